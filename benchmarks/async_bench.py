@@ -0,0 +1,145 @@
+# Execute with:
+#   Repos/slack-notiphier $ venv/bin/python benchmarks/async_bench.py
+#
+# Measures the per-delivery latency and the throughput of WebhookFirehose.handle, one delivery at a time as the Flask
+# app does, against WebhookFirehose.handle_async with concurrent deliveries, as the ASGI app does. Conduit and Slack are
+# faked with a fixed latency per API call. Every delivery is a diff with several comments, on a different diff, so
+# the object cache doesn't hide the Conduit calls.
+
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+import bench_setup
+
+from slack_notiphier.webhook_firehose import WebhookFirehose
+
+LATENCY = 0.02
+DELIVERIES = 50
+COMMENTS = 4
+
+
+def _slow(function):
+    def inner(*args, **kwargs):
+        time.sleep(LATENCY)
+        return function(*args, **kwargs)
+    return inner
+
+
+def _fake_phabricator():
+    phab = MagicMock()
+
+    phab.user.search.side_effect = _slow(lambda **kwargs: {
+        'data': [{
+            'type': 'USER',
+            'phid': "PHID-USER-{}".format(i),
+            'fields': {'username': "user{}".format(i), 'realName': "User Name {}".format(i), 'roles': []},
+        } for i in range(10)],
+    })
+
+    phab.transaction.search.side_effect = _slow(lambda objectIdentifier, constraints: {
+        'data': [{
+            'phid': phid,
+            'type': 'comment',
+            'authorPHID': "PHID-USER-1",
+            'objectPHID': objectIdentifier,
+            'comments': [{'removed': False, 'content': {'raw': "Comment {}".format(phid)}}],
+            'fields': {},
+        } for phid in constraints['phids']],
+    })
+
+    phab.differential.revision.search.side_effect = _slow(lambda constraints: {
+        'data': [{
+            'id': i,
+            'phid': phid,
+            'fields': {'title': "Diff {}".format(i), 'authorPHID': "PHID-USER-2", 'repositoryPHID': "PHID-REPO-1"},
+        } for i, phid in enumerate(constraints['phids'])],
+    })
+
+    phab.diffusion.repository.search.side_effect = _slow(lambda constraints: {
+        'data': [{'id': 1, 'phid': phid, 'fields': {'name': "RepoX"}} for phid in constraints['phids']],
+    })
+
+    return phab
+
+
+def _fake_slack():
+    slack = MagicMock()
+
+    def api_call(method, **kwargs):
+        if method == "users.list":
+            return {'ok': True, 'members': [{
+                'id': "U{}".format(i),
+                'deleted': False,
+                'is_bot': False,
+                'real_name': "User Name {}".format(i),
+            } for i in range(10)]}
+        return {'ok': True}
+
+    slack.api_call.side_effect = _slow(api_call)
+    return slack
+
+
+def _deliveries():
+    return [{
+        'object': {'type': "DREV", 'phid': "PHID-DREV-{}".format(i)},
+        'transactions': [{'phid': "PHID-XACT-DREV-{}-{}".format(i, j)} for j in range(COMMENTS)],
+    } for i in range(DELIVERIES)]
+
+
+async def _timed_async(webhook, delivery):
+    start = time.perf_counter()
+    await webhook.handle_async(delivery)
+    return time.perf_counter() - start
+
+
+def _run_sync(webhook):
+    start = time.perf_counter()
+    latencies = []
+    for delivery in _deliveries():
+        delivery_start = time.perf_counter()
+        webhook.handle(delivery)
+        latencies.append(time.perf_counter() - delivery_start)
+    return latencies, time.perf_counter() - start
+
+
+def _run_async_one_at_a_time(webhook):
+    start = time.perf_counter()
+    loop = asyncio.get_event_loop()
+    latencies = [loop.run_until_complete(_timed_async(webhook, d)) for d in _deliveries()]
+    return latencies, time.perf_counter() - start
+
+
+def _run_async(webhook):
+    start = time.perf_counter()
+    loop = asyncio.get_event_loop()
+    latencies = loop.run_until_complete(asyncio.gather(*(_timed_async(webhook, d) for d in _deliveries())))
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    with patch("phabricator.Phabricator") as Phabricator, patch("slackclient.SlackClient") as Slack:
+        Phabricator.return_value = _fake_phabricator()
+        Slack.return_value = _fake_slack()
+
+        print("{} deliveries of {} comments, {:.0f} msec per API call".format(DELIVERIES, COMMENTS, LATENCY * 1000))
+        print("{:>18} {:>18} {:>18} {:>18}".format("handler", "msec/delivery", "max msec/delivery",
+                                                    "deliveries/sec"))
+
+        for name, run in [("handle", _run_sync),
+                          ("handle_async", _run_async_one_at_a_time),
+                          ("handle_async x{}".format(DELIVERIES), _run_async)]:
+            webhook = WebhookFirehose()
+            # Only the API latency is measured, not Slack's rate limits
+            webhook._slack_client._sender._rate = webhook._slack_client._sender._burst = 1e9
+            webhook._phab_client._object_cache.clear()
+
+            latencies, elapsed = run(webhook)
+            print("{:>18} {:>18.1f} {:>18.1f} {:>18.1f}".format(name,
+                                                                  sum(latencies) / len(latencies) * 1000,
+                                                                  max(latencies) * 1000,
+                                                                  len(latencies) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
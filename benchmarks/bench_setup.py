@@ -0,0 +1,22 @@
+"""
+    Shared setup for the benchmarks: makes `slack_notiphier` importable from the source tree and points it to the
+    test config file, so benchmarks can run without a real Phabricator or Slack configuration.
+    Import this module before importing anything from `slack_notiphier`.
+"""
+
+import os
+import sys
+import timeit
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.environ.setdefault('NOTIPHIER_CONFIG_FILE', os.path.join(ROOT_DIR, 'tests', 'resources', 'slack-notiphier.cfg'))
+
+
+def measure(statement, number):
+    """
+        Returns the average time, in microseconds, of executing `statement` (a callable) `number` times.
+        The best of 3 repetitions is taken to reduce noise.
+    """
+    return min(timeit.repeat(statement, number=number, repeat=3)) / number * 1e6
@@ -0,0 +1,101 @@
+# Execute with:
+#   Repos/slack-notiphier $ venv/bin/python benchmarks/ingest_bench.py
+#
+# Measures the CPU time per request spent by /firehose before handing a delivery to WebhookFirehose, for deliveries
+# of different sizes, through Flask's test client. It compares the current endpoint, which reads the body once and
+# checks and parses the same buffer, with the previous one, which went through request.data and request.json, and
+# with serializing the delivery for the debug log, which is only done now when the debug level is enabled.
+
+import hashlib
+import hmac
+import json
+import time
+from unittest.mock import patch
+
+import bench_setup
+
+from flask import Flask, request, abort
+
+from slack_notiphier import config
+from slack_notiphier.signature import SignatureVerifier
+from slack_notiphier.webhook_firehose import WebhookFirehose
+from slack_notiphier.wsgi import create_app
+
+HMAC_KEY = "ingest-bench"
+REQUESTS = 200
+
+
+def _previous_app(handle):
+    app = Flask('previous')
+    signature_verifier = SignatureVerifier([HMAC_KEY.encode()])
+
+    @app.route('/firehose', methods=['POST'])
+    def phab_webhook_firehose():
+        expected_digest = request.headers.get('X-Phabricator-Webhook-Signature', None)
+        if not signature_verifier.verify(request.data, expected_digest):
+            abort(400)
+        if not request.json:
+            abort(400)
+        handle(request.json)
+        return "OK\n"
+
+    return app
+
+
+def _delivery(transactions):
+    return json.dumps({
+        'object': {'type': "DREV", 'phid': "PHID-DREV-ingestbenchingestbench"},
+        'triggers': [{'phid': "PHID-HWBH-ingestbenchingestbench"}],
+        'action': {'test': False, 'silent': False, 'secure': False, 'epoch': 1546300800},
+        'transactions': [{'phid': "PHID-XACT-DREV-{:015d}".format(i)} for i in range(transactions)],
+    }).encode()
+
+
+def _cpu_msec(function, number):
+    start = time.process_time()
+    for _ in range(number):
+        function()
+    return (time.process_time() - start) / number * 1000
+
+
+def main():
+    config._config.update({'phabricator_webhook_hmac': HMAC_KEY, 'max_body_size': 10 * 1024 * 1024,
+                           'log_level': 'INFO'})
+
+    with patch("phabricator.Phabricator") as Phabricator, patch("slackclient.SlackClient") as Slack:
+        Phabricator.return_value.user.search.return_value = {'data': []}
+        Slack.return_value.api_call.return_value = {'ok': True, 'members': []}
+        current = create_app().test_client()
+    previous = _previous_app(lambda delivery: None).test_client()
+
+    # Only the endpoint is measured, not handling the deliveries
+    with patch.object(WebhookFirehose, 'handle', lambda self, delivery: None):
+        _measure(current, previous)
+
+
+def _measure(current, previous):
+    print("{:>14} {:>10} {:>30} {:>14}".format("transactions", "KB", "ingest", "CPU msec/req"))
+
+    for transactions in [10, 1000, 10000]:
+        body = _delivery(transactions)
+        headers = {'Content-Type': 'application/json',
+                   'X-Phabricator-Webhook-Signature': hmac.new(HMAC_KEY.encode(), body, hashlib.sha256).hexdigest()}
+        number = max(5, REQUESTS // max(1, transactions // 100))
+
+        def post(client):
+            response = client.post('/firehose', data=body, headers=headers)
+            assert response.status_code == 200, response.status_code
+
+        delivery = json.loads(body)
+        results = [
+            ("request.data + request.json", _cpu_msec(lambda: post(previous), number)),
+            ("single read and parse", _cpu_msec(lambda: post(current), number)),
+            ("json.dumps(indent=4) (debug)", _cpu_msec(lambda: json.dumps(delivery, indent=4), number)),
+        ]
+
+        for name, msec in results:
+            print("{:>14} {:>10.1f} {:>30} {:>14.3f}".format(transactions, len(body) / 1024, name, msec))
+
+
+if __name__ == '__main__':
+    main()
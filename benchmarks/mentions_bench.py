@@ -0,0 +1,87 @@
+# Execute with:
+#   Repos/slack-notiphier $ venv/bin/python benchmarks/mentions_bench.py
+#
+# Measures replacing Phabricator mentions with Slack mentions in large comments (pasted logs of 10 KB and 100 KB) with
+# 10k users, comparing it with the previous implementation, which looked every mention up on its own and then called
+# str.replace over the whole text once per distinct mention. Rendering the same comment again hits the memoized result.
+
+import random
+from unittest.mock import MagicMock, patch
+
+import bench_setup
+
+from slack_notiphier.users import Users
+from slack_notiphier.webhook_firehose import WebhookFirehose
+
+USERS = 10000
+
+
+class _FakePhabClient:
+
+    def iter_users(self, page_size=None, created_after=None):
+        yield {"PHID-USER-{:08d}".format(i): ("user{}".format(i), "User Name {}".format(i)) for i in range(USERS)}
+
+
+class _FakeSlackClient:
+
+    def iter_users(self, page_size=None):
+        yield {"User Name {}".format(i): "U{:08d}".format(i) for i in range(USERS)}
+
+
+def _old_replace_mentions(webhook, text):
+    replacements = {}
+    for match in webhook._re_phab_mention.finditer(text):
+        mention = webhook._users.get_mention(match.group(1))
+        if mention is not None:
+            replacements[match.group(0)] = mention
+
+    for phab_username, slack_mention in replacements.items():
+        text = text.replace(phab_username, slack_mention)
+    return text
+
+
+def _comment(size, mention_every):
+    random.seed(size)
+    lines = []
+    length = 0
+    while length < size:
+        if len(lines) % mention_every == 0:
+            line = "[build] step {} failed, cc @user{} @unknown{}".format(len(lines), random.randrange(USERS),
+                                                                           len(lines))
+        else:
+            line = "2019-01-01 12:00:{:02d} INFO worker-{} processed job {} in 12 ms".format(len(lines) % 60,
+                                                                                            len(lines) % 8, len(lines))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def main():
+    users = Users(_FakePhabClient(), _FakeSlackClient())
+    with patch("slack_notiphier.webhook_firehose.Users", lambda **kwargs: users), \
+            patch("phabricator.Phabricator", MagicMock()), patch("slackclient.SlackClient", MagicMock()):
+        webhook = WebhookFirehose()
+
+    print("{:>8} {:>10} {:>20} {:>14}".format("KB", "mentions", "replace", "msec/comment"))
+
+    for size in [10 * 1024, 100 * 1024]:
+        for mention_every in [100, 5]:
+            text = _comment(size, mention_every)
+            mentions = len(webhook._re_phab_mention.findall(text))
+
+            def first_render():
+                webhook._mention_cache.clear()
+                webhook._replace_mentions(text)
+
+            results = [
+                ("str.replace (old)", bench_setup.measure(lambda: _old_replace_mentions(webhook, text), 5)),
+                ("re.sub", bench_setup.measure(first_render, 20)),
+                ("re.sub (memoized)", bench_setup.measure(lambda: webhook._replace_mentions(text), 1000)),
+            ]
+
+            for name, usec in results:
+                print("{:>8} {:>10} {:>20} {:>14.3f}".format(size // 1024, mentions, name, usec / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+# Execute with:
+#   Repos/slack-notiphier $ venv/bin/python benchmarks/replay.py [--workers 2 --threads 4 --concurrency 8 ...]
+#
+# Load test of the whole service: starts Slack Notiphier in a subprocess, pointed to stand-in Conduit and Slack HTTP
+# servers with a configurable latency, and replays a corpus of Firehose deliveries against /firehose, signed like
+# Phabricator signs them. Reports the throughput, the latency percentiles and the API calls made per delivery.
+#
+# The corpus is made of files in the format of tests/resources/*.json: the delivery in "request" and the answers of
+# Conduit in "mocked_phab_calls". Recorded deliveries can be replayed by writing them in that format to a directory and
+# passing it with --corpus.
+
+import argparse
+import glob
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+import requests
+
+import bench_setup
+
+_HMAC_KEY = "replay-hmac-key"
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _FakeApi:
+    """
+        Base of the stand-in servers: answers POST /api/<method> after sleeping `latency` seconds, and counts the
+        calls made to each method.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length', 0))
+                form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+
+                with fake._lock:
+                    fake.calls[method] += 1
+                time.sleep(fake.latency)
+
+                body = json.dumps(fake.answer(method, form)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def answer(self, method, form):
+        raise NotImplementedError
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class _FakeConduit(_FakeApi):
+    """
+        Answers Conduit calls with the responses recorded in the corpus. Users are made up for every user PHID found in
+        the corpus.
+    """
+
+    def __init__(self, latency, corpus):
+        super().__init__(latency)
+        self._responses = {}
+        self._records = {}
+
+        for spec in corpus:
+            for method, calls in spec['mocked_phab_calls'].items():
+                for call in calls:
+                    self._responses[(method, self._canonical(call['kwargs']))] = call['response']
+                    data = call['response']['data']
+                    records = data.values() if isinstance(data, dict) else data
+                    for record in records:
+                        self._records.setdefault(method, {})[record.get('phid')] = record
+
+        user_phids = set(re.findall(r'PHID-USER-[\w]+', json.dumps(corpus)))
+        self._users = [{
+            'type': 'USER',
+            'phid': phid,
+            'fields': {
+                'username': 'ph-username-' + phid[len('PHID-USER-'):],
+                'realName': 'User Name ' + phid[len('PHID-USER-'):].upper(),
+                'roles': [],
+            },
+        } for phid in sorted(user_phids)]
+
+    def answer(self, method, form):
+        params = json.loads(form.get('params', '{}'))
+        params.pop('__conduit__', None)
+
+        if method == 'conduit.ping':
+            result = 'localhost'
+        elif method == 'user.search':
+            phids = params.get('constraints', {}).get('phids')
+            result = {'data': [u for u in self._users if phids is None or u['phid'] in phids],
+                      'cursor': {'after': None}}
+        elif (method, self._canonical(params)) in self._responses:
+            result = self._responses[(method, self._canonical(params))]
+        else:
+            # Not recorded with these exact arguments, e.g. a batch of objects: built from the records of each object
+            phids = params.get('phids') or params.get('constraints', {}).get('phids', [])
+            records = self._records.get(method, {})
+            if method == 'diffusion.querycommits':
+                result = {'data': {phid: records[phid] for phid in phids if phid in records}}
+            else:
+                result = {'data': [records[phid] for phid in phids if phid in records]}
+
+        return {'result': result, 'error_code': None, 'error_info': None}
+
+    @staticmethod
+    def _canonical(kwargs):
+        return json.dumps(kwargs, sort_keys=True)
+
+
+class _FakeSlack(_FakeApi):
+    """
+        Answers Slack calls. Users are made up to match the ones of _FakeConduit, and messages about exceptions are
+        counted as failed deliveries.
+    """
+
+    def __init__(self, latency, conduit):
+        super().__init__(latency)
+        self._members = [{
+            'id': 'SLACK-ID-' + user['phid'][len('PHID-USER-'):],
+            'real_name': user['fields']['realName'],
+            'deleted': False,
+            'is_bot': False,
+        } for user in conduit._users]
+        self.errors = 0
+
+    def answer(self, method, form):
+        if method == 'users.list':
+            return {'ok': True, 'members': self._members}
+
+        if method == 'chat.postMessage':
+            attachments = json.loads(form.get('attachments', '[]'))
+            if any(a.get('text', '').startswith("\n*Exception in Slack-Notiphier:*") for a in attachments):
+                with self._lock:
+                    self.errors += 1
+            return {'ok': True}
+
+        return {'ok': False, 'error': 'unknown_method'}
+
+
+def _load_corpus(corpus_dir):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*.json'))):
+        with open(path, 'r') as fp:
+            spec = json.load(fp)
+        if 'request' in spec and 'mocked_phab_calls' in spec:
+            corpus.append(spec)
+    return corpus
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_notiphier(args, conduit, slack, port, config_dir):
+    config_file = os.path.join(config_dir, 'slack-notiphier.cfg')
+    config = {
+        'log_level': 'ERROR',
+        'phabricator_url': 'http://127.0.0.1:{}/'.format(conduit.port),
+        'phabricator_token': 'api-replay',
+        'phabricator_webhook_hmac': _HMAC_KEY,
+        'slack_token': 'xoxa-replay',
+        'slack_api_url': 'http://127.0.0.1:{}/api/'.format(slack.port),
+        # Slack's rate limits would be the only thing measured otherwise
+        'slack_rate_per_channel': 1000000,
+        'slack_burst_per_channel': 1000000,
+        'users_refresh_interval': 0,
+        'object_cache_size': args.object_cache_size,
+        'snapshot_dir': os.path.join(config_dir, 'snapshots'),
+        # The same deliveries are replayed over and over
+        'dedup_window': 0,
+        'channels': {
+            '__default__': '_slack_channel_',
+            'RepoX': '_slack_channel_x_',
+        },
+    }
+    with open(config_file, 'w') as fp:
+        json.dump(config, fp)
+
+    if args.server == 'serve':
+        command = [sys.executable, '-m', 'slack_notiphier', 'serve', '--workers', str(args.workers),
+                   '--threads', str(args.threads), '--bind', '127.0.0.1:{}'.format(port)]
+    else:
+        config['port'] = port
+        config['host'] = '127.0.0.1'
+        with open(config_file, 'w') as fp:
+            json.dump(config, fp)
+        command = [sys.executable, '-m', 'slack_notiphier']
+
+    process = subprocess.Popen(command, cwd=os.path.join(bench_setup.ROOT_DIR, 'src'),
+                               env=dict(os.environ, NOTIPHIER_CONFIG_FILE=config_file),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception("Slack Notiphier exited with code {}".format(process.returncode))
+        try:
+            if requests.get('http://127.0.0.1:{}/health'.format(port), timeout=1).ok:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+
+    process.terminate()
+    raise Exception("Slack Notiphier didn't start in time")
+
+
+def _sign(body):
+    return hmac.new(_HMAC_KEY.encode(), body, hashlib.sha256).hexdigest()
+
+
+def _replay(url, deliveries, count, concurrency):
+    """
+        Posts `count` deliveries, cycling through the given ones, from `concurrency` threads.
+
+        :return (latencies in seconds, non-200 responses, elapsed seconds)
+    """
+    bodies = [json.dumps(d).encode('utf-8') for d in deliveries]
+    payloads = itertools.islice(itertools.cycle([(body, _sign(body)) for body in bodies]), count)
+    payloads_lock = threading.Lock()
+    local = threading.local()
+    latencies = []
+    failures = Counter()
+
+    def worker():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        while True:
+            with payloads_lock:
+                payload = next(payloads, None)
+            if payload is None:
+                return
+
+            body, signature = payload
+            started_at = time.perf_counter()
+            response = local.session.post(url, data=body, headers={
+                'Content-Type': 'application/json',
+                'X-Phabricator-Webhook-Signature': signature,
+            })
+            elapsed = time.perf_counter() - started_at
+
+            with payloads_lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    failures[response.status_code] += 1
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies, failures, time.perf_counter() - started_at
+
+
+def _percentile(values, percentile):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays Firehose deliveries against Slack Notiphier.")
+    parser.add_argument('--corpus', default=os.path.join(bench_setup.ROOT_DIR, 'tests', 'resources'),
+                        help="directory with the deliveries to replay, in the format of tests/resources/*.json")
+    parser.add_argument('--deliveries', type=int, default=500, help="deliveries to post, cycling through the corpus")
+    parser.add_argument('--warmup', type=int, default=50, help="deliveries posted before measuring")
+    parser.add_argument('--concurrency', type=int, default=8, help="deliveries posted at the same time")
+    parser.add_argument('--server', choices=['serve', 'flask'], default='serve',
+                        help="run the production server (serve) or Flask's development server (flask)")
+    parser.add_argument('--workers', type=int, default=2, help="worker processes, with --server serve")
+    parser.add_argument('--threads', type=int, default=4, help="threads per worker, with --server serve")
+    parser.add_argument('--conduit-latency', type=float, default=20, help="milliseconds per Conduit call")
+    parser.add_argument('--slack-latency', type=float, default=50, help="milliseconds per Slack call")
+    parser.add_argument('--object-cache-size', type=int, default=1000, help="object_cache_size, 0 disables the cache")
+    parser.add_argument('--verbose', action='store_true', help="show the output of Slack Notiphier")
+    args = parser.parse_args()
+
+    corpus = _load_corpus(args.corpus)
+    if not corpus:
+        parser.error("No deliveries found in " + args.corpus)
+
+    conduit = _FakeConduit(args.conduit_latency / 1000, corpus)
+    slack = _FakeSlack(args.slack_latency / 1000, conduit)
+    port = _free_port()
+    url = 'http://127.0.0.1:{}/firehose'.format(port)
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        process = _start_notiphier(args, conduit, slack, port, config_dir)
+        try:
+            deliveries = [spec['request'] for spec in corpus]
+            _replay(url, deliveries, args.warmup, args.concurrency)
+
+            conduit.reset()
+            slack.reset()
+            slack.errors = 0
+            latencies, failures, elapsed = _replay(url, deliveries, args.deliveries, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+
+    print("{} deliveries ({} in the corpus), concurrency {}, server: {}".format(
+        args.deliveries, len(corpus), args.concurrency,
+        "{} workers x {} threads".format(args.workers, args.threads) if args.server == 'serve' else "flask"))
+    print("Latency of the stand-ins: Conduit {:.0f} ms, Slack {:.0f} ms".format(args.conduit_latency,
+                                                                               args.slack_latency))
+    print()
+    print("{:>28} {:>10.1f}".format("deliveries/sec", len(latencies) / elapsed))
+    print("{:>28} {:>10.1f}".format("p50 latency (ms)", _percentile(latencies, 50) * 1000))
+    print("{:>28} {:>10.1f}".format("p99 latency (ms)", _percentile(latencies, 99) * 1000))
+    print("{:>28} {:>10.1f}".format("max latency (ms)", max(latencies) * 1000))
+    print("{:>28} {:>10}".format("non-200 responses", sum(failures.values())))
+    print("{:>28} {:>10}".format("failed deliveries", slack.errors))
+    print()
+    print("API calls per delivery:")
+    for name, fake in [("Conduit", conduit), ("Slack", slack)]:
+        print("{:>28} {:>10.2f}".format(name, sum(fake.calls.values()) / len(latencies)))
+        for method, calls in sorted(fake.calls.items()):
+            print("{:>28} {:>10.2f}".format(method, calls / len(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Execute with:
+#   Repos/slack-notiphier $ venv/bin/python benchmarks/signature_bench.py
+#
+# Measures checking the signature of a delivery with 1, 4 and 16 active keys, signed with the last key. It compares
+# SignatureVerifier with computing the HMAC of every key from scratch and comparing hexadecimal strings, as was done
+# with a single key before key rotation was supported. Updating the verification metrics is measured on its own, as
+# both would pay for it.
+
+import hashlib
+import hmac
+import json
+
+import bench_setup
+
+from slack_notiphier.signature import SignatureVerifier
+
+
+def _body():
+    return json.dumps({
+        'object': {'type': "DREV", 'phid': "PHID-DREV-signaturebenchsigna"},
+        'transactions': [{'phid': "PHID-XACT-DREV-{:015d}".format(i)} for i in range(5)],
+    }).encode()
+
+
+def _from_scratch(keys, body, signature):
+    return any(hmac.compare_digest(hmac.new(key, body, hashlib.sha256).hexdigest(), signature) for key in keys)
+
+
+def main():
+    body = _body()
+    print("{:>6} {:>30} {:>14}".format("keys", "verification", "usec/request"))
+
+    for count in [1, 4, 16]:
+        keys = ["webhook-key-{}".format(i).encode() for i in range(count)]
+        signature = hmac.new(keys[-1], body, hashlib.sha256).hexdigest()
+        verifier = SignatureVerifier(keys)
+
+        results = [
+            ("hmac.new per key (old)", bench_setup.measure(lambda: _from_scratch(keys, body, signature), 20000)),
+            ("SignatureVerifier", bench_setup.measure(lambda: verifier._verify(body, signature), 20000)),
+            ("SignatureVerifier with metrics", bench_setup.measure(lambda: verifier.verify(body, signature), 20000)),
+        ]
+
+        for name, usec in results:
+            print("{:>6} {:>30} {:>14.3f}".format(count, name, usec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Execute with:
+#   Repos/slack-notiphier $ venv/bin/python benchmarks/users_bench.py
+#
+# Measures the cost of looking users up in the Users directory with 10k and 100k users, comparing it with the linear
+# scan over all the users that was used to look users up by username before the directory had indexes.
+
+import bench_setup
+
+from slack_notiphier.users import Users
+
+
+class _FakePhabClient:
+
+    def __init__(self, count):
+        self._count = count
+
+    def iter_users(self, page_size=None, created_after=None):
+        yield {"PHID-USER-{:08d}".format(i): ("user{}".format(i), "User Name {}".format(i))
+               for i in range(self._count)}
+
+
+class _FakeSlackClient:
+
+    def __init__(self, count):
+        self._count = count
+
+    def iter_users(self, page_size=None):
+        yield {"User Name {}".format(i): "U{:08d}".format(i) for i in range(self._count)}
+
+
+def _linear_scan(users, username):
+    return next((u for u in users._directory.users.values() if u.phab_username == username), None)
+
+
+def main():
+    print("{:>8} {:>24} {:>14}".format("users", "lookup", "usec/lookup"))
+
+    for count in [10000, 100000]:
+        users = Users(_FakePhabClient(count), _FakeSlackClient(count))
+        phid = "PHID-USER-{:08d}".format(count - 1)
+        username = "user{}".format(count - 1)
+
+        results = [
+            ("by PHID", bench_setup.measure(lambda: users[phid], 100000)),
+            ("by username", bench_setup.measure(lambda: users[username], 100000)),
+            ("by username (any case)", bench_setup.measure(lambda: users[username.upper()], 100000)),
+            ("by Slack ID", bench_setup.measure(lambda: users.get_by_slack_id("U00000001"), 100000)),
+            ("mention", bench_setup.measure(lambda: users.get_mention(username), 100000)),
+            ("linear scan (old)", bench_setup.measure(lambda: _linear_scan(users, username), 10)),
+        ]
+
+        for name, usec in results:
+            print("{:>8} {:>24} {:>14.3f}".format(count, name, usec))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,38 @@
 
-import hashlib
-import hmac
+import argparse
 
-from flask import Flask, request, abort, make_response, jsonify
-
-from .webhook_firehose import WebhookFirehose
 from .config import get_config
-from .logger import Logger
-
-
-app = Flask(__name__)
-handler = WebhookFirehose()
-
-_hmac = get_config('phabricator_webhook_hmac').encode()
-_logger = Logger('Main')
-
-
-@app.errorhandler(404)
-def not_found(error):
-    return make_response(jsonify({'error': 'Not found'}), 404)
-
-
-@app.route('/firehose', methods=['POST'])
-def phab_webhook_firehose():
-    expected_digest = request.headers.get('X-Phabricator-Webhook-Signature', None)
-    if not expected_digest:
-        _logger.warn("Incoming request didn't contain a message signature")
-        abort(400)
-
-    actual_digest = hmac.new(_hmac, request.data, hashlib.sha256).hexdigest()
 
-    if expected_digest != actual_digest:
-        _logger.warn("Incoming request contained an invalid message signature")
-        abort(400)
 
-    if not request.json:
-        abort(400)
+def main():
+    parser = argparse.ArgumentParser(prog='python -m slack_notiphier',
+                                     description="Posts messages in Slack about activity in Phabricator.")
+    subparsers = parser.add_subparsers(dest='command')
 
-    handler.handle(request.json)
+    serve_parser = subparsers.add_parser('serve', help="run the production server, with several worker processes")
+    serve_parser.add_argument('--workers', type=int, default=get_config('workers', 2),
+                              help="number of worker processes")
+    serve_parser.add_argument('--threads', type=int, default=get_config('threads', 4),
+                              help="number of threads handling requests in each worker")
+    serve_parser.add_argument('--timeout', type=int, default=get_config('worker_timeout', 60),
+                              help="seconds a worker can spend on a request before it is restarted")
+    serve_parser.add_argument('--bind', default="{}:{}".format(get_config('host', '0.0.0.0'), get_config('port', 5000)),
+                              help="address to listen on, as HOST:PORT")
 
-    return "OK\n"
+    args = parser.parse_args()
 
+    if args.command == 'serve':
+        from .serve import serve
+        serve(bind=args.bind, workers=args.workers, threads=args.threads, timeout=args.timeout)
+        return
 
-@app.route('/health')
-def health():
-    return "OK\n"
+    # Flask's development server, in a single process
+    from .wsgi import create_app
+    create_app().run(use_reloader=False,
+                     debug=get_config('_flask_debug', False),
+                     host=get_config('host', '0.0.0.0'),
+                     port=get_config('port', 5000))
 
 
 if __name__ == '__main__':
-    app.run(use_reloader=False,
-            debug=get_config('_flask_debug', False),
-            host=get_config('host', '0.0.0.0'),
-            port=get_config('port', 5000))
+    main()
@@ -0,0 +1,131 @@
+"""
+    ASGI entry point, serving the same endpoints as the Flask app with `WebhookFirehose.handle_async`.
+    Serve it with any ASGI server, e.g.:
+
+        $ uvicorn slack_notiphier.asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import json
+
+from . import logger
+from . import metrics
+from .webhook_firehose import WebhookFirehose
+from .signature import SignatureVerifier
+from .config_watcher import ConfigWatcher
+from .config import get_config
+from .logger import Logger
+
+
+handler = WebhookFirehose()
+
+_signature_verifier = SignatureVerifier.from_config()
+_config_watcher = ConfigWatcher([logger.prepare_reload, handler.prepare_reload, _signature_verifier.prepare_reload],
+                                interval=get_config('config_reload_interval', 10))
+_config_watcher.start()
+_max_body_size = get_config('max_body_size', 1048576)
+_logger = Logger('ASGI')
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+
+    if path == '/firehose' and method == 'POST':
+        status, body = await _firehose(scope, receive)
+        await _respond(send, status, body)
+    elif path == '/health' and method in ('GET', 'HEAD'):
+        await _respond(send, 200, b"OK\n")
+    elif path == '/metrics' and method in ('GET', 'HEAD'):
+        await _respond(send, 200, metrics.render().encode(), metrics.content_type.encode())
+    elif path == '/stats' and method in ('GET', 'HEAD'):
+        await _respond(send, 200, json.dumps(handler.stats()).encode(), b'application/json')
+    else:
+        await _respond(send, 404, json.dumps({'error': 'Not found'}).encode(), b'application/json')
+
+
+async def _firehose(scope, receive):
+    headers = dict(scope['headers'])
+
+    # The body is read once, and the same buffer is checked against the signature and parsed
+    body = await _read_body(receive, headers.get(b'content-length'))
+    if body is None:
+        _logger.warn("Incoming request was larger than max_body_size")
+        return 413, b"Payload Too Large\n"
+
+    signature = headers.get(b'x-phabricator-webhook-signature', b'').decode('latin-1')
+    if not _signature_verifier.verify(body, signature):
+        if not signature:
+            _logger.warn("Incoming request didn't contain a message signature")
+        else:
+            _logger.warn("Incoming request contained an invalid message signature")
+        return 400, b"Bad Request\n"
+
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return 400, b"Bad Request\n"
+
+    if not request:
+        return 400, b"Bad Request\n"
+
+    await handler.handle_async(request)
+
+    return 200, b"OK\n"
+
+
+async def _read_body(receive, content_length=None):
+    """
+        Returns the body of a request, or None if it is larger than max_body_size. Requests announcing a larger body
+        aren't read at all.
+    """
+    if content_length is not None and content_length.isdigit() and int(content_length) > _max_body_size:
+        return None
+
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > _max_body_size:
+            return None
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+
+    # Bodies usually arrive in a single chunk, which is used as it is
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+async def _respond(send, status, body, content_type=b'text/plain; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': body,
+    })
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _config_watcher.stop()
+            handler.flush()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
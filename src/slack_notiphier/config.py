@@ -6,27 +6,58 @@ _no_default = object()
 _config = {}
 
 
-def get_config(name, default=_no_default):
+def get_config(name, default=_no_default, config=None):
+    """
+        :param config: config to read instead of the one in use, e.g. one just loaded that isn't in use yet.
+    """
+    config = _config if config is None else config
     if default is _no_default:
-        value = _config.get(name)
+        value = config.get(name)
         if not value:
             raise ValueError("No value found for '{}' in config file: {}".format(name, _config_file))
         return value
     else:
-        return _config.get(name, default)
+        return config.get(name, default)
 
 
-def reload():
-    global _config, _config_file
-    _config_file = os.getenv('NOTIPHIER_CONFIG_FILE', "/etc/slack-notiphier.cfg")
-    with open(_config_file, 'r') as config_fp:
-        _config = yaml.load(config_fp)
+def config_file():
+    return os.getenv('NOTIPHIER_CONFIG_FILE', "/etc/slack-notiphier.cfg")
+
+
+def load():
+    """
+        Reads and validates the config file, without putting it in use.
+    """
+    path = config_file()
+    with open(path, 'r') as config_fp:
+        config = yaml.safe_load(config_fp)
 
-    if 'channels' not in _config:
+    if not isinstance(config, dict):
+        raise ValueError("The config file must contain a map of config elements: {}".format(path))
+
+    if 'channels' not in config:
         raise KeyError('Need a channels element in the config file.')
 
-    if '__default__' not in _config['channels']:
+    if not isinstance(config['channels'], dict) or '__default__' not in config['channels']:
         raise KeyError('Need to specify a default channels in the config file.')
 
+    return config
+
+
+def swap(config):
+    """
+        Puts a config in use, replacing the whole previous one at once.
+
+        :return The config that was in use.
+    """
+    global _config, _config_file
+    previous = _config
+    _config, _config_file = config, config_file()
+    return previous
+
+
+def reload():
+    swap(load())
+
 
 reload()
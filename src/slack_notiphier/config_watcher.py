@@ -0,0 +1,130 @@
+
+import os
+import signal
+import threading
+
+from . import config
+from . import metrics
+from .logger import Logger
+
+
+_reloads = metrics.counter('notiphier_config_reloads_total',
+                           "Config file reloads, by result: success or failure.",
+                           labels=('result',))
+
+
+class ConfigWatcher:
+    """
+        Reloads the config file without restarting when it changes, checking its modification time every `interval`
+        seconds, or when the process receives a SIGHUP.
+
+        Whatever is derived from the config (channel routing, filters, ...) is rebuilt by reloaders, in the watcher's
+        background thread and not while handling requests. A reloader is a callable that builds what it needs from
+        the new config, which it gets as a dict, and returns a callable that puts it in use. The new config is only
+        put in use, along with everything derived from it, if it is valid and every reloader could build from it.
+        Until then, `get_config` keeps returning the old config.
+
+        Usage:
+            #>>> watcher = ConfigWatcher([logger.prepare_reload, handler.prepare_reload], interval=10)
+            #>>> watcher.start()
+    """
+
+    _logger = Logger('ConfigWatcher')
+
+    def __init__(self, reloaders, interval=10):
+        """
+            :param reloaders: callables building what is derived from the config, see above.
+            :param interval: seconds between checks of the config file. 0 reloads only on SIGHUP.
+        """
+        self._reloaders = list(reloaders)
+        self._interval = interval
+        self._file_state = self._stat()
+        self._lock = threading.Lock()
+        self._reload_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._previous_sighup_handler = None
+
+    def start(self):
+        # Signal handlers can only be set from the main thread, otherwise changes are only noticed by polling
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sighup_handler = signal.signal(signal.SIGHUP, self._on_sighup)
+        else:
+            self._logger.debug("Not started from the main thread, the config won't be reloaded on SIGHUP")
+
+        self._thread = threading.Thread(target=self._watch_loop, name='ConfigWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._previous_sighup_handler is not None:
+            signal.signal(signal.SIGHUP, self._previous_sighup_handler)
+            self._previous_sighup_handler = None
+
+        self._stopped.set()
+        self._reload_requested.set()
+        if self._thread:
+            self._thread.join()
+
+    def request_reload(self):
+        """
+            Asks the background thread to reload the config, whether it changed or not.
+        """
+        self._reload_requested.set()
+
+    def reload(self):
+        """
+            Reloads the config file right away.
+
+            :return True if the new config is in use, False if it wasn't valid and the old one is still in use.
+        """
+        with self._lock:
+            # Taken before reading, so changes made while reloading cause another reload
+            self._file_state = self._stat()
+
+            try:
+                new_config = config.load()
+            except Exception as e:
+                return self._failed("Couldn't load the config file '{}': {}", config.config_file(), e)
+
+            try:
+                appliers = [prepare(new_config) for prepare in self._reloaders]
+            except Exception as e:
+                return self._failed("Invalid config in '{}', keeping the previous one: {}", config.config_file(), e)
+
+            config.swap(new_config)
+            for apply in appliers:
+                apply()
+
+        _reloads.inc(result='success')
+        self._logger.info("Reloaded the config file '{}'", config.config_file())
+        return True
+
+    def _failed(self, message, *args):
+        _reloads.inc(result='failure')
+        self._logger.error(message, *args)
+        return False
+
+    def _on_sighup(self, signum, frame):
+        # Reloading takes locks, so it is left to the background thread
+        self.request_reload()
+
+    def _watch_loop(self):
+        while True:
+            requested = self._reload_requested.wait(self._interval or None)
+            if self._stopped.is_set():
+                return
+            self._reload_requested.clear()
+
+            file_state = self._stat()
+            # A missing file is usually being replaced, it is checked again later
+            if requested or (file_state is not None and file_state != self._file_state):
+                self.reload()
+
+    @staticmethod
+    def _stat():
+        try:
+            stat = os.stat(config.config_file())
+        except OSError:
+            return None
+        # The inode changes when the file is replaced, e.g. Kubernetes' ConfigMaps swap a symlink
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,105 @@
+
+import threading
+import time
+from collections import OrderedDict
+
+from .logger import Logger
+
+
+class DebugChannel:
+    """
+        Posts debugging messages to Slack from a background thread, so they never slow down handling requests.
+
+        Messages are deduplicated by key (the message template, e.g. "No message will be generated for: {}"): only the
+        first message with each key is posted in every interval, and at most `max_messages` are posted per interval.
+        The rest are counted and posted as a single summary at the end of the interval.
+
+        Usage:
+            #>>> channel = DebugChannel(slack_client.slack_debug_callback, interval=60)
+            #>>> channel.post("Unknown type: {}", "Unknown type: task-merge")
+            #>>> channel.post("Unknown type: {}", "Unknown type: task-merge")
+            # The first message is posted right away, the summary of the second one after 60 seconds.
+    """
+
+    _logger = Logger('DebugChannel')
+
+    def __init__(self, send, interval=60, max_messages=10, clock=time.monotonic):
+        """
+            :param send: callable receiving the text to post.
+            :param interval: seconds during which messages with the same key are posted only once, greater than 0.
+            :param max_messages: messages posted at most per interval, not counting the summary.
+        """
+        if not interval > 0:
+            raise ValueError("The interval of the debug channel must be greater than 0: {}".format(interval))
+
+        self._send = send
+        self._interval = interval
+        self._max_messages = max_messages
+        self._clock = clock
+
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self._suppressed = OrderedDict()
+        self._posted_keys = set()
+        self._interval_ends_at = clock() + interval
+
+        self._poster = threading.Thread(target=self._post_loop, name='DebugChannel', daemon=True)
+        self._poster.start()
+
+    def post(self, key, message):
+        """
+            Queues a message to be posted, unless a message with the same key was already posted in this interval or
+            the interval's quota is used up. Never blocks.
+
+            :param message: the text to post, or any object that becomes the text when converted to a string. It is
+                            converted in the background thread, and only if it is posted.
+        """
+        with self._condition:
+            if key in self._posted_keys or key in self._pending or \
+                    len(self._posted_keys) + len(self._pending) >= self._max_messages:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+
+            self._pending[key] = message
+            self._condition.notify()
+
+    def flush(self):
+        """
+            Posts the queued messages and the summary of the suppressed ones right away, and starts a new interval.
+        """
+        self._post(*self._take(end_interval=True))
+
+    def _post_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and self._clock() < self._interval_ends_at:
+                    self._condition.wait(self._interval_ends_at - self._clock())
+
+            self._post(*self._take(end_interval=self._clock() >= self._interval_ends_at))
+
+    def _take(self, end_interval):
+        with self._condition:
+            messages = list(self._pending.values())
+            self._posted_keys.update(self._pending)
+            self._pending.clear()
+
+            suppressed = None
+            if end_interval:
+                suppressed = self._suppressed
+                self._suppressed = OrderedDict()
+                self._posted_keys = set()
+                self._interval_ends_at = self._clock() + self._interval
+
+            return messages, suppressed
+
+    def _post(self, messages, suppressed):
+        if suppressed:
+            messages.append("Debug messages not posted in the last {} seconds:\n{}".format(
+                self._interval,
+                "\n".join("{} x {}".format(count, key) for key, count in suppressed.items())))
+
+        for message in messages:
+            try:
+                self._send(str(message))
+            except Exception as e:
+                self._logger.error("Couldn't post debug message to Slack: {}", e)
@@ -0,0 +1,189 @@
+
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .logger import Logger
+
+
+class SeenTransactions:
+    """
+        Bounded, time-windowed set of the transaction PHIDs already handled, so deliveries Phabricator retries (or
+        that overlap with previous ones) don't post the same messages again.
+
+        Transactions are claimed before handling them, and released if handling fails so a retry can handle them.
+
+        If a file is given, the set is also kept there as an append-only JSON lines log, which survives restarts and
+        is shared by all the processes using the same file. Every claim and release takes an exclusive lock on the
+        file and first reads what other processes appended since the last time. The log is rewritten without the
+        expired entries once it grows well past the size of the set.
+
+        Usage:
+            #>>> seen = SeenTransactions(window=3600)
+            #>>> seen.claim(['PHID-XACT-TASK-1', 'PHID-XACT-TASK-2'])
+            ['PHID-XACT-TASK-1', 'PHID-XACT-TASK-2']
+            #>>> seen.claim(['PHID-XACT-TASK-2', 'PHID-XACT-TASK-3'])
+            ['PHID-XACT-TASK-3']
+
+        Log lines look like:
+            {"phid": "PHID-XACT-TASK-1", "at": 1546300800.0}
+            {"release": "PHID-XACT-TASK-1"}
+    """
+
+    _logger = Logger('SeenTransactions')
+
+    def __init__(self, window=3600, max_size=100000, path=None, compact_threshold=10000, clock=time.time):
+        """
+            :param window: seconds a transaction is remembered for. 0 disables deduplication.
+            :param max_size: transactions remembered at most, the oldest ones are forgotten past this size.
+            :param path: file where the set is kept, created if it doesn't exist.
+            :param compact_threshold: lines in the file after which it can be rewritten without the expired entries.
+            :param clock: function returning the current UNIX time, which is saved to the file.
+        """
+        self._window = window
+        self._max_size = max_size
+        self._path = path
+        self._compact_threshold = compact_threshold
+        self._clock = clock
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._fp = None
+        self._lines = 0
+        if path and window > 0:
+            with self._lock, self._file_lock():
+                self._sync()
+
+    def claim(self, phids):
+        """
+            Marks as seen the transactions that weren't seen within the window.
+
+            :return The PHIDs that weren't seen, in the same order.
+        """
+        if self._window <= 0:
+            return list(phids)
+
+        with self._lock, self._file_lock():
+            self._sync()
+            now = self._clock()
+            self._expire(now)
+
+            claimed = []
+            for phid in phids:
+                if phid not in self._seen:
+                    self._seen[phid] = now
+                    claimed.append(phid)
+
+            self._append({'phid': phid, 'at': now} for phid in claimed)
+            self._expire(now)
+            self._compact()
+            return claimed
+
+    def release(self, phids):
+        """
+            Forgets transactions that were claimed but couldn't be handled.
+        """
+        if self._window <= 0 or not phids:
+            return
+
+        with self._lock, self._file_lock():
+            self._sync()
+            for phid in phids:
+                self._seen.pop(phid, None)
+            self._append({'release': phid} for phid in phids)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        # Entries are kept in the order they were seen, so the expired ones are at the beginning
+        while self._seen:
+            seen_at = next(iter(self._seen.values()))
+            if seen_at > now - self._window and len(self._seen) <= self._max_size:
+                break
+            self._seen.popitem(last=False)
+
+    @contextmanager
+    def _file_lock(self):
+        if not self._path:
+            yield
+            return
+
+        with open("{}.lock".format(self._path), 'a') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+    def _sync(self):
+        """
+            Reads the entries other processes appended to the file. If the file was rewritten since it was opened, the
+            whole set is read again.
+        """
+        if not self._path:
+            return
+
+        if self._fp is not None and not self._is_current():
+            self._fp.close()
+            self._fp = None
+
+        if self._fp is None:
+            self._fp = open(self._path, 'a+')
+            self._fp.seek(0)
+            self._seen.clear()
+            self._lines = 0
+
+        while True:
+            line = self._fp.readline()
+            if not line:
+                break
+            self._lines += 1
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line a crashed process left half written
+                continue
+            if 'release' in entry:
+                self._seen.pop(entry['release'], None)
+            else:
+                self._seen.pop(entry['phid'], None)
+                self._seen[entry['phid']] = entry['at']
+
+    def _is_current(self):
+        try:
+            return os.stat(self._path).st_ino == os.fstat(self._fp.fileno()).st_ino
+        except OSError:
+            return False
+
+    def _append(self, entries):
+        if not self._fp:
+            return
+
+        lines = [json.dumps(entry) + "\n" for entry in entries]
+        if lines:
+            self._fp.write("".join(lines))
+            self._fp.flush()
+            self._lines += len(lines)
+
+    def _compact(self):
+        if not self._fp or self._lines < self._compact_threshold or self._lines < 2 * len(self._seen):
+            return
+
+        tmp_path = "{}.{}.tmp".format(self._path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fp:
+                for phid, seen_at in self._seen.items():
+                    fp.write(json.dumps({'phid': phid, 'at': seen_at}) + "\n")
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self._logger.error("Couldn't compact the seen transactions file '{}': {}", self._path, e)
+            return
+
+        self._fp.close()
+        self._fp = open(self._path, 'a+')
+        self._lines = len(self._seen)
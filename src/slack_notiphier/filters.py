@@ -0,0 +1,96 @@
+
+import fnmatch
+import re
+
+from .config import get_config
+
+
+class _Rule:
+    """
+        Allow and deny lists of names or glob patterns. A name passes if it matches the allow list (when there is one)
+        and it doesn't match the deny list.
+    """
+
+    def __init__(self, dimension, rule):
+        if not isinstance(rule, dict) or set(rule) - {'allow', 'deny'}:
+            raise ValueError("Filter '{}' must have 'allow' and/or 'deny' lists, got: {}".format(dimension, rule))
+        self._allow = self._compile(dimension, rule.get('allow'))
+        self._deny = self._compile(dimension, rule.get('deny'))
+
+    def __bool__(self):
+        return self._allow is not None or self._deny is not None
+
+    def allows(self, *names):
+        """
+            Returns whether a thing known by the given names passes the rule: any of them must be allowed and none of
+            them can be denied. Names that are None are ignored.
+        """
+        names = [name for name in names if name is not None]
+        if self._allow is not None and not any(self._allow.match(name) for name in names):
+            return False
+        if self._deny is not None and any(self._deny.match(name) for name in names):
+            return False
+        return True
+
+    @staticmethod
+    def _compile(dimension, patterns):
+        if patterns is None:
+            return None
+        if not isinstance(patterns, list) or not all(isinstance(pattern, str) for pattern in patterns):
+            raise ValueError("Filter '{}' must have lists of names, got: {}".format(dimension, patterns))
+        return re.compile("|".join("(?:{})".format(fnmatch.translate(pattern)) for pattern in patterns) or "(?!)")
+
+
+class TransactionFilter:
+    """
+        Decides which events from the Firehose generate messages, given the `filters` element of the config file.
+        Each kind of filter is checked as soon as the data it needs is known, so ignored events cost as few Conduit
+        calls as possible: object types before asking Conduit about the transactions, transaction types and authors
+        before looking up the objects they are about, and repositories once they are known.
+
+        Usage:
+            #>>> transaction_filter = TransactionFilter({'object_types': {'deny': ['PROJ']},
+            #>>>                                         'repos': {'allow': ['Mobile*']}})
+            #>>> transaction_filter.allows_object_type('PROJ')
+            False
+            #>>> transaction_filter.allows_repo('MobileApp')
+            True
+    """
+
+    _dimensions = ('object_types', 'transaction_types', 'repos', 'authors')
+
+    def __init__(self, filters=None):
+        """
+            :param filters: {dimension: {'allow': [name or glob], 'deny': [name or glob]}}, dimensions being
+                            `object_types` (e.g. DREV), `transaction_types` (e.g. diff-update), `repos` (repository
+                            names) and `authors` (Phabricator usernames or PHIDs).
+        """
+        filters = filters or {}
+        unknown = set(filters) - set(self._dimensions)
+        if unknown:
+            raise ValueError("Unknown filters: {}. Valid filters are: {}".format(sorted(unknown), self._dimensions))
+
+        self._object_types = _Rule('object_types', filters.get('object_types') or {})
+        self._transaction_types = _Rule('transaction_types', filters.get('transaction_types') or {})
+        self._repos = _Rule('repos', filters.get('repos') or {})
+        self._authors = _Rule('authors', filters.get('authors') or {})
+
+    @classmethod
+    def from_config(cls, config=None):
+        return cls(get_config('filters', {}, config=config))
+
+    @property
+    def has_author_rules(self):
+        return bool(self._authors)
+
+    def allows_object_type(self, object_type):
+        return self._object_types.allows(object_type)
+
+    def allows_transaction_type(self, transaction_type):
+        return self._transaction_types.allows(transaction_type)
+
+    def allows_repo(self, repo_name):
+        return self._repos.allows(repo_name)
+
+    def allows_author(self, phid, username=None):
+        return self._authors.allows(phid, username)
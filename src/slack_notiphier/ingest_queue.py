@@ -0,0 +1,158 @@
+
+import queue
+import threading
+import time
+
+from .logger import Logger
+
+
+class IngestQueue:
+    """
+        Bounded in-process queue of Firehose deliveries, drained by a pool of worker threads.
+        This allows the HTTP endpoint to acknowledge Phabricator as soon as the signature of a delivery is verified,
+        instead of waiting for all the Conduit and Slack calls needed to process it.
+    """
+
+    _logger = Logger('IngestQueue')
+    _stop = object()
+
+    def __init__(self, handler, workers=4, max_size=1000):
+        """
+            :param handler: callable invoked by the workers with each queued delivery.
+            :param workers: number of worker threads processing deliveries.
+            :param max_size: maximum number of deliveries waiting to be processed before `put` starts rejecting them.
+        """
+        if workers < 1:
+            raise ValueError("The ingest queue needs at least one worker, got: {}".format(workers))
+
+        self._handler = handler
+        self._queue = queue.Queue(maxsize=max_size)
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._counters = {
+            'enqueued': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+        }
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._processing_total = 0.0
+        self._processing_max = 0.0
+        self._stopping = False
+        self._stops_queued = 0
+
+        self._workers = [threading.Thread(target=self._work, name='IngestWorker-{}'.format(i), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+        self._logger.info("Started ingest queue with {} workers and room for {} deliveries", workers, max_size)
+
+    def put(self, request):
+        """
+            Enqueues a delivery to be processed in the background.
+
+            :return
+                True if the delivery was queued, False if the queue is full, or stopping, and the caller should apply
+                back-pressure.
+        """
+        if self._stopping:
+            with self._lock:
+                self._counters['rejected'] += 1
+            return False
+
+        try:
+            self._queue.put_nowait((time.monotonic(), request))
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected'] += 1
+            return False
+
+        with self._lock:
+            self._counters['enqueued'] += 1
+        return True
+
+    def join(self):
+        """
+            Blocks until every delivery queued so far has been processed.
+        """
+        self._queue.join()
+
+    def stop(self, timeout=None):
+        """
+            Stops accepting deliveries, processes the ones already queued and then stops the workers.
+
+            :param timeout: maximum seconds to wait for the queued deliveries. None waits for as long as it takes.
+            :return True if all the queued deliveries were processed, False if the timeout expired first.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._stopping = True
+
+        # A worker stops when it gets a stop marker, they go after the deliveries already queued
+        try:
+            while self._stops_queued < len(self._workers):
+                self._queue.put((None, self._stop), timeout=self._remaining(deadline))
+                self._stops_queued += 1
+        except queue.Full:
+            pass
+
+        for worker in self._workers:
+            worker.join(self._remaining(deadline))
+
+        if any(worker.is_alive() for worker in self._workers):
+            self._logger.error("Gave up waiting for the ingest queue, about {} deliveries weren't processed",
+                               self._queue.qsize())
+            return False
+        return True
+
+    def stats(self):
+        """
+            Returns a snapshot of the queue depth, counters and latencies (in seconds), suitable for monitoring.
+        """
+        with self._lock:
+            finished = self._counters['processed'] + self._counters['failed']
+            return {
+                'depth': self._queue.qsize(),
+                'max_size': self._max_size,
+                'workers': len(self._workers),
+                'enqueued': self._counters['enqueued'],
+                'rejected': self._counters['rejected'],
+                'processed': self._counters['processed'],
+                'failed': self._counters['failed'],
+                'wait_avg': self._wait_total / finished if finished else 0.0,
+                'wait_max': self._wait_max,
+                'processing_avg': self._processing_total / finished if finished else 0.0,
+                'processing_max': self._processing_max,
+            }
+
+    def _work(self):
+        while True:
+            enqueued_at, request = self._queue.get()
+            if request is self._stop:
+                self._queue.task_done()
+                return
+
+            started_at = time.monotonic()
+            failed = False
+            try:
+                self._handler(request)
+            except Exception as e:
+                failed = True
+                self._logger.error("Error processing queued delivery: {}", e)
+            finally:
+                finished_at = time.monotonic()
+                self._record(started_at - enqueued_at, finished_at - started_at, failed)
+                self._queue.task_done()
+
+    @staticmethod
+    def _remaining(deadline):
+        return max(0, deadline - time.monotonic()) if deadline is not None else None
+
+    def _record(self, wait, processing, failed):
+        with self._lock:
+            self._counters['failed' if failed else 'processed'] += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._processing_total += processing
+            self._processing_max = max(self._processing_max, processing)
@@ -0,0 +1,138 @@
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from .logger import Logger
+
+
+class InvalidationLog:
+    """
+        Append-only JSON lines log of the Phabricator objects invalidated, shared by all the processes using the same
+        file, so an object that changed while one of them handled a delivery isn't used from the caches of the others.
+
+        Appending takes an exclusive lock on the file. Reading what other processes appended doesn't, and only costs a
+        stat of the file when there is nothing new, so it can be done before every cache hit. The log is rewritten
+        without the entries older than `window` once it grows well past what is left after rewriting it.
+
+        Usage:
+            #>>> log = InvalidationLog('/var/lib/slack-notiphier/invalidations.jsonl', window=86400)
+            #>>> log.append('PHID-TASK-1')
+            #>>> other_process_log.read_new()
+            [('PHID-TASK-1', 0.5)]
+
+        Log lines look like:
+            {"phid": "PHID-TASK-1", "at": 1546300800.0}
+    """
+
+    _logger = Logger('InvalidationLog')
+
+    def __init__(self, path, window=86400, compact_threshold=10000, clock=time.time):
+        """
+            :param path: file where the log is kept, created if it doesn't exist.
+            :param window: seconds an invalidation is kept for, at least as long as objects are cached.
+            :param compact_threshold: lines in the file after which it can be rewritten without the old entries.
+            :param clock: function returning the current UNIX time, which is saved to the file.
+        """
+        self._path = path
+        self._window = window
+        self._compact_threshold = compact_threshold
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._fp = None
+        self._lines = 0
+        self._compacted_lines = 0
+        self._pending = []
+
+    def append(self, phid):
+        with self._lock:
+            try:
+                with open("{}.lock".format(self._path), 'a') as lock_fp:
+                    fcntl.flock(lock_fp, fcntl.LOCK_EX)
+                    try:
+                        # Also reopens the file if it was rewritten, so the entry isn't appended to the old one
+                        self._read()
+                        self._fp.write((json.dumps({'phid': phid, 'at': self._clock()}) + "\n").encode())
+                        self._fp.flush()
+                        self._lines += 1
+                        self._compact()
+                    finally:
+                        fcntl.flock(lock_fp, fcntl.LOCK_UN)
+            except OSError as e:
+                self._logger.error("Couldn't append to the invalidation log '{}': {}", self._path, e)
+
+    def read_new(self):
+        """
+            Returns the objects other processes invalidated since the last call, as (phid, seconds since then). If
+            the file was rewritten, all the entries still in it are returned again, those of this process included.
+        """
+        with self._lock:
+            try:
+                self._read()
+            except OSError as e:
+                self._logger.error("Couldn't read the invalidation log '{}': {}", self._path, e)
+            entries, self._pending = self._pending, []
+
+        now = self._clock()
+        return [(phid, max(0, now - at)) for phid, at in entries]
+
+    def _read(self):
+        if self._fp is not None:
+            try:
+                stat = os.stat(self._path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != os.fstat(self._fp.fileno()).st_ino:
+                self._fp.close()
+                self._fp = None
+            elif stat.st_size == self._fp.tell():
+                return
+
+        if self._fp is None:
+            self._fp = open(self._path, 'ab+')
+            self._fp.seek(0)
+            self._lines = 0
+
+        while True:
+            line = self._fp.readline()
+            if not line:
+                break
+            if not line.endswith(b"\n"):
+                # Still being written, it is read next time
+                self._fp.seek(-len(line), os.SEEK_CUR)
+                break
+            self._lines += 1
+            try:
+                entry = json.loads(line.decode())
+                self._pending.append((entry['phid'], entry['at']))
+            except (ValueError, KeyError):
+                # A line a crashed process left half written
+                continue
+
+    def _compact(self):
+        if self._lines < self._compact_threshold or self._lines < 2 * self._compacted_lines:
+            return
+
+        oldest = self._clock() - self._window
+        self._fp.seek(0)
+        lines = [line for line in self._fp if line.endswith(b"\n") and self._is_recent(line, oldest)]
+
+        tmp_path = "{}.{}.tmp".format(self._path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            fp.writelines(lines)
+        os.replace(tmp_path, self._path)
+
+        # The other processes read the rewritten file from the beginning, this one already has its entries
+        self._fp.close()
+        self._fp = open(self._path, 'ab+')
+        self._fp.seek(0, os.SEEK_END)
+        self._lines = self._compacted_lines = len(lines)
+
+    @staticmethod
+    def _is_recent(line, oldest):
+        try:
+            return json.loads(line.decode())['at'] > oldest
+        except (ValueError, KeyError):
+            return False
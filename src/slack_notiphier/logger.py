@@ -1,5 +1,9 @@
 
+import json
 import logging
+import sys
+import time
+
 from termcolor import colored
 
 from .config import get_config
@@ -12,40 +16,147 @@ _valid_levels = {
     'ERROR': logging.ERROR,
 }
 
+_colors = {
+    logging.DEBUG: 'green',
+    logging.INFO: 'blue',
+    logging.WARN: 'yellow',
+    logging.ERROR: 'red',
+}
+
 
-def reload():
-    _log_level = get_config('log_level', 'INFO')
+class _LazyMessage:
+    """
+        Message in `str.format` style along with its arguments, formatted only when it is emitted.
+        Arguments that are callables are replaced with the value they return.
+    """
+
+    __slots__ = ('message', 'args', 'formatted')
+
+    def __init__(self, message, args):
+        self.message = message
+        self.args = args
+        self.formatted = None
+
+    def __str__(self):
+        # Every handler asks for the message, it is formatted only the first time
+        if self.formatted is None:
+            self.formatted = self.message.format(*(arg() if callable(arg) else arg for arg in self.args))
+        return self.formatted
+
+
+class _TextFormatter(logging.Formatter):
+
+    def __init__(self, use_colors):
+        super().__init__('%(message)s')
+        self._use_colors = use_colors
+
+    def format(self, record):
+        message = super().format(record)
+        if not self._use_colors:
+            return message
+        color = getattr(record, 'color', None) or _colors.get(record.levelno)
+        return colored(message, color, attrs=['dark', 'bold'])
+
+
+class _JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+                    '.{:03d}Z'.format(int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+_handler = None
+
+
+def prepare_reload(config=None):
+    """
+        Validates the log level and format in a config, the one in use by default, and builds the handler for them.
+
+        :return A callable that puts them in use.
+    """
+    _log_level = get_config('log_level', 'INFO', config=config)
     if _log_level not in _valid_levels:
         raise ValueError("Configured log level is not valid: " + _log_level)
 
-    logging.basicConfig(level=_valid_levels[_log_level], format='%(message)s')
+    _log_format = get_config('log_format', 'text', config=config)
+    if _log_format not in ('text', 'json'):
+        raise ValueError("Configured log format is not valid: " + _log_format)
+
+    handler = logging.StreamHandler(sys.stderr)
+    if _log_format == 'json':
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter(use_colors=sys.stderr.isatty()))
+
+    def apply():
+        global _handler
+        root = logging.getLogger()
+        root.addHandler(handler)
+        if _handler:
+            root.removeHandler(_handler)
+        root.setLevel(_valid_levels[_log_level])
+        _handler = handler
+
+    return apply
+
+
+def reload():
+    prepare_reload()()
 
 
 reload()
 
 
 class Logger(object):
+    """
+        Logs messages in `str.format` style. Messages are only formatted if their level is enabled, and arguments that
+        are expensive to compute can be passed as callables, which are only called then:
+
+            #>>> logger.debug("Transaction: {}", lambda: json.dumps(transaction, indent=4))
+    """
+
+    _slack_debug_callback = None
 
     def __init__(self, class_name):
         self._logger = logging.getLogger(class_name)
 
     def debug(self, message, *args):
-        self._logger.debug(colored(message.format(*args), 'green', attrs=['dark', 'bold']))
+        self._log(logging.DEBUG, message, args)
 
     def info(self, message, *args):
-        self._logger.info(colored(message.format(*args), 'blue', attrs=['dark', 'bold']))
+        self._log(logging.INFO, message, args)
 
     def warn(self, message, *args):
-        self._logger.warn(colored(message.format(*args), 'yellow', attrs=['dark', 'bold']))
+        self._log(logging.WARN, message, args)
 
     def error(self, message, *args):
-        self._logger.error(colored(message.format(*args), 'red', attrs=['dark', 'bold']))
+        self._log(logging.ERROR, message, args)
 
     def slack_debug(self, message, *args):
-        self._logger.warn(colored(message.format(*args), 'magenta', attrs=['dark', 'bold']))
+        lazy_message = _LazyMessage(message, args)
+        self._log(logging.WARN, lazy_message, color='magenta')
         if Logger._slack_debug_callback:
-            Logger._slack_debug_callback(message.format(*args))
+            # Messages with the same template are considered duplicates, the message is formatted only if posted
+            Logger._slack_debug_callback(message, lazy_message)
+
+    def _log(self, level, message, args=(), color=None):
+        if self._logger.isEnabledFor(level):
+            if not isinstance(message, _LazyMessage):
+                message = _LazyMessage(message, args)
+            self._logger.log(level, message, extra={'color': color})
 
     @classmethod
     def set_slack_debug_callback(cls, callback):
+        """
+            :param callback: callable receiving the template of each `slack_debug` message and the message itself,
+                             which is formatted when converted to a string.
+        """
         cls._slack_debug_callback = callback
@@ -0,0 +1,93 @@
+
+import threading
+import time
+from collections import OrderedDict
+
+from .logger import Logger
+
+
+class MessageDigest:
+    """
+        Merges the messages generated for the same object and channel within a time window, so a burst of activity
+        (e.g. a diff updated along with several inline comments) is posted to Slack as a single message with an
+        attachment per original message, in the order they were generated.
+
+        Usage:
+            #>>> digest = MessageDigest(slack_client.send_messages, window=10)
+            #>>> digest.add(('PHID-DREV-1234', '#general'), {'text': "User pparker updated diff D1"})
+            #>>> digest.add(('PHID-DREV-1234', '#general'), {'text': "User pparker commented on diff D1"})
+            # ...10 seconds later both messages are posted together.
+    """
+
+    _logger = Logger('MessageDigest')
+
+    def __init__(self, send, window=0, max_messages=20, clock=time.monotonic):
+        """
+            :param send: callable receiving a list of messages to post together.
+            :param window: seconds to wait for more messages for the same object and channel. 0 disables merging.
+            :param max_messages: messages merged at most in a single post, it is posted right away when reached.
+        """
+        self._send = send
+        self._window = window
+        self._max_messages = max_messages
+        self._clock = clock
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+
+        if window > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name='MessageDigest', daemon=True)
+            self._flusher.start()
+
+    def add(self, key, message):
+        """
+            Adds a message to the digest of `key`, which identifies the object and channel it belongs to.
+        """
+        if self._window <= 0:
+            self._send([message])
+            return
+
+        with self._condition:
+            digest = self._pending.get(key)
+            if digest is None:
+                digest = self._pending[key] = {'deadline': self._clock() + self._window, 'messages': []}
+                self._condition.notify()
+            digest['messages'].append(message)
+
+            if len(digest['messages']) < self._max_messages:
+                return
+            del self._pending[key]
+
+        self._send_digest(digest)
+
+    def flush(self):
+        """
+            Posts all the pending digests right away.
+        """
+        with self._condition:
+            digests = list(self._pending.values())
+            self._pending.clear()
+
+        for digest in digests:
+            self._send_digest(digest)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                # Digests are kept in the order they were opened, and all of them last the same window
+                key, digest = next(iter(self._pending.items()))
+                timeout = digest['deadline'] - self._clock()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                del self._pending[key]
+
+            self._send_digest(digest)
+
+    def _send_digest(self, digest):
+        try:
+            self._send(digest['messages'])
+        except Exception as e:
+            self._logger.error("Couldn't send digest of {} messages: {}", len(digest['messages']), e)
@@ -0,0 +1,177 @@
+"""
+    Minimal metrics in the Prometheus text exposition format, served by the `/metrics` endpoint.
+
+    Modules declare their metrics once, at import time, and update them while running:
+
+        #>>> _requests = metrics.counter('notiphier_requests_total', "Requests received.", labels=('endpoint',))
+        #>>> _requests.inc(endpoint='/firehose')
+        #>>> _latency = metrics.histogram('notiphier_request_seconds', "Time handling requests.")
+        #>>> with _latency.time():
+        #>>>     handle(request)
+
+    Metrics are kept per process, so each worker of `python -m slack_notiphier serve` reports its own.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self._label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, labels):
+        if set(labels) != set(self._label_names):
+            raise ValueError("Metric {} expects labels {}, got {}".format(self.name, self._label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self._label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self._label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._get_key(labels), 0)
+
+    def _render_value(self, key, value):
+        return ["{}{} {}".format(self.name, self._format_labels(key), _format_number(value))]
+
+
+class Histogram(_Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per bucket counts (not cumulative), plus one for values above the last bucket, the sum and the count
+                entry = self._values[key] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            entry[0][self._get_bucket(value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+            Observes the seconds spent running the body of the `with` block, even if it raises.
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def get_count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._get_key(labels))
+            return entry[2] if entry else 0
+
+    def _get_bucket(self, value):
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                return i
+        return len(self._buckets)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            lines.append("{}_bucket{} {}".format(self.name,
+                                                 self._format_labels(key, [('le', _format_number(bound))]),
+                                                 cumulative))
+        lines.append("{}_sum{} {}".format(self.name, self._format_labels(key), _format_number(total)))
+        lines.append("{}_count{} {}".format(self.name, self._format_labels(key), count))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric already registered: " + metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=default_buckets):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+def render():
+    """
+        Returns all the registered metrics in the Prometheus text format.
+    """
+    return registry.render()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value):
+    return '+Inf' if value == float('inf') else repr(value)
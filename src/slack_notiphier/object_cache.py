@@ -0,0 +1,259 @@
+
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .invalidation_log import InvalidationLog
+
+
+class ObjectCache:
+    """
+        Bounded LRU cache of Phabricator object records, with a different time to live per object type.
+        Object types are the ones in the PHIDs: "PHID-TASK-..." is a TASK, "PHID-REPO-..." is a REPO, etc.
+
+        Usage:
+            #>>> cache = ObjectCache(max_size=2, ttls={'TASK': 60})
+            #>>> cache.put('PHID-TASK-1234', {'id': 1, 'name': 'My task', 'owner': None})
+            #>>> cache.get('PHID-TASK-1234')
+            {'id': 1, 'name': 'My task', 'owner': None}
+            #>>> cache.invalidate('PHID-TASK-1234')
+            #>>> cache.get('PHID-TASK-1234')
+            None
+    """
+
+    default_ttls = {
+        'TASK': 3600,
+        'DREV': 3600,
+        'CMIT': 86400,
+        'PROJ': 86400,
+        'REPO': 86400,
+    }
+
+    def __init__(self, max_size=1000, ttls=None, clock=time.monotonic):
+        """
+            :param max_size: maximum number of records kept, the least recently used one is evicted past this size.
+            :param ttls: {object_type: seconds} overriding the default time to live of each object type.
+            :param clock: function returning the current time in seconds.
+        """
+        self._max_size = max_size
+        self._ttls = dict(self.default_ttls, **(ttls or {}))
+        self._clock = clock
+        self._records = OrderedDict()
+        # {phid: expires_at} of the objects invalidated, which copies cached before then can't be used in any process
+        self._tombstones = OrderedDict()
+        self._invalidation_log = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, phid):
+        """
+            Returns the cached record for a PHID, or None if it isn't cached, it has expired or it was invalidated.
+        """
+        self._apply_shared_invalidations()
+
+        with self._lock:
+            entry = self._records.get(phid)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+
+            expires_at, record = entry
+            if expires_at <= self._clock():
+                del self._records[phid]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+
+            self._records.move_to_end(phid)
+            self._counters['hits'] += 1
+            return record
+
+    def put(self, phid, record):
+        if self._max_size <= 0:
+            return
+
+        ttl = self._ttls.get(self._get_type(phid), 0)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._records[phid] = (self._clock() + ttl, record)
+            self._records.move_to_end(phid)
+            while len(self._records) > self._max_size:
+                self._records.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, phid):
+        with self._lock:
+            if self._records.pop(phid, None) is not None:
+                self._counters['invalidations'] += 1
+            self._add_tombstone(phid, self._clock())
+
+        if self._invalidation_log:
+            self._invalidation_log.append(phid)
+
+    def share_invalidations(self, path):
+        """
+            Shares the invalidations with the other processes using the same file, see InvalidationLog. Records are
+            also discarded when another process invalidates them, if they were cached before then.
+        """
+        if self._max_size > 0:
+            self._invalidation_log = InvalidationLog(path, window=max(self._ttls.values()))
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._tombstones.clear()
+
+    def save(self, path):
+        """
+            Saves the cached records to a JSON lines file, with the seconds each of them has left to live.
+
+            Several processes can share the file: it is updated holding an exclusive lock, and the records already in
+            it that are still alive are kept, unless this cache has a newer copy. The objects invalidated are saved
+            too, as tombstones: records cached before an object was invalidated, by this process or by any other one
+            sharing the file, are neither saved nor kept. The file is replaced atomically, so a crash while saving
+            never leaves a truncated snapshot.
+
+            Lines look like:
+                {"saved_at": 1546300800.0}
+                ["PHID-TASK-1", 3540.0, {"id": 1, "name": "My task", "owner": null}]
+                ["PHID-TASK-2", 1800.0, null]
+        """
+        if self._max_size <= 0:
+            return
+
+        with self._lock:
+            now = self._clock()
+            entries = OrderedDict((phid, (expires_at - now, record)) for phid, (expires_at, record)
+                                  in self._records.items() if expires_at > now)
+            # A tombstone lives as long as the copies cached before it would, comparing their times left tells
+            # which copies are older
+            tombstones = {phid: expires_at - now for phid, expires_at in self._tombstones.items() if expires_at > now}
+
+        with open("{}.lock".format(path), 'a') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                try:
+                    saved = self._read(path)
+                except FileNotFoundError:
+                    saved = []
+                except (OSError, ValueError, KeyError):
+                    # Overwritten with the records of this cache
+                    saved = []
+
+                for phid, ttl, record in saved:
+                    if record is None and ttl > tombstones.get(phid, 0):
+                        tombstones[phid] = ttl
+
+                # Copies invalidated by other processes are also dropped from this cache
+                stale = [phid for phid, (ttl, record) in entries.items() if ttl <= tombstones.get(phid, 0)]
+                for phid in stale:
+                    del entries[phid]
+                self._drop_stale(stale, tombstones, now)
+
+                for phid, ttl, record in saved:
+                    if len(entries) >= self._max_size:
+                        break
+                    if record is not None and phid not in entries and ttl > tombstones.get(phid, 0):
+                        entries[phid] = (ttl, record)
+
+                tmp_path = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp_path, 'w') as fp:
+                    fp.write(json.dumps({'saved_at': time.time()}) + "\n")
+                    for phid, (ttl, record) in entries.items():
+                        fp.write(json.dumps((phid, ttl, record)) + "\n")
+                    for phid, ttl in sorted(tombstones.items(), key=lambda item: -item[1])[:self._max_size]:
+                        fp.write(json.dumps((phid, ttl, None)) + "\n")
+                os.replace(tmp_path, path)
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+    def load(self, path):
+        """
+            Adds the records saved with `save` to the cache, discounting the time passed since they were saved.
+
+            :return The number of records loaded.
+        """
+        entries = self._read(path)
+
+        loaded = 0
+        with self._lock:
+            now = self._clock()
+            for phid, ttl, record in entries:
+                if record is not None and len(self._records) < self._max_size:
+                    self._records[phid] = (now + ttl, record)
+                    loaded += 1
+        return loaded
+
+    @staticmethod
+    def _read(path):
+        """
+            Returns the records and tombstones saved in a file that are still alive, as (phid, seconds left to live,
+            record), where the record of tombstones is None.
+        """
+        with open(path, 'r') as fp:
+            header = json.loads(fp.readline())
+            elapsed = max(0, time.time() - header['saved_at'])
+            entries = [json.loads(line) for line in fp]
+        return [(phid, ttl - elapsed, record) for phid, ttl, record in entries if ttl > elapsed]
+
+    def _add_tombstone(self, phid, invalidated_at):
+        ttl = self._ttls.get(self._get_type(phid), 0)
+        if self._max_size <= 0 or ttl <= 0:
+            return
+
+        self._tombstones[phid] = max(invalidated_at + ttl, self._tombstones.get(phid, 0))
+        self._tombstones.move_to_end(phid)
+        while len(self._tombstones) > self._max_size:
+            self._tombstones.popitem(last=False)
+
+    def _apply_shared_invalidations(self):
+        if not self._invalidation_log:
+            return
+
+        invalidations = self._invalidation_log.read_new()
+        if not invalidations:
+            return
+
+        with self._lock:
+            now = self._clock()
+            for phid, age in invalidations:
+                self._add_tombstone(phid, now - age)
+                entry = self._records.get(phid)
+                if entry is not None and entry[0] <= self._tombstones.get(phid, 0):
+                    del self._records[phid]
+                    self._counters['invalidations'] += 1
+
+    def _drop_stale(self, phids, tombstones, now):
+        """
+            Removes the records of the given PHIDs cached before their tombstones, given in seconds left to live.
+        """
+        with self._lock:
+            for phid in phids:
+                entry = self._records.get(phid)
+                if entry is not None and entry[0] - now <= tombstones[phid]:
+                    del self._records[phid]
+                    self._counters['invalidations'] += 1
+
+    def stats(self):
+        """
+            Returns the hit/miss/eviction counters and the current size of the cache.
+        """
+        with self._lock:
+            return dict(self._counters, size=len(self._records), max_size=self._max_size)
+
+    @staticmethod
+    def _get_type(phid):
+        # PHIDs look like: PHID-TASK-abcdefghijklmnopqrst
+        parts = phid.split('-')
+        return parts[1] if len(parts) > 2 else None
@@ -0,0 +1,172 @@
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from .logger import Logger
+
+
+class Outbox:
+    """
+        Durable, append-only log of the messages on their way to Slack.
+
+        Every message is written to the log before trying to send it, and an acknowledgement is written once Slack
+        confirms it. Messages without acknowledgement, e.g. because the process died or Slack was down, are returned
+        by `pending` when the outbox is opened again, so they can be sent then.
+
+        Writes reach the OS right away, so they survive the process crashing. To keep throughput, they are fsync-ed
+        to disk in batches, every `sync_interval` seconds, which bounds what a power loss could lose.
+
+        Only one process can have an outbox open at a time, opening an outbox that is open in another process raises
+        BlockingIOError.
+
+        Log lines look like:
+            {"id": 1, "channel": "#general", "attachments": [...]}
+            {"ack": 1}
+    """
+
+    _logger = Logger('Outbox')
+
+    def __init__(self, path, sync_interval=0.05, compact_threshold=10000):
+        """
+            :param path: file where the log is kept, created if it doesn't exist.
+            :param sync_interval: seconds between batched fsyncs. 0 fsyncs after every write.
+            :param compact_threshold: acknowledged messages after which the log is rewritten without them.
+        """
+        self._path = path
+        self._lock_fp = self._lock_file(path)
+        self._sync_interval = sync_interval
+        self._compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._acked = 0
+
+        self._pending = self._read()
+        self._next_id = max(self._pending.keys(), default=0) + 1
+        self._fp = self._rewrite()
+
+        if self._pending:
+            self._logger.info("Outbox has {} messages that were never confirmed by Slack", len(self._pending))
+
+        if sync_interval > 0:
+            self._syncer = threading.Thread(target=self._sync_loop, name='OutboxSync', daemon=True)
+            self._syncer.start()
+
+    def append(self, channel, attachments):
+        """
+            Logs a message before sending it.
+
+            :return The id to use to acknowledge the message.
+        """
+        with self._lock:
+            message_id = self._next_id
+            self._next_id += 1
+            entry = {'id': message_id, 'channel': channel, 'attachments': attachments}
+            self._pending[message_id] = entry
+            self._write(entry)
+        return message_id
+
+    def ack(self, message_id):
+        """
+            Logs that a message doesn't need to be sent anymore.
+        """
+        with self._lock:
+            if self._pending.pop(message_id, None) is None:
+                return
+            self._write({'ack': message_id})
+
+            self._acked += 1
+            if self._acked >= self._compact_threshold:
+                self._fp.close()
+                self._fp = self._rewrite()
+
+    def pending(self):
+        """
+            Returns the messages logged and not acknowledged yet, in the order they were logged.
+        """
+        with self._lock:
+            return [dict(entry) for _, entry in sorted(self._pending.items())]
+
+    def sync(self):
+        """
+            Forces the log to disk.
+        """
+        with self._lock:
+            self._dirty.clear()
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        with self._lock:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._fp.close()
+            self._lock_fp.close()
+
+    def _write(self, entry):
+        self._fp.write(json.dumps(entry) + "\n")
+        self._fp.flush()
+        if self._sync_interval > 0:
+            self._dirty.set()
+        else:
+            os.fsync(self._fp.fileno())
+
+    @staticmethod
+    def _lock_file(path):
+        lock_fp = open("{}.lock".format(path), 'a')
+        try:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_fp.close()
+            raise
+        return lock_fp
+
+    def _read(self):
+        pending = {}
+        try:
+            with open(self._path, 'r') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Most likely the last line, truncated by a crash while writing it
+                        self._logger.warn("Ignoring corrupt line in outbox '{}': {}", self._path, line)
+                        continue
+
+                    if 'ack' in entry:
+                        pending.pop(entry['ack'], None)
+                    else:
+                        pending[entry['id']] = entry
+        except FileNotFoundError:
+            pass
+
+        return pending
+
+    def _rewrite(self):
+        """
+            Replaces the log with one containing only the pending messages, and returns it open for appending.
+        """
+        tmp_path = "{}.tmp".format(self._path)
+        with open(tmp_path, 'w') as fp:
+            for _, entry in sorted(self._pending.items()):
+                fp.write(json.dumps(entry) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self._path)
+
+        self._acked = 0
+        return open(self._path, 'a')
+
+    def _sync_loop(self):
+        while True:
+            self._dirty.wait()
+            # Let more writes pile up, so they are all synced at once
+            time.sleep(self._sync_interval)
+            self._dirty.clear()
+            try:
+                with self._lock:
+                    os.fsync(self._fp.fileno())
+            except (OSError, ValueError) as e:
+                self._logger.error("Couldn't sync outbox '{}' to disk: {}", self._path, e)
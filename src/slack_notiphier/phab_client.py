@@ -1,11 +1,27 @@
 
 import json
+import threading
+from contextlib import contextmanager
 from urllib.parse import urljoin
 
 import phabricator
 
+from . import metrics
 from .logger import Logger
 from .config import get_config
+from .object_cache import ObjectCache
+
+
+_conduit_seconds = metrics.histogram('notiphier_conduit_request_seconds',
+                                     "Latency of the calls to Conduit, by method.",
+                                     labels=('method',))
+_conduit_errors = metrics.counter('notiphier_conduit_errors_total',
+                                  "Calls to Conduit that failed, by method.",
+                                  labels=('method',))
+_object_lookups = metrics.counter('notiphier_object_lookups_total',
+                                  "Lookups of Phabricator objects, by where they were found: the current request, the "
+                                  "object cache or Conduit.",
+                                  labels=('source',))
 
 
 class PhabClient(object):
@@ -15,12 +31,20 @@ class PhabClient(object):
 
     _logger = Logger('PhabClient')
 
+    # Transactions that change the fields kept in the object records, so cached copies must be discarded
+    _invalidating_transactions = {'title', 'name', 'owner', 'commandeer', 'repository', 'projects'}
+    # Conduit's *.search methods fail when asked for more results per page
+    _max_page_size = 100
+
     def __init__(self):
         """
             Attempts to connect to Phabricator using the url and token supplied in Notiphier's config file.
         """
         self._url = get_config('phabricator_url')
         self._client = self._connect_phabricator(token=get_config('phabricator_token'))
+        self._request_cache = threading.local()
+        self._object_cache = ObjectCache(max_size=get_config('object_cache_size', 1000),
+                                         ttls=get_config('object_cache_ttl', {}))
 
         self._transaction_handlers = {
             'TASK': self._handle_task,
@@ -30,6 +54,14 @@ class PhabClient(object):
             'REPO': self._handle_repo,
         }
 
+        self._object_fetchers = {
+            'TASK': self._fetch_tasks,
+            'DREV': self._fetch_diffs,
+            'CMIT': self._fetch_commits,
+            'PROJ': self._fetch_projs,
+            'REPO': self._fetch_repos,
+        }
+
     def _connect_phabricator(self, token):
         url = urljoin(self._url, "api/")
 
@@ -53,24 +85,74 @@ class PhabClient(object):
             Returns the list of human users from Phabricators.
             :return: {phid: (phab_username, phab_full_name)}
         """
+        users = {}
+        for page in self.iter_users():
+            users.update(page)
+        return users
+
+    def iter_users(self, page_size=None, created_after=None):
+        """
+            Generator with the human users from Phabricator, following Conduit's cursors to get all of them.
+            Yields one page at a time in the form: {phid: (phab_username, phab_full_name)}
+
+            :param page_size: users per page, at most 100.
+            :param created_after: if given, only users created after this UNIX timestamp are returned.
+        """
         self._logger.info("Getting list of users from Phabricator...")
 
-        users = self._client.user.search()
-        return {user['phid']: (user['fields']['username'], user['fields']['realName'])
-                for user in users['data']
-                if 'disabled' not in user['fields']['roles'] and
-                   'bot' not in user['fields']['roles'] and
-                   user['type'] == 'USER'}
+        kwargs = {}
+        if page_size:
+            kwargs['limit'] = min(page_size, self._max_page_size)
+        if created_after:
+            kwargs['constraints'] = {'createdStart': created_after}
+
+        while True:
+            users = self._call_conduit('user.search', **kwargs)
+            yield {user['phid']: (user['fields']['username'], user['fields']['realName'])
+                   for user in users['data']
+                   if 'disabled' not in user['fields']['roles'] and
+                      'bot' not in user['fields']['roles'] and
+                      user['type'] == 'USER'}
+
+            after = (users.get('cursor') or {}).get('after')
+            if not after:
+                return
+            kwargs['after'] = after
+
+    def get_user(self, phid):
+        """
+            Returns a single user from Phabricator given its PHID, even if it is a bot or it is disabled.
+            :return: (phab_username, phab_full_name), or None if there is no such user.
+        """
+        users = self._call_conduit('user.search', constraints={'phids': [phid]})
+        return next(((user['fields']['username'], user['fields']['realName'])
+                     for user in users['data'] if user['phid'] == phid), None)
+
+    def get_name(self, phid):
+        """
+            Returns the name Phabricator shows for any kind of object given its PHID, e.g. "Herald" for
+            PHID-APPS-PhabricatorHeraldApplication.
+            :return: The name, or None if Phabricator doesn't know the PHID.
+        """
+        try:
+            result = self._call_conduit('phid.query', phids=[phid])
+        except phabricator.APIError as e:
+            self._logger.warn("Couldn't get the name of {}: {}", phid, e)
+            return None
+        return (result.get(phid) or {}).get('name')
 
-    def get_transactions(self, object_type, object_phid, tx_phids):
+    def get_transactions(self, object_type, object_phid, tx_phids, keep=None):
         """
             Receives a list of Phabricator transactions and returns objects with only the relevant information, if any.
+            Transactions about diffs and commits include the name of their repository in `repo`.
+
+            :param keep: if given, callable telling whether a transaction is interesting, before looking up anything
+                         else about it in Conduit.
         """
         constraints = {'phids': tx_phids}
 
         try:
-            txs = self._client.transaction.search(objectIdentifier=object_phid,
-                                                  constraints=constraints)
+            txs = self._call_conduit('transaction.search', objectIdentifier=object_phid, constraints=constraints)
         except phabricator.APIError as e:
             # Swallow APIErrors related to unimplemented methods
             if "not implemented" in e.message:
@@ -78,51 +160,69 @@ class PhabClient(object):
                 return []
             raise
 
+        for t in txs["data"]:
+            if t['type'] in self._invalidating_transactions:
+                self.invalidate(t['objectPHID'])
+
         results = []
         for t in txs["data"]:
-            self._logger.debug("Transaction:\n{}", json.dumps(t, indent=4))
+            self._logger.debug("Transaction:\n{}", lambda: json.dumps(t, indent=4))
 
             # These types are as sent by Phabricator's Firehose Webhook
             if object_type in self._transaction_handlers:
-                results.extend(self._transaction_handlers[object_type](t))
+                results.extend((t['objectPHID'], r) for r in self._transaction_handlers[object_type](t)
+                               if keep is None or keep(r))
             else:
                 self._logger.slack_debug("No message will be generated for object of type {}.\n{}",
-                    object_type, json.dumps(t, indent=4))
+                    object_type, lambda: json.dumps(t, indent=4))
+
+        # Objects are only looked up for the transactions that are left
+        self.prefetch({phid for phid, _ in results})
+        if object_type in ('DREV', 'CMIT'):
+            for phid, r in results:
+                r['repo'] = self.get_repo(self._get_repo_for(phid))['name']
 
-        return results
+        return [r for _, r in results]
+
+    @contextmanager
+    def request_scope(self, objects=None):
+        """
+            Objects looked up inside this context are fetched from Conduit only once, no matter how many times their
+            link, owner or repository is requested. The scope is per thread, so concurrent requests don't share it.
+
+            :param objects: dictionary holding the objects of the scope. Threads working on the same request can
+                            share a scope by passing the same dictionary.
+        """
+        previous = getattr(self._request_cache, 'objects', None)
+        self._request_cache.objects = {} if objects is None else objects
+        try:
+            yield
+        finally:
+            self._request_cache.objects = previous
 
     def get_link(self, phid):
         """
             Returns a link to a task, differential revision, project or repo given its PHID.
             The link is returned in a format suitable for Slack.
         """
+        obj = self._get_object(phid)
+        if not obj:
+            return None
+
         if phid.startswith("PHID-TASK-"):
-            task = self._client.maniphest.search(constraints={'phids': [phid]})
-            task_id = task['data'][0]['id']
-            task_name = task['data'][0]['fields']['name']
-            return "<{}/T{}|T{}>: {}".format(self._url, task_id, task_id, task_name)
+            return "<{}/T{}|T{}>: {}".format(self._url, obj['id'], obj['id'], obj['name'])
 
         if phid.startswith("PHID-DREV-"):
-            diff = self._client.differential.revision.search(constraints={'phids': [phid]})
-            diff_id = diff['data'][0]['id']
-            diff_name = diff['data'][0]['fields']['title']
-            return "<{}/D{}|D{}>: {}".format(self._url, diff_id, diff_id, diff_name)
+            return "<{}/D{}|D{}>: {}".format(self._url, obj['id'], obj['id'], obj['name'])
 
         if phid.startswith("PHID-PROJ-"):
-            proj = self._client.project.search(constraints={'phids': [phid]})
-            proj_id = proj['data'][0]['id']
-            proj_name = proj['data'][0]['fields']['name']
-            return "<{}/project/view/{}|{}>".format(self._url, proj_id, proj_name)
+            return "<{}/project/view/{}|{}>".format(self._url, obj['id'], obj['name'])
 
         if phid.startswith("PHID-REPO-"):
-            repo = self.get_repo(phid)
-            return "<{}/source/{}|{}>".format(self._url, repo['id'], repo['name'])
+            return "<{}/source/{}|{}>".format(self._url, obj['id'], obj['name'])
 
         if phid.startswith("PHID-CMIT-"):
-            commit = self._client.diffusion.querycommits(phids=[phid])
-            commit_name = commit['data'][phid]['summary']
-            commit_uri = commit['data'][phid]['uri']
-            return "<{}|{}>".format(commit_uri, commit_name)
+            return "<{}|{}>".format(obj['uri'], obj['name'])
 
         return None
 
@@ -131,36 +231,209 @@ class PhabClient(object):
             If given a task's PHID, returns the PHID of its owner. If given a differential revision's PHID,
             it returns its author's PHID.
         """
-        if phid.startswith("PHID-TASK-"):
-            task = self._client.maniphest.search(constraints={'phids': [phid]})
-            return task['data'][0]['fields']['ownerPHID']
+        if not phid.startswith("PHID-TASK-") and not phid.startswith("PHID-DREV-"):
+            return None
 
-        if phid.startswith("PHID-DREV-"):
-            task = self._client.differential.revision.search(constraints={'phids': [phid]})
-            return task['data'][0]['fields']['authorPHID']
+        return self._get_object(phid)['owner']
 
-        return None
+    def get_project_names(self, phid):
+        """
+            Returns the names of the projects a task is tagged with.
+        """
+        project_phids = self._get_object(phid).get('projects', [])
+        self.prefetch(project_phids)
+        return [project['name'] for project in (self._get_object(p) for p in project_phids) if project]
 
     def get_repo(self, phid):
-        repo = self._client.diffusion.repository.search(constraints={'phids': [phid]})
+        repo = self._get_object(phid)
         return {
-            "id": repo['data'][0]['id'],
-            "name": repo['data'][0]['fields']['name'],
+            "id": repo['id'],
+            "name": repo['name'],
         }
 
     def _get_repo_for(self, phid):
         """
             Returns the repository to which the given diff/commit PHID belongs.
         """
-        if phid.startswith("PHID-DREV-"):
-            task = self._client.differential.revision.search(constraints={'phids': [phid]})
-            return task['data'][0]['fields']['repositoryPHID']
+        if not phid.startswith("PHID-DREV-") and not phid.startswith("PHID-CMIT-"):
+            return None
 
-        if phid.startswith("PHID-CMIT-"):
-            task = self._client.diffusion.querycommits(phids=[phid])
-            return task['data'][phid]['repositoryPHID']
+        return self._get_object(phid)['repository']
 
-        return None
+    def load_cache_snapshot(self, path):
+        """
+            Fills the object cache with the records saved in a snapshot file, if it exists.
+        """
+        try:
+            loaded = self._object_cache.load(path)
+            self._logger.info("Loaded {} objects from cache snapshot", loaded)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            self._logger.warn("Ignoring unreadable object cache snapshot '{}': {}", path, e)
+
+    def share_cache_invalidations(self, path):
+        """
+            Shares the objects discarded from the object cache with the other processes using the same file.
+        """
+        self._object_cache.share_invalidations(path)
+
+    def save_cache_snapshot(self, path):
+        try:
+            self._object_cache.save(path)
+        except OSError as e:
+            self._logger.error("Couldn't save the object cache snapshot to '{}': {}", path, e)
+
+    def cache_stats(self):
+        """
+            Returns the counters of the long-lived object cache.
+        """
+        return self._object_cache.stats()
+
+    def _get_object(self, phid):
+        """
+            Returns the record of a Phabricator object, reusing the one already fetched in the current request scope
+            or, failing that, a fresh enough one from the long-lived object cache.
+        """
+        objects = getattr(self._request_cache, 'objects', None)
+        if objects is not None and phid in objects:
+            _object_lookups.inc(source='request')
+            return objects[phid]
+
+        obj = self._object_cache.get(phid)
+        if obj is None:
+            _object_lookups.inc(source='conduit')
+            obj = self._fetch_objects([phid]).get(phid)
+            if obj is not None:
+                self._object_cache.put(phid, obj)
+        else:
+            _object_lookups.inc(source='cache')
+
+        if objects is not None:
+            objects[phid] = obj
+        return obj
+
+    def prefetch(self, phids):
+        """
+            Resolves all the given PHIDs, and the repositories they belong to, with one Conduit call per object type.
+            The objects are kept in the current request scope, so later calls to get_link, get_owner or get_repo for
+            them don't need to go to Conduit.
+        """
+        objects = getattr(self._request_cache, 'objects', None)
+        if objects is None:
+            return
+
+        pending = set(phids)
+        while pending:
+            missing = []
+            for phid in pending:
+                if phid in objects:
+                    continue
+                obj = self._object_cache.get(phid)
+                if obj is None:
+                    missing.append(phid)
+                else:
+                    _object_lookups.inc(source='cache')
+                    objects[phid] = obj
+            _object_lookups.inc(len(missing), source='conduit')
+
+            fetched = self._fetch_objects(sorted(missing))
+            for phid in missing:
+                obj = fetched.get(phid)
+                if obj is not None:
+                    self._object_cache.put(phid, obj)
+                objects[phid] = obj
+
+            # Second round for the repositories referenced by diffs and commits
+            pending = {objects[phid]['repository'] for phid in pending
+                       if objects.get(phid) and objects[phid].get('repository')} - objects.keys()
+
+    def invalidate(self, phid):
+        """
+            Discards the cached record of an object, e.g. because it may have changed.
+        """
+        self._object_cache.invalidate(phid)
+
+        objects = getattr(self._request_cache, 'objects', None)
+        if objects is not None:
+            objects.pop(phid, None)
+
+    def _call_conduit(self, method, **kwargs):
+        """
+            Calls a Conduit method, given its name like 'transaction.search', and records how long it took.
+        """
+        endpoint = self._client
+        for name in method.split('.'):
+            endpoint = getattr(endpoint, name)
+
+        with _conduit_seconds.time(method=method):
+            try:
+                return endpoint(**kwargs)
+            except Exception:
+                _conduit_errors.inc(method=method)
+                raise
+
+    def _fetch_objects(self, phids):
+        """
+            Fetches objects from Conduit, with a single call per object type, and returns records with the fields
+            Notiphier uses from them: {phid: {id, name, owner, repository, projects, uri}}
+            Fields that don't apply to the type of an object are not present.
+        """
+        phids_by_type = {}
+        for phid in phids:
+            phids_by_type.setdefault(self._get_phid_type(phid), []).append(phid)
+
+        objects = {}
+        for object_type, type_phids in phids_by_type.items():
+            if object_type in self._object_fetchers:
+                objects.update(self._object_fetchers[object_type](type_phids))
+        return objects
+
+    def _fetch_tasks(self, phids):
+        tasks = self._call_conduit('maniphest.search', constraints={'phids': phids}, attachments={'projects': True})
+        return {task['phid']: {
+                    'id': task['id'],
+                    'name': task['fields']['name'],
+                    'owner': task['fields']['ownerPHID'],
+                    'projects': task.get('attachments', {}).get('projects', {}).get('projectPHIDs', []),
+                } for task in tasks['data']}
+
+    def _fetch_diffs(self, phids):
+        diffs = self._call_conduit('differential.revision.search', constraints={'phids': phids})
+        return {diff['phid']: {
+                    'id': diff['id'],
+                    'name': diff['fields']['title'],
+                    'owner': diff['fields']['authorPHID'],
+                    'repository': diff['fields']['repositoryPHID'],
+                } for diff in diffs['data']}
+
+    def _fetch_projs(self, phids):
+        projs = self._call_conduit('project.search', constraints={'phids': phids})
+        return {proj['phid']: {
+                    'id': proj['id'],
+                    'name': proj['fields']['name'],
+                } for proj in projs['data']}
+
+    def _fetch_repos(self, phids):
+        repos = self._call_conduit('diffusion.repository.search', constraints={'phids': phids})
+        return {repo['phid']: {
+                    'id': repo['id'],
+                    'name': repo['fields']['name'],
+                } for repo in repos['data']}
+
+    def _fetch_commits(self, phids):
+        commits = self._call_conduit('diffusion.querycommits', phids=phids)
+        return {phid: {
+                    'name': commit['summary'],
+                    'uri': commit['uri'],
+                    'repository': commit['repositoryPHID'],
+                } for phid, commit in commits['data'].items()}
+
+    @staticmethod
+    def _get_phid_type(phid):
+        # PHIDs look like: PHID-TASK-abcdefghijklmnopqrst
+        parts = phid.split('-')
+        return parts[1] if len(parts) > 2 else None
 
     def _handle_task(self, task):
         """
@@ -222,15 +495,11 @@ class PhabClient(object):
             Receives an object representing a transaction for a differential revision (in Phabricator's own format).
             Returns a generator with the relevant parts of the transactions.
         """
-        repo_phid = self._get_repo_for(diff['objectPHID'])
-        repo_name = self.get_repo(repo_phid)['name']
-
         if diff['type'] == 'create':
             yield {
                 'type': 'diff-create',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         elif diff['type'] in ['comment', 'inline']:
             for comment in diff['comments']:
@@ -242,49 +511,42 @@ class PhabClient(object):
                     'author': diff['authorPHID'],
                     'diff': diff['objectPHID'],
                     'comment': comment['content']['raw'],
-                    'repo': repo_name,
                 }
         elif diff['type'] == 'update':
             yield {
                 'type': 'diff-update',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         elif diff['type'] == 'abandon':
             yield {
                 'type': 'diff-abandon',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         elif diff['type'] == 'reclaim':
             yield {
                 'type': 'diff-reclaim',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         elif diff['type'] == 'accept':
             yield {
                 'type': 'diff-accept',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         elif diff['type'] == 'request-changes':
             yield {
                 'type': 'diff-request-changes',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         elif diff['type'] == 'commandeer':
             yield {
                 'type': 'diff-commandeer',
                 'author': diff['authorPHID'],
                 'diff': diff['objectPHID'],
-                'repo': repo_name,
             }
         else:
             self._logger.debug("No message will be generated")
@@ -294,9 +556,6 @@ class PhabClient(object):
             Receives an object representing a transaction for a commit (in Phabricator's own format).
             Returns a generator with the relevant parts of the transactions.
         """
-        repo_phid = self._get_repo_for(commit['objectPHID'])
-        repo_name = self.get_repo(repo_phid)['name']
-
         if commit['type'] == 'comment':
             for comment in commit['comments']:
                 if comment['removed']:
@@ -306,7 +565,6 @@ class PhabClient(object):
                     'type': 'commit-add-comment',
                     'author': commit['authorPHID'],
                     'commit': commit['objectPHID'],
-                    'repo': repo_name,
                     'comment': comment['content']['raw']
                 }
         else:
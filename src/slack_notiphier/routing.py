@@ -0,0 +1,117 @@
+
+import fnmatch
+import re
+
+from .config import get_config
+
+
+class _Rules:
+    """
+        Compiled rules mapping names to the channels messages about them go to. Names are matched exactly first, then
+        against the glob patterns in the order they were configured. The result for every name is memoized.
+    """
+
+    _max_memoized = 10000
+
+    def __init__(self, rules):
+        self._exact = {}
+        globs = []
+        self._glob_channels = {}
+        for name, channels in rules.items():
+            if any(c in name for c in '*?['):
+                group = "rule{}".format(len(globs))
+                globs.append("(?P<{}>{})".format(group, fnmatch.translate(name)))
+                self._glob_channels[group] = _as_channels(name, channels)
+            else:
+                self._exact[name] = _as_channels(name, channels)
+
+        # A single regex with a named group per glob: the first glob matching a name is the group that matched. The
+        # groups are named because fnmatch.translate() can emit groups of its own, e.g. for '*' in Python 3.9 and 3.10.
+        self._globs = re.compile("|".join(globs)) if globs else None
+        self._memoized = {}
+
+    def __bool__(self):
+        return bool(self._exact) or self._globs is not None
+
+    def match(self, name):
+        """
+            Returns the channels for a name, or None if no rule matches it.
+        """
+        try:
+            return self._memoized[name]
+        except KeyError:
+            pass
+
+        channels = self._exact.get(name)
+        if channels is None and self._globs is not None:
+            match = self._globs.match(name)
+            if match:
+                channels = self._glob_channels[match.lastgroup]
+
+        if len(self._memoized) >= self._max_memoized:
+            self._memoized = {}
+        self._memoized[name] = channels
+        return channels
+
+
+class ChannelRouter:
+    """
+        Decides which Slack channels get the messages about an object, given the `channels` (by repository) and
+        `project_channels` (by project) elements of the config file. Rules are compiled once, when the router is
+        built, so routing a message is a dictionary lookup for names already seen.
+
+        Usage:
+            #>>> router = ChannelRouter({'__default__': '#general', 'Mobile*': ['#mobile', '#releases']})
+            #>>> router.for_repo('MobileApp')
+            ('#mobile', '#releases')
+            #>>> router.for_repo('Backend')
+            ('#general',)
+    """
+
+    _special_channels = ('__default__', '__debug__')
+
+    def __init__(self, channels, project_channels=None):
+        """
+            :param channels: {repo name or glob: channel or list of channels}, with the `__default__` channel, which
+                             gets the messages no rule matches.
+            :param project_channels: {project name or glob: channel or list of channels}
+        """
+        if not isinstance(channels['__default__'], str):
+            raise ValueError("The __default__ channel must be a single channel name")
+        self.default = (channels['__default__'],)
+        self._repos = _Rules({name: value for name, value in channels.items() if name not in self._special_channels})
+        self._projects = _Rules(project_channels or {})
+
+    @classmethod
+    def from_config(cls, config=None):
+        return cls(get_config('channels', config=config), get_config('project_channels', {}, config=config))
+
+    @property
+    def has_project_rules(self):
+        return bool(self._projects)
+
+    def for_repo(self, repo_name):
+        """
+            Returns the channels for messages about a diff or commit of a repository.
+        """
+        return self._repos.match(repo_name) or self.default
+
+    def for_projects(self, project_names):
+        """
+            Returns the channels for messages about an object tagged with some projects: all the channels of all the
+            projects, without repetitions.
+        """
+        channels = []
+        for project_name in project_names:
+            for channel in self._projects.match(project_name) or ():
+                if channel not in channels:
+                    channels.append(channel)
+        return tuple(channels) or self.default
+
+
+def _as_channels(name, value):
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, list) and value and all(isinstance(channel, str) for channel in value):
+        return tuple(value)
+    raise ValueError("Channels for '{}' must be a channel name or a list of them, got: {}".format(name, value))
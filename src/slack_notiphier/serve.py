@@ -0,0 +1,34 @@
+"""
+    Production server: runs the WSGI app under gunicorn, with several pre-forked worker processes each running several
+    threads. Every worker builds its own WebhookFirehose after forking, so no threads or connections cross a fork.
+    Workers share the user directory and the object cache through the files in `snapshot_dir`.
+"""
+
+from gunicorn.app.base import BaseApplication
+
+from .wsgi import create_app
+
+
+class _Server(BaseApplication):
+
+    def __init__(self, options):
+        self._options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self._options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Called by each worker after forking, as the app isn't preloaded
+        return create_app()
+
+
+def serve(bind, workers, threads, timeout):
+    _Server({
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'timeout': timeout,
+        'preload_app': False,
+    }).run()
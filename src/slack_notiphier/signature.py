@@ -0,0 +1,108 @@
+
+import hashlib
+import hmac
+import threading
+import time
+
+from . import metrics
+from .config import get_config
+
+
+_verifications = metrics.counter('notiphier_signature_verifications_total',
+                                 "Webhook signatures checked, by result: valid, invalid or missing.",
+                                 labels=('result',))
+_verification_seconds = metrics.histogram('notiphier_signature_verification_seconds',
+                                          "Time spent checking webhook signatures.",
+                                          buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+
+
+class SignatureVerifier:
+    """
+        Checks the signature Phabricator sends along with a webhook request, in the X-Phabricator-Webhook-Signature
+        header: the HMAC-SHA256 of the body, as hexadecimal.
+
+        Several keys can be active at once, e.g. while rotating the key of a webhook or when several webhooks send
+        deliveries to the same Notiphier. A request is valid if it is signed with any of them. The HMAC of every key
+        is set up once, and copied for every request, and the key that matched last is tried first, so checking a
+        request usually costs a single HMAC no matter how many keys there are.
+
+        Usage:
+            #>>> verifier = SignatureVerifier([b'new-key', b'old-key'])
+            #>>> verifier.verify(body, request.headers.get('X-Phabricator-Webhook-Signature'))
+            True
+    """
+
+    def __init__(self, keys):
+        """
+            :param keys: HMAC keys of the webhooks, as bytes.
+        """
+        if not keys:
+            raise ValueError("At least one webhook HMAC key is needed")
+        self._hmacs = [hmac.new(key, digestmod=hashlib.sha256) for key in keys]
+        self._digest_size = self._hmacs[0].digest_size
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config=None):
+        """
+            Builds a verifier with the key, or list of keys, in `phabricator_webhook_hmac`.
+        """
+        keys = get_config('phabricator_webhook_hmac', config=config)
+        if isinstance(keys, str):
+            keys = [keys]
+        if not isinstance(keys, list) or not all(isinstance(key, str) and key for key in keys):
+            raise ValueError("phabricator_webhook_hmac must be a key or a list of keys")
+        return cls([key.encode() for key in keys])
+
+    def prepare_reload(self, config):
+        """
+            Sets up the HMACs of the keys in a new config.
+
+            :return A callable that puts them in use.
+        """
+        reloaded = self.from_config(config)
+
+        def apply():
+            with self._lock:
+                self._hmacs = reloaded._hmacs
+
+        return apply
+
+    def verify(self, body, signature):
+        """
+            :param body: raw body of the request, as bytes.
+            :param signature: signature received, as a string.
+        """
+        if not signature:
+            _verifications.inc(result='missing')
+            return False
+
+        started_at = time.perf_counter()
+        valid = self._verify(body, signature)
+        _verification_seconds.observe(time.perf_counter() - started_at)
+
+        _verifications.inc(result='valid' if valid else 'invalid')
+        return valid
+
+    def _verify(self, body, signature):
+        # Digests are compared as raw bytes, a signature that isn't a digest in hexadecimal can't be valid
+        try:
+            expected = bytes.fromhex(signature)
+        except ValueError:
+            return False
+        if len(expected) != self._digest_size:
+            return False
+
+        hmacs = self._hmacs
+        for i, keyed in enumerate(hmacs):
+            actual = keyed.copy()
+            actual.update(body)
+            if hmac.compare_digest(actual.digest(), expected):
+                if i > 0:
+                    with self._lock:
+                        # Deliveries signed with the same key usually come together. The keys may have been reloaded
+                        # meanwhile, and then the old ones must not come back.
+                        if any(h is keyed for h in self._hmacs):
+                            self._hmacs = [keyed] + [h for h in self._hmacs if h is not keyed]
+                return True
+        return False
@@ -1,8 +1,54 @@
 
+import atexit
+import itertools
+import json
+
+import requests
 import slackclient
+from slackclient.slackrequest import SlackRequest
 
 from .logger import Logger
 from .config import get_config
+from .slack_sender import SlackSender
+from .outbox import Outbox
+from .debug_channel import DebugChannel
+
+
+class _PooledSlackRequest(SlackRequest):
+    """
+        Replacement for slackclient's requester that reuses HTTP connections to Slack, instead of opening a new one
+        for every API call.
+    """
+
+    def __init__(self, pool_size, api_url=None, proxies=None):
+        """
+            :param api_url: base URL of Slack's API, by default https://slack.com/api/
+        """
+        super().__init__(proxies=proxies)
+        self._api_url = api_url
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def do(self, token, request="?", post_data=None, domain="slack.com", timeout=None):
+        post_data = dict(post_data or {})
+        token = post_data.pop('token', token)
+
+        # Lists and dicts, like message attachments, are sent as JSON
+        for key, value in post_data.items():
+            if isinstance(value, (list, dict)):
+                post_data[key] = json.dumps(value)
+
+        api_url = self._api_url or 'https://{}/api/'.format(domain)
+        return self._session.post(api_url + request,
+                                  headers={
+                                      'user-agent': self.get_user_agent(),
+                                      'Authorization': 'Bearer {}'.format(token),
+                                  },
+                                  data=post_data,
+                                  timeout=timeout,
+                                  proxies=self.proxies)
 
 
 class SlackClient:
@@ -12,9 +58,19 @@ class SlackClient:
 
     _logger = Logger('SlackClient')
 
+    # Seconds to wait, when exiting, for the messages queued to be sent in the background
+    _exit_flush_timeout = 10
+
     def __init__(self):
         self._client = self._connect_slack(get_config('slack_token'))
-        self._channels = get_config('channels', {})
+        self._sender = SlackSender(self._client.api_call,
+                                   rate=get_config('slack_rate_per_channel', 1),
+                                   burst=get_config('slack_burst_per_channel', 5),
+                                   max_retries=get_config('slack_max_retries', 5),
+                                   queue_size=get_config('slack_queue_size', 1000),
+                                   background=get_config('slack_async_send', True),
+                                   outbox=self._open_outbox())
+        atexit.register(self._sender.flush, self._exit_flush_timeout)
         self._colors = {
             'none': '#F0F0F0',
             'info': '#28D7E5',
@@ -22,19 +78,63 @@ class SlackClient:
             'error': 'danger',
             'success': 'good',
         }
-        if '__debug__' in self._channels:
-            Logger.set_slack_debug_callback(self.slack_debug_callback)
+        self._debug_channel = None
+        self.prepare_reload()()
+
+    def prepare_reload(self, config=None):
+        """
+            Reads the `__default__` and `__debug__` channels from a config, the one in use by default.
+
+            :return A callable that puts them in use.
+        """
+        channels = get_config('channels', {}, config=config)
+        debug_interval = get_config('slack_debug_interval', 60, config=config)
+        debug_max_messages = get_config('slack_debug_max_messages', 10, config=config)
+        # Checked here, as the debug channel may only be created when the config is put in use
+        if not debug_interval > 0:
+            raise ValueError("slack_debug_interval must be greater than 0: {}".format(debug_interval))
+
+        def apply():
+            self._channels = channels
+            if '__debug__' in channels:
+                if self._debug_channel is None:
+                    self._debug_channel = DebugChannel(self.slack_debug_callback,
+                                                       interval=debug_interval,
+                                                       max_messages=debug_max_messages)
+                Logger.set_slack_debug_callback(self._debug_channel.post)
+            elif self._debug_channel is not None:
+                # The __debug__ channel was removed
+                Logger.set_slack_debug_callback(None)
+
+        return apply
 
     def _connect_slack(self, token):
         if not token:
             raise Exception("Can't find a token to connect to Slack.")
 
         try:
-            return slackclient.SlackClient(token)
+            client = slackclient.SlackClient(token)
+            client.server.api_requester = _PooledSlackRequest(pool_size=get_config('slack_pool_size', 10),
+                                                              api_url=get_config('slack_api_url', None))
+            return client
         except Exception as e:
             self._logger.error("Error connecting to Slack: ", e)
             raise
 
+    def _open_outbox(self):
+        outbox_file = get_config('outbox_file', None)
+        if not outbox_file:
+            return None
+
+        # When serving with several worker processes each one needs its own outbox: the first one takes `outbox_file`,
+        # the rest `outbox_file.1`, `outbox_file.2`... so a restarted worker replays what a previous one left behind
+        for slot in itertools.count():
+            path = outbox_file if slot == 0 else "{}.{}".format(outbox_file, slot)
+            try:
+                return Outbox(path, sync_interval=get_config('outbox_sync_interval', 0.05))
+            except BlockingIOError:
+                continue
+
     def get_users(self):
         """
             Requires this permission in Slack:
@@ -43,16 +143,36 @@ class SlackClient:
 
             Returns: {real_name: slack_user_id}
         """
+        users = {}
+        for page in self.iter_users():
+            users.update(page)
+        return users
+
+    def iter_users(self, page_size=None):
+        """
+            Generator with the human users from Slack, following Slack's cursors to get all of them.
+            Yields one page at a time in the form: {real_name: slack_user_id}
+        """
         self._logger.info("Getting list of users from Slack...")
 
-        response = self._client.api_call("users.list")
-        if not response['ok']:
-            raise Exception("Couldn't retrieve user list from Slack. Error: " + str(response['error']))
+        kwargs = {}
+        if page_size:
+            kwargs['limit'] = page_size
+
+        while True:
+            response = self._client.api_call("users.list", **kwargs)
+            if not response['ok']:
+                raise Exception("Couldn't retrieve user list from Slack. Error: " + str(response['error']))
 
-        return {user['real_name']: user['id'] for user in response['members']
-                if not user.get('is_bot', True)
-                and not user.get('deleted', True)
-                and user.get('real_name')}
+            yield {user['real_name']: user['id'] for user in response['members']
+                   if not user.get('is_bot', True)
+                   and not user.get('deleted', True)
+                   and user.get('real_name')}
+
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                return
+            kwargs['cursor'] = cursor
 
     def send_message(self, message):
         """
@@ -60,21 +180,31 @@ class SlackClient:
                 Post messages as the app
                 chat:write
         """
-        channel = message.get('channel', self._channels.get('__default__'))
+        self.send_messages([message])
+
+    def send_messages(self, messages):
+        """
+            Posts several messages for the same channel as a single Slack message, with an attachment per message.
+        """
+        channel = messages[0].get('channel', self._channels.get('__default__'))
         attachments = [
             {
                 'color': self._colors[message.get('type', 'none')],
                 'text': message['text'],
             }
+            for message in messages
         ]
 
-        result = self._client.api_call("chat.postMessage",
-                                       channel=channel,
-                                       attachments=attachments)
-        if not result['ok']:
-            self._logger.error("Couldn't send message to Slack because '{}', dropping: {}",
-                               result['error'],
-                               message)
+        self._sender.send(channel, attachments)
+
+    def flush(self, timeout=None):
+        """
+            Waits until the messages sent so far were delivered to Slack, when they are sent in the background.
+        """
+        return self._sender.flush(timeout)
+
+    def stats(self):
+        return self._sender.stats()
 
     def slack_debug_callback(self, message):
         self.send_message({
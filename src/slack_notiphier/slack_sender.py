@@ -0,0 +1,345 @@
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from . import metrics
+from .logger import Logger
+
+
+_post_seconds = metrics.histogram('notiphier_slack_post_message_seconds',
+                                  "Latency of the calls to Slack's chat.postMessage.")
+_posts = metrics.counter('notiphier_slack_post_messages_total',
+                         "Calls to Slack's chat.postMessage, by outcome: ok, retryable (rate limited or transient "
+                         "error) or failed.",
+                         labels=('outcome',))
+
+
+class _TokenBucket:
+    """
+        Allows `rate` events per second on average, with bursts of up to `burst` events.
+    """
+
+    def __init__(self, rate, burst, clock):
+        self._rate = rate
+        self._burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated_at = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+            Takes a token if there is one available.
+
+            :return 0 if a token was taken, or the seconds to wait until one is available.
+        """
+        with self._lock:
+            now = self._clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self._rate
+
+    def pause(self, seconds):
+        """
+            Stops handing out tokens for some seconds, e.g. because Slack asked us to slow down.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+
+class SlackSender:
+    """
+        Sends messages to Slack respecting its rate limits.
+
+        Every channel has its own token bucket, matching Slack's limit of about one message per second per channel
+        for `chat.postMessage`. Messages rejected because of rate limits or transient errors are retried with
+        exponential backoff, or after the delay requested by Slack in the `Retry-After` header.
+
+        In background mode messages are queued and sent from a dedicated thread, so callers never wait for Slack.
+        Every channel has its own queue: a message waiting to be retried holds back the later messages of its channel,
+        so they are posted in order, but not the messages of other channels. Otherwise messages are sent, and retried,
+        in the caller's thread.
+
+        If given an Outbox, messages are logged to it before sending them and acknowledged once Slack confirms them
+        (or rejects them for good, or they don't fit in the queue), and the messages left unacknowledged by a previous run are sent on startup. They
+        are sent in the background even when not in background mode, so a long backlog doesn't hold up startup.
+    """
+
+    _logger = Logger('SlackSender')
+
+    _retryable_errors = {'ratelimited', 'rate_limited', 'internal_error', 'fatal_error', 'service_unavailable',
+                         'request_timeout'}
+
+    def __init__(self, api_call, rate=1.0, burst=5, max_retries=5, backoff=1.0, max_backoff=60.0,
+                 queue_size=1000, background=False, outbox=None, clock=time.monotonic, sleep=time.sleep):
+        """
+            :param api_call: function used to call Slack's API, with the signature of `SlackClient.api_call`.
+            :param rate: messages per second allowed on each channel.
+            :param burst: messages that can be sent at once on a channel before `rate` applies.
+            :param max_retries: attempts made after the first one before dropping a message.
+            :param backoff: seconds to wait before the first retry, doubled on every following retry.
+            :param max_backoff: maximum seconds to wait between retries.
+            :param queue_size: maximum messages waiting to be sent or retried in background mode.
+            :param background: send messages from a background thread.
+            :param outbox: optional Outbox where messages are logged until Slack confirms them.
+        """
+        self._api_call = api_call
+        self._rate = rate
+        self._burst = burst
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._queue_size = queue_size
+        self._outbox = outbox
+        self._clock = clock
+        self._sleep = sleep
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            'sent': 0,
+            'retried': 0,
+            'dropped': 0,
+        }
+
+        self._background = background
+        if background:
+            # {channel: messages in order}, and a heap of (time, sequence, channel) with when the first message of
+            # each channel can be sent
+            self._channel_queues = {}
+            self._ready = []
+            self._sequence = itertools.count()
+            self._pending = 0
+            self._wakeup = threading.Condition(self._lock)
+            self._idle = threading.Condition(self._lock)
+            self._worker = threading.Thread(target=self._work, name='SlackSender', daemon=True)
+            self._worker.start()
+
+        self._replayer = None
+        if outbox:
+            pending = [{
+                'id': entry['id'],
+                'channel': entry['channel'],
+                'attachments': entry['attachments'],
+                'attempts': 0,
+            } for entry in outbox.pending()]
+
+            if background:
+                for message in pending:
+                    self._enqueue(message)
+            elif pending:
+                self._replayer = threading.Thread(target=self._replay, args=(pending,), name='SlackSenderReplay',
+                                                  daemon=True)
+                self._replayer.start()
+
+    def send(self, channel, attachments):
+        """
+            Sends a message to a channel, or queues it to be sent if running in background mode.
+        """
+        self._enqueue({
+            'id': self._outbox.append(channel, attachments) if self._outbox else None,
+            'channel': channel,
+            'attachments': attachments,
+            'attempts': 0,
+        })
+
+    def _enqueue(self, message):
+        if not self._background:
+            self._send_until_done(message)
+            return
+
+        with self._lock:
+            self._pending += 1
+            full = self._pending > self._queue_size
+            if not full:
+                channel_queue = self._channel_queues.get(message['channel'])
+                if channel_queue is None:
+                    channel_queue = self._channel_queues[message['channel']] = deque()
+                    self._schedule(message['channel'], 0)
+                channel_queue.append(message)
+        if full:
+            # Dropped for good, it isn't sent by a later run either
+            self._ack(message)
+            self._drop(message, "the outgoing queue is full")
+
+    def flush(self, timeout=None):
+        """
+            In background mode, or while replaying the outbox, waits until all the messages sent so far were delivered
+            or dropped.
+
+            :return True if there are no messages left, False if the timeout expired first.
+        """
+        if not self._background:
+            if self._replayer:
+                self._replayer.join(timeout)
+                return not self._replayer.is_alive()
+            return True
+
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            if self._background:
+                stats['queued'] = sum(len(channel_queue) for channel_queue in self._channel_queues.values())
+                stats['retrying'] = sum(1 for channel_queue in self._channel_queues.values()
+                                        if channel_queue[0]['attempts'])
+            return stats
+
+    def _send_until_done(self, message):
+        while True:
+            wait = self._get_bucket(message['channel']).try_acquire()
+            if wait:
+                self._sleep(wait)
+                continue
+
+            delay = self._attempt(message)
+            if delay is None:
+                return
+            self._sleep(delay)
+
+    def _replay(self, messages):
+        for message in messages:
+            self._send_until_done(message)
+        self._logger.info("Sent the {} messages left in the outbox", len(messages))
+
+    def _work(self):
+        while True:
+            channel, message = self._next_message()
+
+            wait = self._get_bucket(channel).try_acquire()
+            if wait:
+                # Only this channel waits, the rest keep sending
+                with self._lock:
+                    self._schedule(channel, wait)
+                continue
+
+            delay = self._attempt(message)
+            with self._lock:
+                if delay is None:
+                    # Sent or dropped, the next message of the channel can go
+                    channel_queue = self._channel_queues[channel]
+                    channel_queue.popleft()
+                    if channel_queue:
+                        self._schedule(channel, 0)
+                    else:
+                        del self._channel_queues[channel]
+                else:
+                    self._schedule(channel, delay)
+
+    def _next_message(self):
+        """
+            Returns the channel, and its first message, that is due the soonest in background mode.
+        """
+        with self._wakeup:
+            while True:
+                timeout = None
+                if self._ready:
+                    timeout = self._ready[0][0] - self._clock()
+                    if timeout <= 0:
+                        channel = heapq.heappop(self._ready)[2]
+                        return channel, self._channel_queues[channel][0]
+                self._wakeup.wait(timeout)
+
+    def _schedule(self, channel, delay):
+        """
+            Sets when the first message of a channel is sent. Must be called holding the lock.
+        """
+        heapq.heappush(self._ready, (self._clock() + delay, next(self._sequence), channel))
+        self._wakeup.notify()
+
+    def _attempt(self, message):
+        """
+            Tries to send a message once.
+
+            :return None if the message was sent or dropped, or the seconds to wait before retrying it.
+        """
+        retry_after = None
+        try:
+            with _post_seconds.time():
+                result = self._api_call("chat.postMessage",
+                                        channel=message['channel'],
+                                        attachments=message['attachments'])
+        except Exception as e:
+            error = str(e)
+            retryable = True
+        else:
+            if result['ok']:
+                _posts.inc(outcome='ok')
+                self._ack(message)
+                self._done('sent')
+                return None
+
+            error = result['error']
+            retryable = error in self._retryable_errors
+            retry_after = self._get_retry_after(result)
+
+        _posts.inc(outcome='retryable' if retryable else 'failed')
+
+        message['attempts'] += 1
+        if not retryable:
+            # Slack would reject it again, there is no point in keeping it for later
+            self._ack(message)
+            self._drop(message, error)
+            return None
+
+        if message['attempts'] > self._max_retries:
+            self._drop(message, error)
+            return None
+
+        with self._lock:
+            self._counters['retried'] += 1
+
+        if retry_after:
+            self._get_bucket(message['channel']).pause(retry_after)
+            return retry_after
+
+        return min(self._max_backoff, self._backoff * 2 ** (message['attempts'] - 1))
+
+    def _drop(self, message, reason):
+        self._logger.error("Couldn't send message to Slack because '{}', dropping: {}", reason, message)
+        self._done('dropped')
+
+    def _ack(self, message):
+        if self._outbox and message['id'] is not None:
+            try:
+                self._outbox.ack(message['id'])
+            except Exception as e:
+                # Sent again in a later run, which beats stopping sending now
+                self._logger.error("Couldn't acknowledge message in the outbox: {}", e)
+
+    def _done(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+            if self._background:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def _get_bucket(self, channel):
+        with self._lock:
+            bucket = self._buckets.get(channel)
+            if bucket is None:
+                bucket = self._buckets[channel] = _TokenBucket(self._rate, self._burst, self._clock)
+            return bucket
+
+    @staticmethod
+    def _get_retry_after(result):
+        headers = result.get('headers') or {}
+        retry_after = headers.get('Retry-After', headers.get('retry-after'))
+        try:
+            return float(retry_after) if retry_after is not None else None
+        except ValueError:
+            return None
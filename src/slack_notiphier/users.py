@@ -1,5 +1,83 @@
 
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from . import metrics
 from .logger import Logger
+from .config import get_config
+
+
+_lookups = metrics.counter('notiphier_user_lookups_total',
+                           "Lookups of users by PHID while handling messages: found in the directory (hit), looked up "
+                           "in Phabricator (resolved) or not found (unknown).",
+                           labels=('result',))
+
+
+class User:
+    """
+        A Phabricator user, along with its Slack ID if a Slack user with the same full name was found.
+    """
+
+    __slots__ = ('phid', 'phab_username', 'slack_id')
+
+    def __init__(self, phid, phab_username, slack_id):
+        self.phid = phid
+        self.phab_username = phab_username
+        self.slack_id = slack_id
+
+    @property
+    def mention(self):
+        """
+            The Slack mention for this user in the form <@SLACKID>, or None if the user wasn't found in Slack.
+        """
+        return '<@{}>'.format(self.slack_id) if self.slack_id else None
+
+    def __eq__(self, other):
+        if not isinstance(other, User):
+            return NotImplemented
+        return (self.phid, self.phab_username, self.slack_id) == (other.phid, other.phab_username, other.slack_id)
+
+    def __hash__(self):
+        return hash((self.phid, self.phab_username, self.slack_id))
+
+    def __repr__(self):
+        return "User(phid={!r}, phab_username={!r}, slack_id={!r})".format(self.phid, self.phab_username, self.slack_id)
+
+
+class _Directory:
+    """
+        Snapshot of the merged user directory along with its indexes.
+        Users swaps whole snapshots when refreshing, so readers never see a half-built directory. The only change made
+        in place is adding a single user resolved on demand, which touches one key per index.
+    """
+
+    __slots__ = ('users', 'by_username', 'by_lower_username', 'by_slack_id', 'mentions', 'slack_users', 'synced_at')
+
+    def __init__(self, users, slack_users, synced_at):
+        """
+            :param users: {phid: User}
+            :param slack_users: {real_name: slack_user_id} with all the Slack users, to match users added later.
+            :param synced_at: UNIX timestamp of when the data in the directory was downloaded.
+        """
+        self.users = users
+        self.by_username = {u.phab_username: u for u in users.values()}
+        self.by_lower_username = {u.phab_username.lower(): u for u in users.values()}
+        self.by_slack_id = {u.slack_id: u for u in users.values() if u.slack_id}
+        self.mentions = {u.phab_username.lower(): u.mention for u in users.values() if u.slack_id}
+        self.slack_users = slack_users
+        self.synced_at = synced_at
+
+    def add(self, user):
+        self.users[user.phid] = user
+        self.by_username[user.phab_username] = user
+        self.by_lower_username[user.phab_username.lower()] = user
+        if user.slack_id:
+            self.by_slack_id[user.slack_id] = user
+            self.mentions[user.phab_username.lower()] = user.mention
 
 
 class Users:
@@ -10,9 +88,11 @@ class Users:
     Usage:
         #>>> users = Users(my_phab_url, my_phab_token, my_slack_token)
         #>>> users['pparker']
-        {'phid': 'PHID-USER-1234', 'phab_username': 'pparker', 'slack_id': 'U98765'}
+        User(phid='PHID-USER-1234', phab_username='pparker', slack_id='U98765')
         #>>> users['PHID-USER-1234']
-        {'phid': 'PHID-USER-1234', 'phab_username': 'pparker', 'slack_id': 'U98765'}
+        User(phid='PHID-USER-1234', phab_username='pparker', slack_id='U98765')
+        #>>> users.get_by_slack_id('U98765')
+        User(phid='PHID-USER-1234', phab_username='pparker', slack_id='U98765')
         #>>> users.mention('pparker')
         '<@U98765>'
         #>>> users.mention('PHID-USER-1234')
@@ -20,28 +100,75 @@ class Users:
     """
 
     _logger = Logger('Users')
-    _merged_users = {}
+    _directory = _Directory({}, {}, None)
+
+    # Margin, in seconds, when asking Phabricator for the users created since the last refresh
+    _delta_margin = 60
 
-    def __init__(self, phab_client, slack_client):
+    _snapshot_version = 1
+
+    # Seconds before retrying a full refresh that failed, doubled after every failure in a row
+    _min_retry_delay = 1
+    _max_retry_delay = 300
+
+    def __init__(self, phab_client, slack_client, snapshot_file=None):
+        """
+            :param snapshot_file: if given, the directory is saved to this file after every refresh, and loaded from it
+                                  when starting. When loaded from a snapshot, the directory is served right away and
+                                  reconciled with Phabricator and Slack by the background refresher.
+                                  Several processes can share the same snapshot file, in which case only one of them
+                                  downloads the users at a time and the rest reuse the snapshot it saved.
+        """
         self._phab_client = phab_client
         self._slack_client = slack_client
+        self._snapshot_file = snapshot_file
+        self._page_size = get_config('users_page_size', None)
+
+        self._refresh_lock = threading.Lock()
+        self._request_lock = threading.Lock()
+        self._refresh_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._last_refresh_request = None
+        self._on_demand_interval = 0
+        self._refresher = None
+
+        self._negative_ttl = get_config('users_negative_ttl', 600)
+        self._negative_lock = threading.Lock()
+        self._unknown_phids = {}
+        self._placeholders = {}
 
-        phab_users = phab_client.get_users()
-        slack_users = slack_client.get_users()
-        self._merged_users = self._merge_users(phab_users, slack_users)
+        # Processes starting at the same time wait for the first one to download the users, then load its snapshot
+        with self._snapshot_lock():
+            self._stale = snapshot_file is not None and self.load_snapshot(snapshot_file)
+            if not self._stale:
+                self.refresh()
 
     def __getitem__(self, userid):
         """
-            Returns a user given its PHID or Phabricator username.
+            Returns a user given its PHID or Phabricator username. Usernames are matched ignoring case if there is
+            no exact match, as Phabricator does.
 
             :return
-                An object in the form {phid, phab_username, slack_id} with the data of the user found.
+                A User with the data of the user found.
                 If a matching user is not found, None is returned.
         """
+        directory = self._directory
         if userid.startswith("PHID-USER-"):
-            return self._merged_users.get(userid)
+            return directory.users.get(userid)
 
-        return next((u for u in self._merged_users.values() if u['phab_username'] == userid), None)
+        user = directory.by_username.get(userid)
+        if user is None:
+            user = directory.by_lower_username.get(userid.lower())
+        return user
+
+    def __len__(self):
+        return len(self._directory.users)
+
+    def get_by_slack_id(self, slack_id):
+        """
+            Returns a user given its Slack ID, or None if no Phabricator user is linked to it.
+        """
+        return self._directory.by_slack_id.get(slack_id)
 
     def get_mention(self, userid):
         """
@@ -55,18 +182,285 @@ class Users:
         if not user:
             return None
 
-        slack_id = user['slack_id']
-        if not slack_id:
+        return user.mention
+
+    def get_mentions(self):
+        """
+            Returns the Slack mention of every user linked to Slack, by lowercase Phabricator username:
+            {phab_username: '<@SLACKID>'}
+            The dictionary is replaced when the directory is refreshed, and it only grows otherwise. It must not be
+            modified.
+        """
+        return self._directory.mentions
+
+    def resolve(self, phid):
+        """
+            Returns a user given its PHID. If the user is not in the directory, it is looked up on its own in
+            Phabricator and added to the directory, and the Slack user with the same full name is linked to it.
+            PHIDs that can't be resolved are remembered for a while, so they don't cause a lookup per message.
+
+            :return
+                A User with the data of the user found, or None.
+        """
+        user = self[phid]
+        if user is not None:
+            _lookups.inc(result='hit')
+            return user
+        if not phid.startswith("PHID-USER-"):
+            _lookups.inc(result='unknown')
+            return None
+
+        with self._negative_lock:
+            expires_at = self._unknown_phids.get(phid)
+            if expires_at is not None and expires_at > time.monotonic():
+                _lookups.inc(result='unknown')
+                return None
+
+        phab_user = self._phab_client.get_user(phid)
+        if not phab_user:
+            self._logger.warn("Unknown Phabricator user, ignoring it for {} seconds: {}", self._negative_ttl, phid)
+            with self._negative_lock:
+                now = time.monotonic()
+                self._unknown_phids = {p: e for p, e in self._unknown_phids.items() if e > now}
+                self._unknown_phids[phid] = now + self._negative_ttl
+            _lookups.inc(result='unknown')
             return None
 
-        return '<@{}>'.format(slack_id)
+        # Added to the current directory without waiting for a refresh in progress, which will include it anyway
+        directory = self._directory
+        user = User(phid, phab_user[0], directory.slack_users.get(phab_user[1]))
+        directory.add(user)
+
+        self._logger.info("Resolved user not present in the directory: {}", user)
+
+        _lookups.inc(result='resolved')
+
+        # Slack users can't be looked up by full name on their own, so the user may be new in Slack too. Only then a
+        # refresh is needed, as it downloads all the Slack users.
+        if user.slack_id is None:
+            self.request_refresh()
+        return user
+
+    def get_placeholder(self, phid):
+        """
+            Returns a User standing for a PHID that `resolve` doesn't know, e.g. Herald's PHID-APPS-..., named as
+            Phabricator shows it or, failing that, after the PHID itself. It has no Slack ID, so it is never mentioned.
+            Placeholders are remembered as long as unknown users (users_negative_ttl).
+        """
+        with self._negative_lock:
+            expires_at, user = self._placeholders.get(phid, (0, None))
+            if expires_at > time.monotonic():
+                return user
+
+        user = User(phid, self._phab_client.get_name(phid) or phid, None)
+        with self._negative_lock:
+            now = time.monotonic()
+            self._placeholders = {p: e for p, e in self._placeholders.items() if e[0] > now}
+            self._placeholders[phid] = (now + self._negative_ttl, user)
+        return user
+
+    def refresh(self, delta=False):
+        """
+            Downloads the users from Phabricator and Slack and replaces the directory with the new one.
+            Lookups done while refreshing are served from the previous directory.
+
+            :param delta: only ask Phabricator for the users created since the last refresh and add them to the
+                          current directory. Slack doesn't allow filtering, so its users are always downloaded in full.
+        """
+        with self._refresh_lock:
+            started_at = time.monotonic()
+            synced_at = time.time()
+            current = self._directory
+
+            if delta and current.synced_at:
+                created_after = int(current.synced_at) - self._delta_margin
+                merged_users = dict(current.users)
+            else:
+                created_after = None
+                merged_users = {}
+
+            # Slack users are needed in full to cross them with Phabricator's, which are then merged a page at a time
+            slack_users = {}
+            for page in self._slack_client.iter_users(self._page_size):
+                slack_users.update(page)
+
+            for page in self._phab_client.iter_users(self._page_size, created_after=created_after):
+                merged_users.update(self._merge_users(page, slack_users))
+
+            self._directory = _Directory(merged_users, slack_users, synced_at)
+
+            self._logger.info("User directory with {} users {} in {:.2f} seconds",
+                              len(merged_users),
+                              "updated" if created_after else "built",
+                              time.monotonic() - started_at)
+
+            if self._snapshot_file:
+                self.save_snapshot(self._snapshot_file)
+
+    def save_snapshot(self, path):
+        """
+            Saves the directory to a JSON lines file: a header line followed by a line per Phabricator user and a line
+            per Slack user. The file is replaced atomically, so a crash while saving never leaves a truncated snapshot.
+        """
+        directory = self._directory
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fp:
+                fp.write(json.dumps({'version': self._snapshot_version, 'synced_at': directory.synced_at}) + "\n")
+                for user in list(directory.users.values()):
+                    fp.write(json.dumps(['u', user.phid, user.phab_username, user.slack_id]) + "\n")
+                for real_name, slack_id in directory.slack_users.items():
+                    fp.write(json.dumps(['s', real_name, slack_id]) + "\n")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self._logger.error("Couldn't save the user directory snapshot to '{}': {}", path, e)
+
+    def load_snapshot(self, path):
+        """
+            Replaces the directory with the one saved in a snapshot file.
+
+            :return True if the snapshot was loaded, False if it doesn't exist or can't be read.
+        """
+        started_at = time.monotonic()
+        try:
+            with open(path, 'r') as fp:
+                header = json.loads(fp.readline())
+                if header.get('version') != self._snapshot_version:
+                    raise ValueError("Unsupported snapshot version: {}".format(header.get('version')))
+
+                users = {}
+                slack_users = {}
+                for line in fp:
+                    entry = json.loads(line)
+                    if entry[0] == 'u':
+                        users[entry[1]] = User(entry[1], entry[2], entry[3])
+                    elif entry[0] == 's':
+                        slack_users[entry[1]] = entry[2]
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, IndexError) as e:
+            self._logger.warn("Ignoring unreadable user directory snapshot '{}': {}", path, e)
+            return False
+
+        self._directory = _Directory(users, slack_users, header.get('synced_at'))
+        self._logger.info("User directory with {} users loaded from snapshot in {:.2f} seconds",
+                          len(users), time.monotonic() - started_at)
+        return True
+
+    def start_refresher(self, interval, on_demand_interval, on_refresh=None):
+        """
+            Starts a background thread that refreshes the directory every `interval` seconds (0 disables periodic
+            refreshes) and whenever `request_refresh` is called, at most once every `on_demand_interval` seconds.
+            If the directory was loaded from a snapshot, it is refreshed right away.
+
+            :param on_refresh: optional callable invoked after every refresh done by the background thread.
+        """
+        self._on_demand_interval = on_demand_interval
+        self._refresher = threading.Thread(target=self._refresh_loop, args=(interval, on_refresh),
+                                           name='UsersRefresher', daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        self._stopped.set()
+        self._refresh_requested.set()
+        if self._refresher:
+            self._refresher.join()
+
+    def request_refresh(self):
+        """
+            Asks the background refresher to look for new users, for example because an unknown PHID was seen.
+            Requests are rate limited, so many unknown PHIDs in a row cause a single refresh.
+
+            :return True if a refresh was requested, False if it was discarded because of the rate limit.
+        """
+        with self._request_lock:
+            now = time.monotonic()
+            if self._last_refresh_request is not None and \
+                    now - self._last_refresh_request < self._on_demand_interval:
+                return False
+            self._last_refresh_request = now
+
+        self._refresh_requested.set()
+        return True
+
+    def _refresh_loop(self, interval, on_refresh):
+        if self._stale:
+            next_full_refresh = time.monotonic()
+        else:
+            next_full_refresh = time.monotonic() + interval if interval else None
+        failures = 0
+
+        while True:
+            timeout = max(0, next_full_refresh - time.monotonic()) if next_full_refresh is not None else None
+            requested = self._refresh_requested.wait(timeout)
+            if self._stopped.is_set():
+                return
+            self._refresh_requested.clear()
+
+            try:
+                if requested:
+                    self.refresh(delta=True)
+                else:
+                    self._refresh_shared()
+                    self._stale = False
+                    failures = 0
+                    next_full_refresh = time.monotonic() + interval if interval else None
+
+                if on_refresh:
+                    on_refresh()
+            except Exception as e:
+                if requested:
+                    self._logger.error("Couldn't refresh the user directory: {}", e)
+                    continue
+                # Otherwise the full refresh would be retried right away, hammering Phabricator and Slack during outages
+                failures += 1
+                retry_delay = min(self._min_retry_delay * 2 ** (failures - 1), self._max_retry_delay)
+                next_full_refresh = time.monotonic() + retry_delay
+                self._logger.error("Couldn't refresh the user directory, retrying in {} seconds: {}", retry_delay, e)
+
+    def _refresh_shared(self):
+        """
+            Full refresh done by the background refresher. If another process sharing the snapshot file saved it less
+            than `on_demand_interval` seconds ago, the directory is loaded from it instead of downloading the users.
+        """
+        with self._snapshot_lock():
+            synced_at = self._get_snapshot_synced_at()
+            if synced_at is None or synced_at < time.time() - self._on_demand_interval:
+                self.refresh()
+            elif synced_at != self._directory.synced_at:
+                self.load_snapshot(self._snapshot_file)
+
+    def _get_snapshot_synced_at(self):
+        if not self._snapshot_file:
+            return None
+        try:
+            with open(self._snapshot_file, 'r') as fp:
+                return json.loads(fp.readline()).get('synced_at')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    @contextmanager
+    def _snapshot_lock(self):
+        """
+            Holds an exclusive lock, shared by all the processes using the same snapshot file, while refreshing.
+        """
+        if not self._snapshot_file:
+            yield
+            return
+
+        with open("{}.lock".format(self._snapshot_file), 'a') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
 
     def _merge_users(self, phab_users, slack_users):
         """
             Grabs a user list from Slack and one from Phabricator and crosses them to return a dictionary with an entry
             per user, containing both Slack and Phab information for it.
 
-            :return {phid: {phid, phab_username, slack_id}}
+            :return {phid: User}
         """
 
         # Input looks like: 'Peter Parker'
@@ -77,5 +471,5 @@ class Users:
 
             return slack_users[phab_fullname]
 
-        return {phid: {'phid': phid, 'phab_username': phab_names[0], 'slack_id': get_slack_id(phab_names[1])}
+        return {phid: User(phid, phab_names[0], get_slack_id(phab_names[1]))
                 for phid, phab_names in phab_users.items()}
@@ -1,29 +1,93 @@
 
+import asyncio
+import atexit
 import json
+import os
 import re
 import textwrap
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from . import metrics
 from .users import Users
 from .logger import Logger
 from .phab_client import PhabClient
 from .slack_client import SlackClient
+from .message_digest import MessageDigest
+from .dedup import SeenTransactions
+from .filters import TransactionFilter
+from .routing import ChannelRouter
 from .config import get_config
 
 
+_delivery_seconds = metrics.histogram('notiphier_delivery_seconds',
+                                      "Time handling a delivery from the Firehose, from its arrival until its messages "
+                                      "are handed to Slack.")
+_delivery_errors = metrics.counter('notiphier_delivery_errors_total',
+                                   "Deliveries from the Firehose whose handling failed.")
+_duplicate_transactions = metrics.counter('notiphier_duplicate_transactions_total',
+                                          "Transactions skipped because they were already handled, e.g. in deliveries "
+                                          "retried by Phabricator.")
+_filtered_transactions = metrics.counter('notiphier_filtered_transactions_total',
+                                        "Transactions ignored because of the filters in the config file, by filter.",
+                                        labels=('filter',))
+_render_seconds = metrics.histogram('notiphier_render_seconds',
+                                    "Time converting a transaction to a message, by object type.",
+                                    labels=('object_type',))
+
+
 class WebhookFirehose:
     """
         Receives notifications coming from a Phabricator Firehose Webhook.
         It then converts each notification to a human-readable message and sends it through Slack.
     """
     _logger = Logger('WebhookFirehose')
-    _re_phab_mention = re.compile("@([\\w_-]+)")
+    # Same as Phabricator's mention rule: not preceded by a word character (e.g. in emails), and not ending with a dot
+    _re_phab_mention = re.compile(r"(?<!\w)@([\w.-]*[\w-])")
+    _mention_cache_size = 256
 
     def __init__(self):
         self._slack_client = SlackClient()
         self._phab_client = PhabClient()
+        self._digest = MessageDigest(self._slack_client.send_messages,
+                                     window=get_config('digest_window', 0),
+                                     max_messages=get_config('digest_max_messages', 20))
+        atexit.register(self._digest.flush)
+        self._executor = ThreadPoolExecutor(max_workers=get_config('async_workers', 16))
+        self._router = ChannelRouter.from_config()
+        self._filter = TransactionFilter.from_config()
+        self._mention_cache = OrderedDict()
+        self._mention_cache_mentions = None
+        self._mention_cache_size_seen = 0
+        self._mention_cache_lock = threading.Lock()
+
+        snapshot_dir = get_config('snapshot_dir', None)
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            self._objects_snapshot = os.path.join(snapshot_dir, 'objects.jsonl')
+            users_snapshot = os.path.join(snapshot_dir, 'users.jsonl')
+            seen_transactions_file = os.path.join(snapshot_dir, 'seen_transactions.jsonl')
+            self._phab_client.load_cache_snapshot(self._objects_snapshot)
+            self._phab_client.share_cache_invalidations(os.path.join(snapshot_dir, 'invalidations.jsonl'))
+            atexit.register(self._save_objects_snapshot)
+        else:
+            self._objects_snapshot = None
+            users_snapshot = None
+            seen_transactions_file = None
+
+        self._seen_transactions = SeenTransactions(window=get_config('dedup_window', 3600),
+                                                   max_size=get_config('dedup_max_size', 100000),
+                                                   path=seen_transactions_file)
+
         self._users = Users(phab_client=self._phab_client,
-                            slack_client=self._slack_client)
+                            slack_client=self._slack_client,
+                            snapshot_file=users_snapshot)
+        self._users.start_refresher(interval=get_config('users_refresh_interval', 3600),
+                                    on_demand_interval=get_config('users_refresh_min_interval', 60),
+                                    on_refresh=self._save_objects_snapshot)
 
         self._transaction_handlers = {
             "TASK": self._handle_task,
@@ -40,66 +104,237 @@ class WebhookFirehose:
             'type': 'info'
         })
 
+    def prepare_reload(self, config):
+        """
+            Builds the channel routing, the filters and the special Slack channels from a new config.
+
+            :return A callable that puts them in use.
+        """
+        router = ChannelRouter.from_config(config)
+        transaction_filter = TransactionFilter.from_config(config)
+        apply_slack_channels = self._slack_client.prepare_reload(config)
+
+        def apply():
+            self._router, self._filter = router, transaction_filter
+            apply_slack_channels()
+
+        return apply
+
     def handle(self, request):
         """
             Handle a single request from one of Phabricator's Firehose webhooks.
             It extracts the relevant data and sends the message to Slack.
         """
+        started_at = time.perf_counter()
+        claimed = []
+        try:
+            object_type = request['object']['type']
+            object_phid = request['object']['phid']
+
+            self._logger.debug("Incoming message:\n{}", lambda: json.dumps(request, indent=4))
+
+            if not self._accepts_object_type(request):
+                return
+
+            claimed = self._claim_transactions(request)
+            if not claimed:
+                return
+
+            with self._phab_client.request_scope():
+                transactions = self._get_transactions(object_type, object_phid, claimed)
+                self._handle_transactions(object_type, object_phid, transactions)
+        except Exception as e:
+            _delivery_errors.inc()
+            self._seen_transactions.release(claimed)
+            self._report_exception(e, request, traceback.format_exc())
+        finally:
+            _delivery_seconds.observe(time.perf_counter() - started_at)
+
+    async def handle_async(self, request):
+        """
+            Same as `handle`, for asyncio servers. Blocking Conduit and Slack calls run in a thread pool, so many
+            deliveries are handled at the same time with few threads. Within a delivery, the messages are rendered at
+            the same time and messages going to different channels are sent at the same time (keeping their order
+            within each channel), but most Conduit calls depend on the previous ones, so a single delivery takes about
+            as long as with `handle`.
+        """
+        # Within a coroutine this is the running loop, asyncio.get_running_loop() needs Python 3.7
+        loop = asyncio.get_event_loop()
+        objects = {}
+
+        def in_scope(function, *args):
+            with self._phab_client.request_scope(objects):
+                return function(*args)
+
+        def run(function, *args):
+            return loop.run_in_executor(self._executor, in_scope, function, *args)
+
+        started_at = time.perf_counter()
+        claimed = []
         try:
             object_type = request['object']['type']
             object_phid = request['object']['phid']
 
-            self._logger.debug("Incoming message:\n{}", json.dumps(request, indent=4))
+            self._logger.debug("Incoming message:\n{}", lambda: json.dumps(request, indent=4))
+
+            if not self._accepts_object_type(request):
+                return
+
+            claimed = await loop.run_in_executor(self._executor, self._claim_transactions, request)
+            if not claimed:
+                return
+
+            transactions = await run(self._get_transactions, object_type, object_phid, claimed)
+            rendered = await asyncio.gather(*(run(self._handle_transaction, object_type, t) for t in transactions))
 
-            transactions = self._get_transactions(object_type, object_phid, request['transactions'])
-            self._handle_transactions(object_type, transactions)
+            messages_by_channel = OrderedDict()
+            for messages in rendered:
+                for message in messages:
+                    messages_by_channel.setdefault(message['channel'], []).append(message)
+
+            await asyncio.gather(*(run(self._send_messages, object_phid, channel_messages)
+                                   for channel_messages in messages_by_channel.values()))
         except Exception as e:
-            try:
-                fmt_request = json.dumps(request)
-            except:
-                fmt_request = request
-
-            message = textwrap.dedent("""
-                *Exception in Slack-Notiphier:* {}
-                *Original message:* {}
-                *Stacktrace:*
-                {}
-                """).format(e,
-                            fmt_request,
-                            textwrap.indent(traceback.format_exc(), "        "))
-            self._slack_client.send_message({
-                'text': message,
-                'type': 'error',
-            })
-
-    def _get_transactions(self, object_type, object_phid, wrapped_phids):
-        """
-            Receives a list of transactions as received by the Firehose, and returns a list with only the interesting
-            parts of the transactions.
-        """
-        phids = [t['phid'] for t in wrapped_phids]
-        return self._phab_client.get_transactions(object_type, object_phid, phids)
-
-    def _handle_transactions(self, object_type, transactions):
+            _delivery_errors.inc()
+            stacktrace = traceback.format_exc()
+            await loop.run_in_executor(self._executor, self._seen_transactions.release, claimed)
+            await loop.run_in_executor(self._executor, self._report_exception, e, request, stacktrace)
+        finally:
+            _delivery_seconds.observe(time.perf_counter() - started_at)
+
+    def flush(self, timeout=None):
+        """
+            Posts the pending digests and waits until Slack got all the messages sent so far.
+        """
+        self._digest.flush()
+        return self._slack_client.flush(timeout)
+
+    def stats(self):
+        """
+            Returns counters describing the internal state of the webhook, suitable for monitoring.
+        """
+        return {
+            'object_cache': self._phab_client.cache_stats(),
+            'slack': self._slack_client.stats(),
+        }
+
+    def _save_objects_snapshot(self):
+        if self._objects_snapshot:
+            self._phab_client.save_cache_snapshot(self._objects_snapshot)
+
+    def _claim_transactions(self, request):
+        """
+            Returns the PHIDs of the transactions in a delivery that weren't handled already, and marks them as
+            handled. Phabricator retries the deliveries that time out, even if they were handled.
+        """
+        phids = [t['phid'] for t in request['transactions']]
+        claimed = self._seen_transactions.claim(phids)
+        if len(claimed) < len(phids):
+            _duplicate_transactions.inc(len(phids) - len(claimed))
+            self._logger.info("Skipping {} transactions of {} already handled",
+                              len(phids) - len(claimed), request['object']['phid'])
+        return claimed
+
+    def _accepts_object_type(self, request):
+        """
+            Tells whether the object of a delivery can generate any message, before asking Conduit about it.
+        """
+        object_type = request['object']['type']
+        if object_type not in self._transaction_handlers:
+            self._logger.slack_debug("No message will be generated for object of type {}.\n{}",
+                                     object_type, lambda: json.dumps(request, indent=4))
+            return False
+
+        if not self._filter.allows_object_type(object_type):
+            _filtered_transactions.inc(len(request['transactions']), filter='object_types')
+            # Its transactions aren't looked up, so any of them could have renamed it. The cached names of repositories
+            # and projects are still used to route diffs and tasks.
+            self._phab_client.invalidate(request['object']['phid'])
+            return False
+
+        return True
+
+    def _get_transactions(self, object_type, object_phid, phids):
+        """
+            Receives the PHIDs of the transactions in a delivery, and returns a list with only the interesting parts of
+            the transactions that pass the filters.
+        """
+        transactions = self._phab_client.get_transactions(object_type, object_phid, phids,
+                                                          keep=self._keep_transaction)
+
+        # Repositories are only known once the transactions that are left are about to be rendered
+        if object_type in ('DREV', 'CMIT'):
+            allowed = [t for t in transactions if self._filter.allows_repo(t['repo'])]
+            if len(allowed) < len(transactions):
+                _filtered_transactions.inc(len(transactions) - len(allowed), filter='repos')
+            return allowed
+
+        return transactions
+
+    def _keep_transaction(self, transaction):
+        if not self._filter.allows_transaction_type(transaction['type']):
+            _filtered_transactions.inc(filter='transaction_types')
+            return False
+
+        if self._filter.has_author_rules:
+            # Only users already in the directory are matched by username, not to ask Phabricator about the rest
+            user = self._users[transaction['author']]
+            if not self._filter.allows_author(transaction['author'], user.phab_username if user else None):
+                _filtered_transactions.inc(filter='authors')
+                return False
+
+        return True
+
+    def _handle_transactions(self, object_type, object_phid, transactions):
         """
             Receives a list of interesting transactions and sends messages to Slack.
+            Messages about the same object and channel may be merged before sending them, see MessageDigest.
         """
         for t in transactions:
-            message = self._handle_transaction(object_type, t)
+            messages = self._handle_transaction(object_type, t)
+
+            if messages:
+                self._send_messages(object_phid, messages)
+
+    def _send_messages(self, object_phid, messages):
+        for message in messages:
+            self._digest.add((object_phid, message.get('channel')), message)
+            self._logger.debug("Message: {}", message)
 
-            if message:
-                self._slack_client.send_message(message)
-                self._logger.debug("Message: {}", message)
+    def _report_exception(self, e, request, stacktrace):
+        try:
+            fmt_request = json.dumps(request)
+        except:
+            fmt_request = request
+
+        message = textwrap.dedent("""
+            *Exception in Slack-Notiphier:* {}
+            *Original message:* {}
+            *Stacktrace:*
+            {}
+            """).format(e,
+                        fmt_request,
+                        textwrap.indent(stacktrace, "        "))
+        self._slack_client.send_message({
+            'text': message,
+            'type': 'error',
+        })
 
     def _handle_transaction(self, object_type, transaction):
         """
-            Receives a single interesting transaction and send a message to Slack.
+            Receives a single interesting transaction and returns the messages to send to Slack: the same message for
+            each of the channels it goes to.
         """
         if object_type not in self._transaction_handlers:
-            self._logger.slack_debug("No message will be generated for: {}", json.dumps(transaction, indent=4))
-            return None
+            self._logger.slack_debug("No message will be generated for: {}",
+                                 lambda: json.dumps(transaction, indent=4))
+            return []
 
-        return self._transaction_handlers[object_type](transaction)
+        with _render_seconds.time(object_type=object_type):
+            message = self._transaction_handlers[object_type](transaction)
+            if not message:
+                return []
+            return [dict(message, channel=channel) for channel in self._get_channels(object_type, transaction)]
 
     def _handle_task(self, transaction):
         """
@@ -110,18 +345,14 @@ class WebhookFirehose:
 
         owner_phid = self._phab_client.get_owner(transaction['task'])
         if owner_phid:
-            if not self._users[owner_phid]:
-                raise ValueError("Unknown Phabricator user: {}".format(owner_phid))
-            owner_name = self._users[owner_phid]['phab_username']
-            owner_mention = self._users.get_mention(owner_phid)
+            owner = self._get_user(owner_phid)
+            owner_name = owner.phab_username
+            owner_mention = owner.mention
         else:
             owner_name = None
             owner_mention = None
 
-        author_phid = transaction['author']
-        if not self._users[author_phid]:
-            raise ValueError("Unknown Phabricator user: {}".format(author_phid))
-        author_name = self._users[author_phid]['phab_username']
+        author_name = self._get_user(transaction['author']).phab_username
 
         if transaction['type'] == 'task-create':
             message = "User {} created task {}".format(author_name, task_link)
@@ -148,7 +379,8 @@ class WebhookFirehose:
 
         elif transaction['type'] == 'task-assign':
             if transaction['asignee']:
-                asignee_mention = self._users.get_mention(transaction['asignee'])
+                asignee = self._get_user(transaction['asignee'])
+                asignee_mention = asignee.mention or asignee.phab_username
             else:
                 asignee_mention = "nobody"
 
@@ -177,7 +409,8 @@ class WebhookFirehose:
                 'text': message
             }
 
-        self._logger.slack_debug("No message will be generated for: {}", json.dumps(transaction, indent=4))
+        self._logger.slack_debug("No message will be generated for: {}",
+                                 lambda: json.dumps(transaction, indent=4))
 
     def _handle_diff(self, transaction):
         """
@@ -186,25 +419,17 @@ class WebhookFirehose:
 
         diff_link = self._phab_client.get_link(transaction['diff'])
 
-        owner_phid = self._phab_client.get_owner(transaction['diff'])
-        author_phid = transaction['author']
-
-        if not self._users[owner_phid]:
-            raise ValueError("Unknown Phabricator user: {}".format(owner_phid))
-        if not self._users[author_phid]:
-            raise ValueError("Unknown Phabricator user: {}".format(author_phid))
-
-        owner_name = self._users[owner_phid]['phab_username']
-        owner_mention = self._users.get_mention(owner_phid)
-        author_name = self._users[author_phid]['phab_username']
+        owner = self._get_user(self._phab_client.get_owner(transaction['diff']))
+        author = self._get_user(transaction['author'])
 
-        channel = self._get_channel_for_repo(transaction['repo'])
+        owner_name = owner.phab_username
+        owner_mention = owner.mention
+        author_name = author.phab_username
 
         if transaction['type'] == 'diff-create':
             message = "User {} created diff {}".format(author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-add-comment':
@@ -212,53 +437,47 @@ class WebhookFirehose:
             message = "User {} commented on diff {} with {}".format(author_name, diff_link, comment)
             message = "{} {}".format(owner_mention, message) if author_name != owner_name else message
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-update':
             message = "User {} updated diff {}".format(author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-abandon':
             message = "User {} abandoned diff {}".format(author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-reclaim':
             message = "User {} reclaimed diff {}".format(author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-accept':
             message = "{} User {} accepted diff {}".format(owner_mention, author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-request-changes':
             message = "{} User {} requested changes to diff {}".format(owner_mention, author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
         elif transaction['type'] == 'diff-commandeer':
             message = "{} User {} took command of diff {}".format(owner_mention, author_name, diff_link)
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
-        self._logger.slack_debug("No message will be generated for: {}", json.dumps(transaction, indent=4))
+        self._logger.slack_debug("No message will be generated for: {}",
+                                 lambda: json.dumps(transaction, indent=4))
 
     def _handle_commit(self, transaction):
         """
@@ -267,23 +486,16 @@ class WebhookFirehose:
 
         commit_link = self._phab_client.get_link(transaction['commit'])
 
-        author_phid = transaction['author']
-
-        if not self._users[author_phid]:
-            raise ValueError("Unknown Phabricator user: {}".format(author_phid))
-
-        author_name = self._users[author_phid]['phab_username']
-
-        channel = self._get_channel_for_repo(transaction['repo'])
+        author_name = self._get_user(transaction['author']).phab_username
 
         if transaction['type'] == 'commit-add-comment':
             message = "User {} created commit {} on repository {}".format(author_name, commit_link, transaction['repo'])
             return {
-                'text': message,
-                'channel': channel,
+                'text': message
             }
 
-        self._logger.slack_debug("No message will be generated for: {}", json.dumps(transaction, indent=4))
+        self._logger.slack_debug("No message will be generated for: {}",
+                                 lambda: json.dumps(transaction, indent=4))
 
     def _handle_proj(self, transaction):
         """
@@ -292,12 +504,7 @@ class WebhookFirehose:
 
         proj_link = self._phab_client.get_link(transaction['proj'])
 
-        author_phid = transaction['author']
-
-        if not self._users[author_phid]:
-            raise ValueError("Unknown Phabricator user: {}".format(author_phid))
-
-        author_name = self._users[author_phid]['phab_username']
+        author_name = self._get_user(transaction['author']).phab_username
 
         if transaction['type'] == 'proj-create':
             message = "User {} created project {}".format(author_name, proj_link)
@@ -305,7 +512,8 @@ class WebhookFirehose:
                 'text': message
             }
 
-        self._logger.slack_debug("No message will be generated for: {}", json.dumps(transaction, indent=4))
+        self._logger.slack_debug("No message will be generated for: {}",
+                                 lambda: json.dumps(transaction, indent=4))
 
     def _handle_repo(self, transaction):
         """
@@ -314,12 +522,7 @@ class WebhookFirehose:
 
         repo_link = self._phab_client.get_link(transaction['repo'])
 
-        author_phid = transaction['author']
-
-        if not self._users[author_phid]:
-            raise ValueError("Unknown Phabricator user: {}".format(author_phid))
-
-        author_name = self._users[author_phid]['phab_username']
+        author_name = self._get_user(transaction['author']).phab_username
 
         if transaction['type'] == 'repo-create':
             message = "User {} created repository {}".format(author_name, repo_link)
@@ -327,23 +530,58 @@ class WebhookFirehose:
                 'text': message
             }
 
-        self._logger.slack_debug("No message will be generated for: {}", json.dumps(transaction, indent=4))
+        self._logger.slack_debug("No message will be generated for: {}",
+                                 lambda: json.dumps(transaction, indent=4))
 
-    def _replace_mentions(self, text):
-        matches = self._re_phab_mention.finditer(text)
-
-        replacements = {}
-        for match in matches:
-            phab_username = match.group(1)
-            mention = self._users.get_mention(phab_username)
-            if mention is not None:
-                replacements[match.group(0)] = mention
-
-        for phab_username, slack_mention in replacements.items():
-            text = text.replace(phab_username, slack_mention)
-
-        return text
+    def _get_user(self, phid):
+        """
+            Returns the user with the given PHID. Authors that aren't users, like Herald, and users Phabricator doesn't
+            know get a placeholder named as Phabricator shows them, so their transactions are still posted.
+        """
+        user = self._users.resolve(phid)
+        if user is None:
+            user = self._users.get_placeholder(phid)
+        return user
 
-    def _get_channel_for_repo(self, repo_name):
-        channels = get_config('channels')
-        return channels.get(repo_name, channels['__default__'])
+    def _replace_mentions(self, text):
+        """
+            Replaces the Phabricator mentions (@username) in a text with Slack mentions, in a single pass.
+            Results are memoized, as the same comment is often rendered more than once.
+        """
+        if '@' not in text:
+            return text
+
+        mentions = self._users.get_mentions()
+        with self._mention_cache_lock:
+            # Cached results are only valid for the same set of mentions, which only grows until it is replaced
+            if self._mention_cache_mentions is not mentions or self._mention_cache_size_seen != len(mentions):
+                self._mention_cache_mentions = mentions
+                self._mention_cache_size_seen = len(mentions)
+                self._mention_cache.clear()
+            replaced = self._mention_cache.get(text)
+            if replaced is not None:
+                self._mention_cache.move_to_end(text)
+                return replaced
+
+        def replace(match):
+            return mentions.get(match.group(1).lower(), match.group(0))
+
+        replaced = self._re_phab_mention.sub(replace, text)
+
+        with self._mention_cache_lock:
+            self._mention_cache[text] = replaced
+            if len(self._mention_cache) > self._mention_cache_size:
+                self._mention_cache.popitem(last=False)
+        return replaced
+
+    def _get_channels(self, object_type, transaction):
+        """
+            Returns the channels that get the messages about a transaction: by repository for diffs and commits, and
+            by project for tasks.
+        """
+        router = self._router
+        if object_type in ('DREV', 'CMIT'):
+            return router.for_repo(transaction['repo'])
+        if object_type == 'TASK' and router.has_project_rules:
+            return router.for_projects(self._phab_client.get_project_names(transaction['task']))
+        return router.default
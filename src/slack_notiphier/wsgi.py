@@ -0,0 +1,128 @@
+"""
+    WSGI entry point. `create_app` builds the Flask app along with its own WebhookFirehose, so pre-forking servers must
+    call it in every worker after forking. E.g., with gunicorn:
+
+        $ gunicorn --workers 4 --threads 8 'slack_notiphier.wsgi:create_app()'
+
+    `python -m slack_notiphier serve` does the same.
+"""
+
+import atexit
+import json
+
+from flask import Flask, request, abort, make_response, jsonify
+
+from . import logger
+from . import metrics
+from .webhook_firehose import WebhookFirehose
+from .ingest_queue import IngestQueue
+from .signature import SignatureVerifier
+from .config_watcher import ConfigWatcher
+from .config import get_config
+from .logger import Logger
+
+
+_logger = Logger('Main')
+
+
+def create_app():
+    app = Flask('slack_notiphier')
+    # Not left to Flask's MAX_CONTENT_LENGTH, which older Werkzeugs only check when parsing forms
+    max_body_size = get_config('max_body_size', 1048576)
+    handler = WebhookFirehose()
+
+    signature_verifier = SignatureVerifier.from_config()
+
+    # Routing, filters, webhook keys and logging follow changes to the config file, other elements need a restart
+    config_watcher = ConfigWatcher([logger.prepare_reload, handler.prepare_reload, signature_verifier.prepare_reload],
+                                   interval=get_config('config_reload_interval', 10))
+    config_watcher.start()
+
+    if get_config('async_ingest', False):
+        ingest_queue = IngestQueue(handler.handle,
+                                   workers=get_config('ingest_workers', 4),
+                                   max_size=get_config('ingest_queue_size', 1000))
+        # Deliveries in the queue were already acknowledged, Phabricator won't send them again
+        atexit.register(ingest_queue.stop, get_config('ingest_shutdown_timeout', 20))
+    else:
+        ingest_queue = None
+
+    @app.errorhandler(404)
+    def not_found(error):
+        return make_response(jsonify({'error': 'Not found'}), 404)
+
+    @app.errorhandler(413)
+    def too_large(error):
+        _logger.warn("Incoming request was larger than max_body_size: {} bytes", request.content_length)
+        return make_response(jsonify({'error': 'Request too large'}), 413)
+
+    @app.route('/firehose', methods=['POST'])
+    def phab_webhook_firehose():
+        # The body is read once, and the same buffer is checked against the signature and parsed
+        body = _read_body(max_body_size)
+        if body is None:
+            abort(413)
+
+        expected_digest = request.headers.get('X-Phabricator-Webhook-Signature', None)
+        if not signature_verifier.verify(body, expected_digest):
+            if not expected_digest:
+                _logger.warn("Incoming request didn't contain a message signature")
+            else:
+                _logger.warn("Incoming request contained an invalid message signature")
+            abort(400)
+
+        try:
+            delivery = json.loads(body)
+        except ValueError:
+            abort(400)
+
+        if not delivery:
+            abort(400)
+
+        if ingest_queue:
+            if not ingest_queue.put(delivery):
+                _logger.warn("Ingest queue is full, asking Phabricator to retry the delivery later")
+                return make_response("Busy\n", 429, {'Retry-After': str(get_config('ingest_retry_after', 30))})
+            return "OK\n"
+
+        handler.handle(delivery)
+
+        return "OK\n"
+
+    @app.route('/health')
+    def health():
+        return "OK\n"
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return make_response(metrics.render(), 200, {'Content-Type': metrics.content_type})
+
+    @app.route('/stats')
+    def stats():
+        return jsonify(dict(handler.stats(),
+                            ingest_queue=ingest_queue.stats() if ingest_queue else None))
+
+    return app
+
+
+def _read_body(max_size):
+    """
+        Returns the body of the current request, or None if it is larger than `max_size`. Requests announcing a larger
+        body aren't read at all, and no more than `max_size` + 1 bytes are read from the others.
+    """
+    if request.content_length is not None and request.content_length > max_size:
+        return None
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.stream.read(max_size + 1 - size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            return None
+        chunks.append(chunk)
+
+    # Bodies are usually read in a single chunk, which is used as it is
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
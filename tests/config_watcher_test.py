@@ -0,0 +1,117 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import json
+import os
+import signal
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from slack_notiphier import config
+from slack_notiphier.config import get_config
+from slack_notiphier.config_watcher import ConfigWatcher
+from slack_notiphier.routing import ChannelRouter
+
+
+def _config(**elements):
+    return dict({'channels': {'__default__': "_slack_channel_"}}, **elements)
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / "slack-notiphier.cfg"
+    path.write_text(json.dumps(_config(log_level="INFO")))
+
+    previous_config = config._config
+    with patch.dict(os.environ, {'NOTIPHIER_CONFIG_FILE': str(path)}):
+        config.reload()
+        yield path
+    config.swap(previous_config)
+
+
+def _write(path, content):
+    # Modification times can be too coarse to tell quick writes apart, the size changes anyway
+    path.write_text(content if isinstance(content, str) else json.dumps(content))
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_reload_puts_new_config_in_use(config_file):
+    apply = MagicMock()
+    levels = []
+
+    def prepare(new_config):
+        # The new config isn't in use until every reloader built from it
+        levels.append((get_config('log_level'), new_config['log_level']))
+        return apply
+
+    watcher = ConfigWatcher([prepare, prepare], interval=0)
+
+    _write(config_file, _config(log_level="DEBUG"))
+
+    assert watcher.reload()
+    assert get_config('log_level') == "DEBUG"
+    assert levels == [("INFO", "DEBUG"), ("INFO", "DEBUG")]
+    assert apply.call_count == 2
+
+
+@pytest.mark.parametrize("content", [
+    "channels: [",
+    _config(channels={'RepoX': "_slack_channel_x_"}),
+    "!!python/object/apply:os.system ['true']",
+])
+def test_invalid_config_files_are_not_used(config_file, content):
+    reloader = MagicMock()
+    watcher = ConfigWatcher([reloader], interval=0)
+
+    _write(config_file, content)
+
+    assert not watcher.reload()
+    assert get_config('log_level') == "INFO"
+    reloader.assert_not_called()
+
+
+def test_config_is_kept_if_a_reloader_fails(config_file):
+    apply = MagicMock()
+    router = MagicMock()
+    watcher = ConfigWatcher([lambda new_config: apply, ChannelRouter.from_config, router], interval=0)
+
+    _write(config_file, _config(log_level="DEBUG", channels={'__default__': ["_slack_channel_", "_slack_channel_x_"]}))
+
+    assert not watcher.reload()
+    assert get_config('log_level') == "INFO"
+    assert get_config('channels') == {'__default__': "_slack_channel_"}
+    apply.assert_not_called()
+    router.assert_not_called()
+
+
+def test_changes_to_the_file_are_noticed(config_file):
+    watcher = ConfigWatcher([], interval=0.01)
+    watcher.start()
+    try:
+        _write(config_file, _config(log_level="DEBUG"))
+        _wait_for(lambda: get_config('log_level') == "DEBUG")
+    finally:
+        watcher.stop()
+
+
+def test_sighup_reloads(config_file):
+    sighup_handler = signal.getsignal(signal.SIGHUP)
+    watcher = ConfigWatcher([], interval=0)
+    watcher.start()
+    try:
+        # Reloaded even if the file looks the same, e.g. when its modification time was kept
+        config.swap(_config(log_level="ERROR"))
+        os.kill(os.getpid(), signal.SIGHUP)
+        _wait_for(lambda: get_config('log_level') == "INFO")
+    finally:
+        watcher.stop()
+
+    assert signal.getsignal(signal.SIGHUP) == sighup_handler
@@ -0,0 +1,101 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import time
+from unittest.mock import patch
+
+import pytest
+
+from slack_notiphier.debug_channel import DebugChannel
+from slack_notiphier.logger import Logger
+from slack_notiphier.slack_client import SlackClient
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_duplicated_messages_are_summarized():
+    posted = []
+    channel = DebugChannel(posted.append, interval=3600)
+
+    channel.post("No message for: {}", "No message for: task-merge")
+    channel.post("No message for: {}", "No message for: task-close")
+    channel.post("No message for: {}", "No message for: task-close")
+    channel.post("Unknown type: {}", "Unknown type: WIKI")
+
+    _wait_for(lambda: len(posted) == 2)
+    assert posted == ["No message for: task-merge", "Unknown type: WIKI"]
+
+    channel.flush()
+    assert posted[2] == "Debug messages not posted in the last 3600 seconds:\n2 x No message for: {}"
+
+    # A new interval starts after the summary
+    channel.post("No message for: {}", "No message for: task-open")
+    _wait_for(lambda: len(posted) == 4)
+    assert posted[3] == "No message for: task-open"
+
+
+def test_messages_per_interval_are_limited():
+    posted = []
+    channel = DebugChannel(posted.append, interval=3600, max_messages=2)
+
+    for i in range(5):
+        channel.post("Message {}".format(i), "Message {}".format(i))
+
+    _wait_for(lambda: len(posted) == 2)
+    channel.flush()
+    assert posted == ["Message 0", "Message 1",
+                      "Debug messages not posted in the last 3600 seconds:\n1 x Message 2\n1 x Message 3\n1 x Message 4"]
+
+
+def test_messages_are_formatted_only_if_posted():
+    class Message:
+        formatted = 0
+
+        def __str__(self):
+            Message.formatted += 1
+            return "Message"
+
+    posted = []
+    channel = DebugChannel(posted.append, interval=3600)
+    for _ in range(10):
+        channel.post("Message", Message())
+
+    _wait_for(lambda: posted)
+    assert Message.formatted == 1
+
+
+@patch("slackclient.SlackClient")
+@patch.object(Logger, '_slack_debug_callback', None)
+def test_debug_channel_is_reloaded(Slack):
+    Slack.return_value.api_call.return_value = {'ok': True}
+    slack_client = SlackClient()
+    assert Logger._slack_debug_callback is None
+
+    slack_client.prepare_reload({'channels': {'__default__': "#general", '__debug__': "#debug"}})()
+    Logger('Test').slack_debug("Debugging: {}", "on")
+    _wait_for(lambda: Slack.return_value.api_call.call_args and
+              Slack.return_value.api_call.call_args[1]['channel'] == "#debug")
+
+    slack_client.prepare_reload({'channels': {'__default__': "#general"}})()
+    assert Logger._slack_debug_callback is None
+
+
+@patch("slackclient.SlackClient")
+@patch.object(Logger, '_slack_debug_callback', None)
+def test_debug_interval_must_be_positive(Slack):
+    Slack.return_value.api_call.return_value = {'ok': True}
+    slack_client = SlackClient()
+
+    # The posting thread would never sleep otherwise
+    with pytest.raises(ValueError):
+        slack_client.prepare_reload({'channels': {'__default__': "#general", '__debug__': "#debug"},
+                                     'slack_debug_interval': 0})
+    with pytest.raises(ValueError):
+        DebugChannel(print, interval=0)
+    assert Logger._slack_debug_callback is None
+
@@ -0,0 +1,87 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+from slack_notiphier.dedup import SeenTransactions
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 1546300800.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_claim_skips_seen_transactions():
+    seen = SeenTransactions(window=60)
+
+    assert seen.claim(["PHID-XACT-1", "PHID-XACT-2"]) == ["PHID-XACT-1", "PHID-XACT-2"]
+    assert seen.claim(["PHID-XACT-2", "PHID-XACT-3", "PHID-XACT-3"]) == ["PHID-XACT-3"]
+    assert seen.claim(["PHID-XACT-1"]) == []
+
+
+def test_released_transactions_can_be_claimed_again():
+    seen = SeenTransactions(window=60)
+
+    claimed = seen.claim(["PHID-XACT-1", "PHID-XACT-2"])
+    seen.release(claimed)
+
+    assert seen.claim(["PHID-XACT-2"]) == ["PHID-XACT-2"]
+
+
+def test_transactions_are_forgotten_after_the_window():
+    clock = _Clock()
+    seen = SeenTransactions(window=60, clock=clock)
+
+    seen.claim(["PHID-XACT-1"])
+    clock.now += 30
+    seen.claim(["PHID-XACT-2"])
+    clock.now += 31
+
+    assert seen.claim(["PHID-XACT-1", "PHID-XACT-2"]) == ["PHID-XACT-1"]
+
+
+def test_oldest_transactions_are_forgotten_past_max_size():
+    seen = SeenTransactions(window=60, max_size=2)
+
+    seen.claim(["PHID-XACT-1", "PHID-XACT-2", "PHID-XACT-3"])
+
+    assert len(seen) == 2
+    assert seen.claim(["PHID-XACT-1", "PHID-XACT-3"]) == ["PHID-XACT-1"]
+
+
+def test_disabled_window_claims_everything():
+    seen = SeenTransactions(window=0)
+
+    assert seen.claim(["PHID-XACT-1"]) == ["PHID-XACT-1"]
+    assert seen.claim(["PHID-XACT-1"]) == ["PHID-XACT-1"]
+
+
+def test_file_survives_restarts(tmp_path):
+    path = str(tmp_path / "seen.jsonl")
+    seen = SeenTransactions(window=60, path=path)
+    seen.claim(["PHID-XACT-1", "PHID-XACT-2"])
+    seen.release(["PHID-XACT-2"])
+
+    restarted = SeenTransactions(window=60, path=path)
+
+    assert restarted.claim(["PHID-XACT-1", "PHID-XACT-2"]) == ["PHID-XACT-2"]
+
+
+def test_file_is_shared_and_compacted(tmp_path):
+    path = str(tmp_path / "seen.jsonl")
+    clock = _Clock()
+    first = SeenTransactions(window=60, path=path, compact_threshold=4, clock=clock)
+    second = SeenTransactions(window=60, path=path, compact_threshold=4, clock=clock)
+
+    assert first.claim(["PHID-XACT-1"]) == ["PHID-XACT-1"]
+    assert second.claim(["PHID-XACT-1", "PHID-XACT-2"]) == ["PHID-XACT-2"]
+
+    clock.now += 61
+    for i in range(3, 8):
+        first.claim(["PHID-XACT-{}".format(i)])
+
+    # The file was rewritten without the expired transactions, and the other process notices it
+    assert len(open(path).readlines()) < 7
+    assert second.claim(["PHID-XACT-1", "PHID-XACT-7"]) == ["PHID-XACT-1"]
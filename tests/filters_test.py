@@ -0,0 +1,58 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import pytest
+
+from slack_notiphier.filters import TransactionFilter
+
+
+def test_no_filters_allow_everything():
+    transaction_filter = TransactionFilter()
+
+    assert transaction_filter.allows_object_type("DREV")
+    assert transaction_filter.allows_transaction_type("diff-update")
+    assert transaction_filter.allows_repo("Backend")
+    assert transaction_filter.allows_author("PHID-USER-bb", "ph-username-bb")
+    assert not transaction_filter.has_author_rules
+
+
+def test_allow_and_deny():
+    transaction_filter = TransactionFilter({
+        'object_types': {'deny': ["PROJ", "REPO"]},
+        'transaction_types': {'allow': ["diff-*", "task-*"], 'deny': ["diff-update"]},
+        'repos': {'allow': ["Mobile*", "Backend"]},
+    })
+
+    assert transaction_filter.allows_object_type("DREV")
+    assert not transaction_filter.allows_object_type("PROJ")
+
+    assert transaction_filter.allows_transaction_type("diff-create")
+    assert not transaction_filter.allows_transaction_type("diff-update")
+    assert not transaction_filter.allows_transaction_type("commit-add-comment")
+
+    assert transaction_filter.allows_repo("MobileApp")
+    assert transaction_filter.allows_repo("Backend")
+    assert not transaction_filter.allows_repo("Backend-docs")
+
+
+def test_authors_by_phid_or_username():
+    transaction_filter = TransactionFilter({'authors': {'deny': ["ci-bot", "PHID-USER-aa"]}})
+
+    assert transaction_filter.has_author_rules
+    assert transaction_filter.allows_author("PHID-USER-bb", "ph-username-bb")
+    assert not transaction_filter.allows_author("PHID-USER-cc", "ci-bot")
+    assert not transaction_filter.allows_author("PHID-USER-aa", None)
+
+    transaction_filter = TransactionFilter({'authors': {'allow': ["ph-username-*"]}})
+
+    assert transaction_filter.allows_author("PHID-USER-bb", "ph-username-bb")
+    assert not transaction_filter.allows_author("PHID-USER-zz", None)
+
+
+def test_invalid_filters():
+    with pytest.raises(ValueError):
+        TransactionFilter({'users': {'deny': ["ci-bot"]}})
+    with pytest.raises(ValueError):
+        TransactionFilter({'repos': {'block': ["Backend"]}})
+    with pytest.raises(ValueError):
+        TransactionFilter({'repos': {'deny': "Backend"}})
@@ -0,0 +1,97 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import threading
+import time
+
+import pytest
+
+from slack_notiphier.ingest_queue import IngestQueue
+
+
+def test_deliveries_are_processed_in_background():
+    processed = []
+    ingest_queue = IngestQueue(processed.append, workers=2, max_size=10)
+
+    for i in range(5):
+        assert ingest_queue.put({'delivery': i})
+
+    ingest_queue.join()
+    ingest_queue.stop()
+
+    assert sorted(d['delivery'] for d in processed) == [0, 1, 2, 3, 4]
+
+    stats = ingest_queue.stats()
+    assert stats['depth'] == 0
+    assert stats['enqueued'] == 5
+    assert stats['processed'] == 5
+    assert stats['rejected'] == 0
+    assert stats['failed'] == 0
+
+
+def test_full_queue_rejects_deliveries():
+    release = threading.Event()
+    ingest_queue = IngestQueue(lambda request: release.wait(), workers=1, max_size=1)
+
+    # The first delivery occupies the only worker, the second one fills the queue
+    assert ingest_queue.put({'delivery': 1})
+    while ingest_queue.stats()['depth']:
+        time.sleep(0.001)
+    assert ingest_queue.put({'delivery': 2})
+    assert not ingest_queue.put({'delivery': 3})
+
+    release.set()
+    ingest_queue.join()
+    ingest_queue.stop()
+
+    stats = ingest_queue.stats()
+    assert stats['rejected'] == 1
+    assert stats['processed'] == 2
+
+
+def test_failed_deliveries_are_counted():
+    def failing_handler(request):
+        raise ValueError("Boom")
+
+    ingest_queue = IngestQueue(failing_handler, workers=1, max_size=10)
+    assert ingest_queue.put({'delivery': 1})
+    ingest_queue.join()
+    ingest_queue.stop()
+
+    stats = ingest_queue.stats()
+    assert stats['failed'] == 1
+    assert stats['processed'] == 0
+
+
+def test_stop_processes_queued_deliveries():
+    processed = []
+    ingest_queue = IngestQueue(lambda request: (time.sleep(0.01), processed.append(request)), workers=1, max_size=10)
+
+    for i in range(5):
+        assert ingest_queue.put({'delivery': i})
+
+    assert ingest_queue.stop(timeout=5)
+    assert len(processed) == 5
+    assert not ingest_queue.put({'delivery': 5})
+
+
+def test_stop_gives_up_after_timeout():
+    release = threading.Event()
+    ingest_queue = IngestQueue(lambda request: release.wait(), workers=1, max_size=1)
+    assert ingest_queue.put({'delivery': 1})
+    while ingest_queue.stats()['depth']:
+        time.sleep(0.001)
+    assert ingest_queue.put({'delivery': 2})
+
+    started_at = time.monotonic()
+    assert not ingest_queue.stop(timeout=0.1)
+    assert time.monotonic() - started_at < 1
+
+    release.set()
+    assert ingest_queue.stop(timeout=5)
+    assert ingest_queue.stats()['processed'] == 2
+
+
+def test_needs_at_least_one_worker():
+    with pytest.raises(ValueError):
+        IngestQueue(lambda request: None, workers=0)
@@ -0,0 +1,67 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+from slack_notiphier.invalidation_log import InvalidationLog
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 1546300800.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_are_read_by_other_processes(tmp_path):
+    clock = _Clock()
+    path = str(tmp_path / "invalidations.jsonl")
+    first = InvalidationLog(path, clock=clock)
+    second = InvalidationLog(path, clock=clock)
+
+    first.append("PHID-TASK-1")
+    clock.now += 5
+    first.append("PHID-REPO-1")
+    clock.now += 10
+
+    assert second.read_new() == [("PHID-TASK-1", 15), ("PHID-REPO-1", 10)]
+    assert second.read_new() == []
+    assert first.read_new() == []
+
+    second.append("PHID-TASK-2")
+    assert first.read_new() == [("PHID-TASK-2", 0)]
+
+
+def test_lines_being_written_are_read_later(tmp_path):
+    clock = _Clock()
+    path = tmp_path / "invalidations.jsonl"
+    log = InvalidationLog(str(path), clock=clock)
+
+    with open(str(path), 'a') as fp:
+        fp.write('{"phid": "PHID-TASK-1", "at": 1546300800.0}\n{"phid": "PHID-TA')
+    assert log.read_new() == [("PHID-TASK-1", 0)]
+
+    with open(str(path), 'a') as fp:
+        fp.write('SK-2", "at": 1546300800.0}\n')
+    assert log.read_new() == [("PHID-TASK-2", 0)]
+
+
+def test_old_entries_are_compacted(tmp_path):
+    clock = _Clock()
+    path = tmp_path / "invalidations.jsonl"
+    first = InvalidationLog(str(path), window=60, compact_threshold=4, clock=clock)
+    second = InvalidationLog(str(path), window=60, compact_threshold=4, clock=clock)
+
+    for i in range(3):
+        first.append("PHID-TASK-{}".format(i))
+    assert len(second.read_new()) == 3
+
+    clock.now += 61
+    first.append("PHID-TASK-3")
+
+    assert path.read_text().count("\n") == 1
+    # The rewritten file is read again, and appended to instead of the old one
+    assert second.read_new() == [("PHID-TASK-3", 0)]
+    second.append("PHID-TASK-4")
+    assert first.read_new() == [("PHID-TASK-4", 0)]
+    assert path.read_text().count("\n") == 2
@@ -0,0 +1,39 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import json
+import logging
+from unittest.mock import MagicMock
+
+from slack_notiphier.logger import Logger, _JsonFormatter, _TextFormatter
+
+
+def test_disabled_messages_are_not_formatted(caplog):
+    logger = Logger('LoggerTest')
+    expensive = MagicMock(return_value="expensive")
+
+    with caplog.at_level(logging.INFO):
+        logger.debug("Value: {}", expensive)
+    expensive.assert_not_called()
+    assert not caplog.records
+
+    with caplog.at_level(logging.DEBUG):
+        logger.debug("Value: {}", expensive)
+    expensive.assert_called_once_with()
+    assert caplog.records[0].getMessage() == "Value: expensive"
+
+
+def test_text_format_without_colors():
+    record = logging.LogRecord('LoggerTest', logging.INFO, __file__, 1, "Plain message", None, None)
+
+    assert _TextFormatter(use_colors=False).format(record) == "Plain message"
+
+
+def test_json_format():
+    record = logging.LogRecord('LoggerTest', logging.WARN, __file__, 1, "Some message", None, None)
+
+    entry = json.loads(_JsonFormatter().format(record))
+    assert entry['level'] == 'WARNING'
+    assert entry['logger'] == 'LoggerTest'
+    assert entry['message'] == "Some message"
+    assert entry['time'].endswith('Z')
@@ -0,0 +1,63 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import threading
+
+from slack_notiphier.message_digest import MessageDigest
+
+
+class _Recorder:
+
+    def __init__(self):
+        self.sent = []
+        self.event = threading.Event()
+
+    def __call__(self, messages):
+        self.sent.append([m['text'] for m in messages])
+        self.event.set()
+
+
+def test_messages_are_sent_right_away_without_window():
+    recorder = _Recorder()
+    digest = MessageDigest(recorder, window=0)
+
+    digest.add(('PHID-DREV-1', '#general'), {'text': "One"})
+    digest.add(('PHID-DREV-1', '#general'), {'text': "Two"})
+
+    assert recorder.sent == [["One"], ["Two"]]
+
+
+def test_messages_are_merged_per_object_and_channel():
+    recorder = _Recorder()
+    digest = MessageDigest(recorder, window=3600)
+
+    digest.add(('PHID-DREV-1', '#general'), {'text': "One"})
+    digest.add(('PHID-TASK-1', '#general'), {'text': "Task"})
+    digest.add(('PHID-DREV-1', '#other'), {'text': "Other channel"})
+    digest.add(('PHID-DREV-1', '#general'), {'text': "Two"})
+    assert recorder.sent == []
+
+    digest.flush()
+    assert recorder.sent == [["One", "Two"], ["Task"], ["Other channel"]]
+
+
+def test_digest_is_sent_when_full():
+    recorder = _Recorder()
+    digest = MessageDigest(recorder, window=3600, max_messages=2)
+
+    digest.add(('PHID-DREV-1', '#general'), {'text': "One"})
+    digest.add(('PHID-DREV-1', '#general'), {'text': "Two"})
+    digest.add(('PHID-DREV-1', '#general'), {'text': "Three"})
+
+    assert recorder.sent == [["One", "Two"]]
+
+
+def test_digest_is_sent_when_window_ends():
+    recorder = _Recorder()
+    digest = MessageDigest(recorder, window=0.05)
+
+    digest.add(('PHID-DREV-1', '#general'), {'text': "One"})
+    digest.add(('PHID-DREV-1', '#general'), {'text': "Two"})
+
+    assert recorder.event.wait(5)
+    assert recorder.sent == [["One", "Two"]]
@@ -1,17 +1,22 @@
 # Execute with:
 #   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
 
+import asyncio
 import json
 from unittest.mock import patch
 
 import pytest
 
+from slack_notiphier import config, metrics
+from slack_notiphier.filters import TransactionFilter
+from slack_notiphier.routing import ChannelRouter
 from slack_notiphier.webhook_firehose import WebhookFirehose
 
 
 @patch("slackclient.SlackClient")
 @patch("phabricator.Phabricator")
-def _execute_test_from_file(test_filename, Phabricator, Slack, users):
+def _execute_test_from_file(test_filename, Phabricator, Slack, users, repeat=1, use_async=False, posts=True,
+                            between=None):
     with open("../tests/resources/" + test_filename, 'r') as fp_test_spec:
         test_spec = json.load(fp_test_spec)
 
@@ -30,6 +35,7 @@ def _execute_test_from_file(test_filename, Phabricator, Slack, users):
                                                                                 test_spec["mocked_phab_calls"])
         instance_phab.diffusion.querycommits.side_effect = _mock_phab_call("diffusion.querycommits",
                                                                            test_spec["mocked_phab_calls"])
+        instance_phab.phid.query.side_effect = _mock_phab_call("phid.query", test_spec["mocked_phab_calls"])
 
         # Mock Slack calls
         instance_slack = Slack.return_value
@@ -40,9 +46,16 @@ def _execute_test_from_file(test_filename, Phabricator, Slack, users):
         # Process the message from the file as if it came from Phabricator's Firehose. It then asserts Slack was
         # invoked with the right message.
         try:
-            webhook.handle(test_spec["request"])
-
-            for expected in test_spec["expected_responses"]:
+            for i in range(repeat):
+                # Another delivery handled between repetitions
+                if i and between:
+                    webhook.handle(between)
+                if use_async:
+                    asyncio.get_event_loop().run_until_complete(webhook.handle_async(test_spec["request"]))
+                else:
+                    webhook.handle(test_spec["request"])
+
+            for expected in test_spec["expected_responses"] if posts else []:
                 instance_slack.api_call.assert_any_call("chat.postMessage",
                                                         channel=expected['channel'],
                                                         attachments=expected['attachments'])
@@ -51,6 +64,8 @@ def _execute_test_from_file(test_filename, Phabricator, Slack, users):
             print("Exception in test. Some information about attempted Slack calls:", instance_slack.mock_calls)
             raise e
 
+        return instance_phab, instance_slack
+
 
 def _mock_phab_call(method, mocked_phab_calls):
 
@@ -117,6 +132,8 @@ def test_welcome_message(Phabricator, Slack, users):
     "task-add-comment-own.json",
     "task-claim.json",
     "task-assign.json",
+    "task-assign-not-in-slack.json",
+    "task-assign-by-herald.json",
     "task-change-priority.json",
     "task-change-priority-own.json",
     "task-change-status.json",
@@ -130,6 +147,10 @@ def test_tasks(task_test_file, users):
     _execute_test_from_file(task_test_file, users=users)
 
 
+def test_tasks_async(task_test_file, users):
+    _execute_test_from_file(task_test_file, users=users, use_async=True)
+
+
 # Diff Revision Tests
 
 
@@ -156,6 +177,10 @@ def test_diffs(diff_test_file, users):
     _execute_test_from_file(diff_test_file, users=users)
 
 
+def test_diffs_async(diff_test_file, users):
+    _execute_test_from_file(diff_test_file, users=users, use_async=True)
+
+
 # Commit Tests
 
 
@@ -196,3 +221,194 @@ def repo_test_file(request):
 
 def test_repos(repo_test_file, users):
     _execute_test_from_file(repo_test_file, users=users)
+
+
+# Mention tests
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_replace_mentions(Phabricator, Slack, users):
+    Phabricator.return_value.user.search.return_value = users['phab']
+    Slack.return_value.api_call.side_effect = _mock_slack_api_call(users['slack'])
+
+    webhook = WebhookFirehose()
+
+    assert webhook._replace_mentions("Thanks @ph-username-bb and @PH-USERNAME-CC.") == \
+        "Thanks <@SLACK-ID-bb> and <@SLACK-ID-cc>."
+    # Unknown users and usernames that only start like a known one are left as they are
+    assert webhook._replace_mentions("@ph-username-bb, @ph-username-bbb and @nobody") == \
+        "<@SLACK-ID-bb>, @ph-username-bbb and @nobody"
+    assert webhook._replace_mentions("Mail me at someone@ph-username-bb.com") == \
+        "Mail me at someone@ph-username-bb.com"
+    # Memoized results are still right
+    assert webhook._replace_mentions("Thanks @ph-username-bb and @PH-USERNAME-CC.") == \
+        "Thanks <@SLACK-ID-bb> and <@SLACK-ID-cc>."
+
+
+# Routing tests
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_messages_fan_out_to_channels(users, use_async):
+    router = ChannelRouter({'__default__': "_slack_channel_x_", 'Repo *': ["_slack_channel_", "_slack_channel_y_"]})
+    with patch.object(ChannelRouter, 'from_config', return_value=router):
+        _, instance_slack = _execute_test_from_file("diff-add-comment.json", users=users, use_async=use_async)
+
+    channels = [c[1]['channel'] for c in instance_slack.api_call.call_args_list if c[0][0] == "chat.postMessage"]
+    # The welcome message goes to the default channel, the messages about the diff to both channels of its repo
+    assert channels.count("_slack_channel_") == 2
+    assert channels.count("_slack_channel_y_") == 1
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_routing_and_filters_are_reloaded(Phabricator, Slack, users):
+    Phabricator.return_value.user.search.return_value = users['phab']
+    Slack.return_value.api_call.side_effect = _mock_slack_api_call(users['slack'])
+
+    webhook = WebhookFirehose()
+    apply = webhook.prepare_reload({
+        'channels': {'__default__': "_slack_channel_new_", 'RepoY': "_slack_channel_y_"},
+        'filters': {'object_types': {'deny': ["PROJ"]}},
+    })
+
+    assert webhook._get_channels("DREV", {'repo': "RepoY"}) == ("_slack_channel_",)
+    apply()
+    assert webhook._get_channels("DREV", {'repo': "RepoY"}) == ("_slack_channel_y_",)
+    assert webhook._get_channels("DREV", {'repo': "RepoX"}) == ("_slack_channel_new_",)
+
+    webhook.handle({'object': {'type': "PROJ", 'phid': "PHID-PROJ-1"}, 'transactions': [{'phid': "PHID-XACT-PROJ-1"}]})
+    Phabricator.return_value.transaction.search.assert_not_called()
+
+    # Messages without a channel, e.g. about errors, go to the new default channel too
+    webhook._slack_client.send_message({'text': "Error", 'type': 'error'})
+    assert Slack.return_value.api_call.call_args[1]['channel'] == "_slack_channel_new_"
+
+
+# Filter tests
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_unknown_object_types_are_ignored(Phabricator, Slack, users):
+    Phabricator.return_value.user.search.return_value = users['phab']
+    Slack.return_value.api_call.side_effect = _mock_slack_api_call(users['slack'])
+
+    webhook = WebhookFirehose()
+    webhook.handle({'object': {'type': "USER", 'phid': "PHID-USER-bb"}, 'transactions': [{'phid': "PHID-XACT-USER-1"}]})
+
+    Phabricator.return_value.transaction.search.assert_not_called()
+
+
+def _filtered(filters, test_filename, users):
+    with patch.object(TransactionFilter, 'from_config', return_value=TransactionFilter(filters)):
+        instance_phab, instance_slack = _execute_test_from_file(test_filename, users=users, posts=False)
+
+    posts = [c for c in instance_slack.api_call.call_args_list if c[0][0] == "chat.postMessage"]
+    # Only the welcome message
+    assert len(posts) == 1
+    return instance_phab
+
+
+def test_denied_object_types_are_not_looked_up(users):
+    instance_phab = _filtered({'object_types': {'deny': ["DREV"]}}, "diff-add-comment.json", users)
+
+    instance_phab.transaction.search.assert_not_called()
+
+
+def test_denied_object_types_still_discard_cached_objects(users):
+    # Diffs are routed by the name of their repository, so it is fetched again after any change to it, even if events
+    # about repositories are denied
+    rename = {'object': {'type': "REPO", 'phid': "PHID-REPO-2bdkr2te4eqaopwszp57"},
+              'transactions': [{'phid': "PHID-XACT-REPO-1"}]}
+    with patch.object(TransactionFilter, 'from_config',
+                      return_value=TransactionFilter({'object_types': {'deny': ["REPO"]}})), \
+            patch.dict(config._config, {'dedup_window': 0}):
+        instance_phab, _ = _execute_test_from_file("diff-add-comment.json", users=users, repeat=2, between=rename)
+
+    assert instance_phab.transaction.search.call_count == 2
+    assert instance_phab.differential.revision.search.call_count == 1
+    assert instance_phab.diffusion.repository.search.call_count == 2
+
+
+def test_denied_transaction_types_are_not_looked_up(users):
+    instance_phab = _filtered({'transaction_types': {'allow': ["diff-create", "task-*"]}}, "diff-add-comment.json",
+                              users)
+
+    assert instance_phab.transaction.search.call_count == 1
+    instance_phab.differential.revision.search.assert_not_called()
+    instance_phab.diffusion.repository.search.assert_not_called()
+
+
+def test_denied_authors_are_not_looked_up(users):
+    instance_phab = _filtered({'authors': {'deny': ["ph-username-bb"]}}, "diff-add-comment.json", users)
+
+    instance_phab.differential.revision.search.assert_not_called()
+
+
+def test_denied_repos_are_not_posted(users):
+    instance_phab = _filtered({'repos': {'deny': ["Repo *"]}}, "diff-add-comment.json", users)
+
+    assert instance_phab.diffusion.repository.search.call_count == 1
+
+
+# Conduit usage tests
+
+
+def test_diff_objects_are_fetched_once(users):
+    instance_phab, _ = _execute_test_from_file("diff-add-comment.json", users=users)
+
+    assert instance_phab.differential.revision.search.call_count == 1
+    assert instance_phab.diffusion.repository.search.call_count == 1
+
+
+def test_task_objects_are_fetched_once(users):
+    instance_phab, _ = _execute_test_from_file("task-add-comment.json", users=users)
+
+    assert instance_phab.maniphest.search.call_count == 1
+
+
+def test_objects_are_cached_across_requests(users):
+    # Repeated deliveries would be skipped otherwise
+    with patch.dict(config._config, {'dedup_window': 0}):
+        instance_phab, _ = _execute_test_from_file("diff-add-comment.json", users=users, repeat=3)
+
+    assert instance_phab.transaction.search.call_count == 3
+    assert instance_phab.differential.revision.search.call_count == 1
+    assert instance_phab.diffusion.repository.search.call_count == 1
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_retried_deliveries_are_skipped(users, use_async):
+    instance_phab, instance_slack = _execute_test_from_file("diff-add-comment.json", users=users, repeat=3,
+                                                            use_async=use_async)
+
+    assert instance_phab.transaction.search.call_count == 1
+    posts = [c for c in instance_slack.api_call.call_args_list if c[0][0] == "chat.postMessage"]
+    # The welcome message and the comment
+    assert len(posts) == 2
+
+
+def test_async_objects_are_fetched_once(users):
+    instance_phab, _ = _execute_test_from_file("diff-add-comment.json", users=users, use_async=True)
+
+    assert instance_phab.differential.revision.search.call_count == 1
+    assert instance_phab.diffusion.repository.search.call_count == 1
+
+
+def test_stages_are_measured(users):
+    before = metrics.render()
+    _execute_test_from_file("diff-add-comment.json", users=users)
+    after = metrics.render()
+
+    for line in ['notiphier_conduit_request_seconds_count{method="transaction.search"}',
+                 'notiphier_conduit_request_seconds_count{method="differential.revision.search"}',
+                 'notiphier_render_seconds_count{object_type="DREV"}',
+                 'notiphier_slack_post_message_seconds_count',
+                 'notiphier_user_lookups_total{result="hit"}']:
+        assert _metric_value(after, line) > _metric_value(before, line), line
+
+
+def _metric_value(rendered, prefix):
+    return next((float(line.rsplit(' ', 1)[1]) for line in rendered.splitlines() if line.startswith(prefix + ' ')), 0)
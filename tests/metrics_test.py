@@ -0,0 +1,69 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import pytest
+
+from slack_notiphier.metrics import Counter, Histogram, Registry
+
+
+def test_counter():
+    counter = Counter('test_requests_total', "Requests.", labels=('endpoint',))
+    counter.inc(endpoint='/firehose')
+    counter.inc(2, endpoint='/firehose')
+    counter.inc(endpoint='/health')
+
+    assert counter.get(endpoint='/firehose') == 3
+    assert counter.render() == [
+        '# HELP test_requests_total Requests.',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{endpoint="/firehose"} 3',
+        'test_requests_total{endpoint="/health"} 1',
+    ]
+
+
+def test_histogram():
+    histogram = Histogram('test_latency_seconds', "Latency.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert histogram.get_count() == 3
+    assert histogram.render() == [
+        '# HELP test_latency_seconds Latency.',
+        '# TYPE test_latency_seconds histogram',
+        'test_latency_seconds_bucket{le="0.1"} 1',
+        'test_latency_seconds_bucket{le="1"} 2',
+        'test_latency_seconds_bucket{le="+Inf"} 3',
+        'test_latency_seconds_sum 5.55',
+        'test_latency_seconds_count 3',
+    ]
+
+
+def test_histogram_times_blocks():
+    histogram = Histogram('test_block_seconds', "Block.", labels=('name',))
+
+    with pytest.raises(ValueError):
+        with histogram.time(name='failing'):
+            raise ValueError("Boom")
+
+    assert histogram.get_count(name='failing') == 1
+
+
+def test_labels_are_checked_and_escaped():
+    counter = Counter('test_labels_total', "Labels.", labels=('name',))
+
+    with pytest.raises(ValueError):
+        counter.inc(other="x")
+
+    counter.inc(name='quote " and \\ back\nslash')
+    assert counter.render()[-1] == 'test_labels_total{name="quote \\" and \\\\ back\\nslash"} 1'
+
+
+def test_registry_rejects_duplicates():
+    registry = Registry()
+    registry.register(Counter('test_total', "Test."))
+
+    with pytest.raises(ValueError):
+        registry.register(Counter('test_total', "Test."))
+
+    assert registry.render().startswith("# HELP test_total Test.\n")
@@ -0,0 +1,170 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+from slack_notiphier.object_cache import ObjectCache
+
+
+class _FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_and_put():
+    cache = ObjectCache()
+    cache.put('PHID-TASK-1', {'id': 1})
+
+    assert cache.get('PHID-TASK-1') == {'id': 1}
+    assert cache.get('PHID-TASK-2') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 1
+
+
+def test_least_recently_used_is_evicted():
+    cache = ObjectCache(max_size=2)
+    cache.put('PHID-TASK-1', {'id': 1})
+    cache.put('PHID-TASK-2', {'id': 2})
+    cache.get('PHID-TASK-1')
+    cache.put('PHID-TASK-3', {'id': 3})
+
+    assert cache.get('PHID-TASK-1') == {'id': 1}
+    assert cache.get('PHID-TASK-2') is None
+    assert cache.get('PHID-TASK-3') == {'id': 3}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl_per_object_type():
+    clock = _FakeClock()
+    cache = ObjectCache(ttls={'TASK': 10, 'REPO': 100}, clock=clock)
+    cache.put('PHID-TASK-1', {'id': 1})
+    cache.put('PHID-REPO-1', {'id': 1})
+
+    clock.now = 50
+    assert cache.get('PHID-TASK-1') is None
+    assert cache.get('PHID-REPO-1') == {'id': 1}
+
+    clock.now = 100
+    assert cache.get('PHID-REPO-1') is None
+    assert cache.stats()['expirations'] == 2
+
+
+def test_invalidate():
+    cache = ObjectCache()
+    cache.put('PHID-DREV-1', {'id': 1})
+    cache.invalidate('PHID-DREV-1')
+    cache.invalidate('PHID-DREV-2')
+
+    assert cache.get('PHID-DREV-1') is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_disabled_cache():
+    cache = ObjectCache(max_size=0)
+    cache.put('PHID-TASK-1', {'id': 1})
+    assert cache.get('PHID-TASK-1') is None
+
+    cache = ObjectCache(ttls={'TASK': 0})
+    cache.put('PHID-TASK-1', {'id': 1})
+    assert cache.get('PHID-TASK-1') is None
+
+
+def test_save_and_load(tmp_path):
+    clock = _FakeClock()
+    cache = ObjectCache(ttls={'TASK': 10, 'REPO': 100}, clock=clock)
+    cache.put('PHID-TASK-1', {'id': 1})
+    cache.put('PHID-REPO-1', {'id': 2})
+    cache.put('PHID-REPO-2', {'id': 3})
+    clock.now = 20
+
+    snapshot_file = str(tmp_path / "objects.jsonl")
+    cache.save(snapshot_file)
+
+    restored = ObjectCache(clock=clock)
+    assert restored.load(snapshot_file) == 2
+    assert restored.get('PHID-TASK-1') is None
+    assert restored.get('PHID-REPO-2') == {'id': 3}
+
+    clock.now = 100
+    assert restored.get('PHID-REPO-1') is None
+
+
+def test_saves_are_merged(tmp_path):
+    # E.g. several workers saving their caches when exiting
+    snapshot_file = str(tmp_path / "objects.jsonl")
+    first = ObjectCache()
+    first.put('PHID-TASK-1', {'id': 1})
+    first.put('PHID-TASK-2', {'id': 2})
+    second = ObjectCache()
+    second.put('PHID-TASK-2', {'id': 2, 'name': "Renamed"})
+    second.put('PHID-TASK-3', {'id': 3})
+
+    first.save(snapshot_file)
+    second.save(snapshot_file)
+
+    restored = ObjectCache()
+    assert restored.load(snapshot_file) == 3
+    assert restored.get('PHID-TASK-1') == {'id': 1}
+    assert restored.get('PHID-TASK-2') == {'id': 2, 'name': "Renamed"}
+    assert restored.get('PHID-TASK-3') == {'id': 3}
+
+
+def test_invalidated_records_are_not_saved_back(tmp_path):
+    snapshot_file = str(tmp_path / "objects.jsonl")
+    clock = _FakeClock()
+    first = ObjectCache(clock=clock)
+    second = ObjectCache(clock=clock)
+    for cache in (first, second):
+        cache.put('PHID-TASK-1', {'id': 1})
+        cache.put('PHID-TASK-2', {'id': 2})
+    first.save(snapshot_file)
+
+    # The first worker handles renames of both tasks, and then the second worker fetches the second task again
+    clock.now = 10
+    first.invalidate('PHID-TASK-1')
+    first.invalidate('PHID-TASK-2')
+    first.save(snapshot_file)
+    clock.now = 20
+    second.put('PHID-TASK-2', {'id': 2, 'name': "Renamed"})
+    second.save(snapshot_file)
+
+    assert second.get('PHID-TASK-1') is None
+    assert second.get('PHID-TASK-2') == {'id': 2, 'name': "Renamed"}
+
+    restored = ObjectCache(clock=clock)
+    assert restored.load(snapshot_file) == 1
+    assert restored.get('PHID-TASK-1') is None
+    assert restored.get('PHID-TASK-2') == {'id': 2, 'name': "Renamed"}
+
+    # Copies saved before the tombstones are discarded too
+    first.put('PHID-TASK-1', {'id': 1, 'name': "Renamed"})
+    first.save(snapshot_file)
+    restored = ObjectCache(clock=clock)
+    assert restored.load(snapshot_file) == 2
+    assert restored.get('PHID-TASK-1') == {'id': 1, 'name': "Renamed"}
+
+
+def test_invalidations_are_shared(tmp_path):
+    # E.g. several workers, only one of them handling the transaction that renamed a repository
+    invalidations_file = str(tmp_path / "invalidations.jsonl")
+    first = ObjectCache()
+    second = ObjectCache()
+    for cache in (first, second):
+        cache.share_invalidations(invalidations_file)
+        cache.put('PHID-REPO-1', {'id': 1, 'name': "Old"})
+        cache.put('PHID-REPO-2', {'id': 2})
+
+    first.invalidate('PHID-REPO-1')
+
+    assert second.get('PHID-REPO-1') is None
+    assert second.get('PHID-REPO-2') == {'id': 2}
+
+    # Fetched again after the rename
+    second.put('PHID-REPO-1', {'id': 1, 'name': "New"})
+    assert second.get('PHID-REPO-1') == {'id': 1, 'name': "New"}
+    assert first.get('PHID-REPO-1') is None
@@ -0,0 +1,134 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from slack_notiphier.outbox import Outbox
+from slack_notiphier.slack_sender import SlackSender
+
+
+def test_pending_messages_survive_reopening(tmp_path):
+    path = str(tmp_path / "outbox.log")
+
+    outbox = Outbox(path)
+    first = outbox.append("#general", [{'text': "One"}])
+    second = outbox.append("#other", [{'text': "Two"}])
+    outbox.append("#general", [{'text': "Three"}])
+    outbox.ack(first)
+    outbox.close()
+
+    reopened = Outbox(path)
+    pending = reopened.pending()
+    assert [m['attachments'][0]['text'] for m in pending] == ["Two", "Three"]
+    assert pending[0] == {'id': second, 'channel': "#other", 'attachments': [{'text': "Two"}]}
+
+    # New messages don't reuse the ids of the pending ones
+    assert reopened.append("#general", [{'text': "Four"}]) > pending[-1]['id']
+
+
+def test_truncated_line_is_ignored(tmp_path):
+    path = tmp_path / "outbox.log"
+    path.write_text('{"id": 1, "channel": "#general", "attachments": []}\n{"ack": 1}\n{"id": 2, "chan')
+
+    assert Outbox(str(path)).pending() == []
+
+
+def test_log_is_compacted(tmp_path):
+    path = tmp_path / "outbox.log"
+
+    outbox = Outbox(str(path), sync_interval=0, compact_threshold=2)
+    ids = [outbox.append("#general", [{'text': str(i)}]) for i in range(3)]
+    outbox.ack(ids[0])
+    outbox.ack(ids[1])
+    outbox.close()
+
+    assert len(path.read_text().splitlines()) == 1
+
+
+def test_sender_acknowledges_confirmed_messages(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.log"))
+    api_call = MagicMock(side_effect=[
+        {'ok': True},
+        {'ok': False, 'error': 'channel_not_found'},
+        {'ok': False, 'error': 'internal_error'},
+    ])
+    sender = SlackSender(api_call, max_retries=0, outbox=outbox)
+
+    sender.send("#general", [{'text': "Sent"}])
+    sender.send("#missing", [{'text': "Rejected"}])
+    sender.send("#general", [{'text': "Failed"}])
+
+    assert [m['attachments'][0]['text'] for m in outbox.pending()] == ["Failed"]
+
+
+def test_sender_acknowledges_messages_dropped_from_a_full_queue(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.log"))
+    api_call = MagicMock(return_value={'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '60'}})
+    sender = SlackSender(api_call, background=True, queue_size=1, outbox=outbox)
+
+    sender.send("#general", [{'text': "Queued"}])
+    sender.send("#general", [{'text': "Dropped"}])
+
+    assert sender.stats()['dropped'] == 1
+    assert [m['attachments'][0]['text'] for m in outbox.pending()] == ["Queued"]
+
+
+def test_sender_keeps_sending_if_the_outbox_fails(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.log"))
+    api_call = MagicMock(return_value={'ok': True})
+    sender = SlackSender(api_call, background=True, outbox=outbox)
+
+    with patch.object(outbox, 'ack', side_effect=OSError("No space left on device")):
+        sender.send("#general", [{'text': "One"}])
+        sender.send("#general", [{'text': "Two"}])
+        assert sender.flush(timeout=5)
+
+    assert api_call.call_count == 2
+    assert sender.stats()['sent'] == 2
+
+
+def test_sender_replays_pending_messages(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    outbox = Outbox(path)
+    outbox.append("#general", [{'text': "Never sent"}])
+    outbox.close()
+
+    outbox = Outbox(path)
+    api_call = MagicMock(return_value={'ok': True})
+    sender = SlackSender(api_call, outbox=outbox)
+
+    assert sender.flush(timeout=5)
+    api_call.assert_called_once_with("chat.postMessage", channel="#general", attachments=[{'text': "Never sent"}])
+    assert outbox.pending() == []
+
+
+def test_replaying_does_not_hold_up_startup(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    outbox = Outbox(path)
+    for i in range(3):
+        outbox.append("#general", [{'text': "Never sent {}".format(i)}])
+    outbox.close()
+
+    slack_is_up = threading.Event()
+    api_call = MagicMock(side_effect=lambda *args, **kwargs: {'ok': slack_is_up.wait(5)})
+    sender = SlackSender(api_call, outbox=Outbox(path))
+
+    # Slack doesn't answer until now, but the sender is already usable
+    assert not sender.flush(timeout=0.01)
+    slack_is_up.set()
+    assert sender.flush(timeout=5)
+    assert api_call.call_count == 3
+
+
+def test_outbox_is_open_in_a_single_process(tmp_path):
+    path = str(tmp_path / "outbox.log")
+    outbox = Outbox(path)
+
+    with pytest.raises(BlockingIOError):
+        Outbox(path)
+
+    outbox.close()
+    Outbox(path).close()
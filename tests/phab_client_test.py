@@ -0,0 +1,102 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+from unittest.mock import patch
+
+from slack_notiphier.phab_client import PhabClient
+
+
+def _task(phid, task_id, owner, projects=()):
+    return {
+        'id': task_id,
+        'phid': phid,
+        'fields': {
+            'name': "Task {}".format(task_id),
+            'ownerPHID': owner,
+        },
+        'attachments': {
+            'projects': {'projectPHIDs': list(projects)},
+        },
+    }
+
+
+def _diff(phid, diff_id, repo):
+    return {
+        'id': diff_id,
+        'phid': phid,
+        'fields': {
+            'title': "Diff {}".format(diff_id),
+            'authorPHID': "PHID-USER-bb",
+            'repositoryPHID': repo,
+        },
+    }
+
+
+def _repo(phid, repo_id):
+    return {
+        'id': repo_id,
+        'phid': phid,
+        'fields': {
+            'name': "Repo {}".format(repo_id),
+        },
+    }
+
+
+@patch("phabricator.Phabricator")
+def test_prefetch_batches_objects_by_type(Phabricator):
+
+    instance = Phabricator.return_value
+    instance.maniphest.search.return_value = {'data': [_task("PHID-TASK-1", 1, "PHID-USER-bb"),
+                                                       _task("PHID-TASK-2", 2, None)]}
+    instance.differential.revision.search.return_value = {'data': [_diff("PHID-DREV-1", 1, "PHID-REPO-1"),
+                                                                   _diff("PHID-DREV-2", 2, "PHID-REPO-2")]}
+    instance.diffusion.repository.search.return_value = {'data': [_repo("PHID-REPO-1", 1),
+                                                                  _repo("PHID-REPO-2", 2)]}
+
+    phab_client = PhabClient()
+    with phab_client.request_scope():
+        phab_client.prefetch(["PHID-TASK-2", "PHID-DREV-1", "PHID-TASK-1", "PHID-DREV-2"])
+
+        assert phab_client.get_link("PHID-TASK-1") == "<http://_phab_url_/T1|T1>: Task 1"
+        assert phab_client.get_owner("PHID-TASK-1") == "PHID-USER-bb"
+        assert phab_client.get_owner("PHID-TASK-2") is None
+        assert phab_client.get_link("PHID-DREV-2") == "<http://_phab_url_/D2|D2>: Diff 2"
+        assert phab_client.get_repo(phab_client._get_repo_for("PHID-DREV-2"))['name'] == "Repo 2"
+
+    instance.maniphest.search.assert_called_once_with(constraints={'phids': ["PHID-TASK-1", "PHID-TASK-2"]},
+                                                      attachments={'projects': True})
+    instance.differential.revision.search.assert_called_once_with(constraints={'phids': ["PHID-DREV-1",
+                                                                                         "PHID-DREV-2"]})
+    instance.diffusion.repository.search.assert_called_once_with(constraints={'phids': ["PHID-REPO-1",
+                                                                                        "PHID-REPO-2"]})
+
+
+@patch("phabricator.Phabricator")
+def test_prefetch_skips_cached_objects(Phabricator):
+
+    instance = Phabricator.return_value
+    instance.maniphest.search.return_value = {'data': [_task("PHID-TASK-1", 1, None)]}
+
+    phab_client = PhabClient()
+    with phab_client.request_scope():
+        phab_client.prefetch(["PHID-TASK-1"])
+    with phab_client.request_scope():
+        phab_client.prefetch(["PHID-TASK-1"])
+        assert phab_client.get_link("PHID-TASK-1") == "<http://_phab_url_/T1|T1>: Task 1"
+
+    assert instance.maniphest.search.call_count == 1
+
+
+@patch("phabricator.Phabricator")
+def test_task_project_names(Phabricator):
+
+    instance = Phabricator.return_value
+    instance.maniphest.search.return_value = {'data': [_task("PHID-TASK-1", 1, None, ["PHID-PROJ-1", "PHID-PROJ-2"])]}
+    instance.project.search.return_value = {'data': [{'id': 1, 'phid': "PHID-PROJ-1", 'fields': {'name': "Infra"}},
+                                                     {'id': 2, 'phid': "PHID-PROJ-2", 'fields': {'name': "Mobile"}}]}
+
+    phab_client = PhabClient()
+    with phab_client.request_scope():
+        assert phab_client.get_project_names("PHID-TASK-1") == ["Infra", "Mobile"]
+
+    instance.project.search.assert_called_once_with(constraints={'phids': ["PHID-PROJ-1", "PHID-PROJ-2"]})
@@ -0,0 +1,78 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import fnmatch
+import itertools
+from unittest.mock import patch
+
+import pytest
+
+from slack_notiphier.routing import ChannelRouter
+
+
+def _router():
+    return ChannelRouter({
+        '__default__': "#general",
+        '__debug__': "#debug",
+        'Backend': "#backend",
+        'Mobile*': ["#mobile", "#releases"],
+        '*-docs': "#docs",
+    }, {
+        'Infra': "#infra",
+        'Team *': ["#teams", "#infra"],
+    })
+
+
+def test_route_by_repo():
+    router = _router()
+
+    assert router.for_repo("Backend") == ("#backend",)
+    assert router.for_repo("MobileApp") == ("#mobile", "#releases")
+    assert router.for_repo("Mobile-docs") == ("#mobile", "#releases")
+    assert router.for_repo("Backend-docs") == ("#docs",)
+    assert router.for_repo("backend") == ("#general",)
+    assert router.for_repo("__debug__") == ("#general",)
+
+    # Memoized results are still right
+    assert router.for_repo("MobileApp") == ("#mobile", "#releases")
+    assert router.for_repo("Other") == ("#general",)
+
+
+def _translate_with_groups(translate):
+    # Like fnmatch.translate() in Python 3.9 and 3.10, which emit a capturing group for every '*'
+    numbers = itertools.count()
+    return lambda glob: translate(glob).replace(".*", "(?P<g{}>.*)".format(next(numbers)), 1)
+
+
+@pytest.mark.parametrize('translate_groups', [False, True])
+def test_globs_with_several_wildcards(translate_groups):
+    translate = _translate_with_groups(fnmatch.translate) if translate_groups else fnmatch.translate
+    with patch("fnmatch.translate", side_effect=translate):
+        router = ChannelRouter({'__default__': "#general", 'Mobile*App*': "#mobile", 'Web*': "#web", '*-docs': "#docs"})
+
+    assert router.for_repo("WebSite") == ("#web",)
+    assert router.for_repo("MobileXAppY") == ("#mobile",)
+    assert router.for_repo("Web-docs") == ("#web",)
+    assert router.for_repo("Backend-docs") == ("#docs",)
+    assert router.for_repo("Other") == ("#general",)
+
+
+def test_route_by_projects():
+    router = _router()
+
+    assert router.has_project_rules
+    assert router.for_projects(["Infra"]) == ("#infra",)
+    assert router.for_projects(["Team A", "Infra", "Team B"]) == ("#teams", "#infra")
+    assert router.for_projects(["Other"]) == ("#general",)
+    assert router.for_projects([]) == ("#general",)
+
+    assert not ChannelRouter({'__default__': "#general"}).has_project_rules
+
+
+def test_invalid_channels():
+    with pytest.raises(ValueError):
+        ChannelRouter({'__default__': ["#general", "#other"]})
+    with pytest.raises(ValueError):
+        ChannelRouter({'__default__': "#general", 'Backend': []})
+    with pytest.raises(ValueError):
+        ChannelRouter({'__default__': "#general"}, {'Infra': {'channel': "#infra"}})
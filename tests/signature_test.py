@@ -0,0 +1,84 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import hashlib
+import hmac
+from unittest.mock import patch
+
+import pytest
+
+from slack_notiphier import config
+from slack_notiphier.signature import SignatureVerifier, _verifications
+
+
+_BODY = b'{"object": {"type": "TASK", "phid": "PHID-TASK-1"}, "transactions": []}'
+
+
+def _sign(key, body=_BODY):
+    return hmac.new(key, body, hashlib.sha256).hexdigest()
+
+
+def test_verify_signature():
+    verifier = SignatureVerifier([b"key"])
+
+    assert verifier.verify(_BODY, _sign(b"key"))
+    assert verifier.verify(_BODY, _sign(b"key").upper())
+    assert not verifier.verify(_BODY, _sign(b"other-key"))
+    assert not verifier.verify(_BODY + b" ", _sign(b"key"))
+
+
+def test_malformed_signatures_are_invalid():
+    verifier = SignatureVerifier([b"key"])
+
+    assert not verifier.verify(_BODY, "not hexadecimal")
+    assert not verifier.verify(_BODY, _sign(b"key")[:-2])
+    assert not verifier.verify(_BODY, _sign(b"key") + "00")
+
+
+def test_any_active_key_is_valid():
+    verifier = SignatureVerifier([b"new-key", b"old-key"])
+
+    for _ in range(2):
+        assert verifier.verify(_BODY, _sign(b"old-key"))
+        assert verifier.verify(_BODY, _sign(b"new-key"))
+    assert not verifier.verify(_BODY, _sign(b"retired-key"))
+
+
+def test_verifications_are_counted():
+    verifier = SignatureVerifier([b"key"])
+    before = {result: _verifications.get(result=result) for result in ('valid', 'invalid', 'missing')}
+
+    verifier.verify(_BODY, _sign(b"key"))
+    verifier.verify(_BODY, _sign(b"other-key"))
+    verifier.verify(_BODY, None)
+
+    for result in ('valid', 'invalid', 'missing'):
+        assert _verifications.get(result=result) == before[result] + 1
+
+
+def test_keys_from_config():
+    with patch.dict(config._config, {'phabricator_webhook_hmac': "key"}):
+        assert SignatureVerifier.from_config().verify(_BODY, _sign(b"key"))
+
+    with patch.dict(config._config, {'phabricator_webhook_hmac': ["new-key", "old-key"]}):
+        assert SignatureVerifier.from_config().verify(_BODY, _sign(b"old-key"))
+
+    with patch.dict(config._config, {'phabricator_webhook_hmac': ["new-key", 1234]}):
+        with pytest.raises(ValueError):
+            SignatureVerifier.from_config()
+
+
+def test_keys_are_reloaded():
+    with patch.dict(config._config, {'phabricator_webhook_hmac': ["old-key", "other-key"]}):
+        verifier = SignatureVerifier.from_config()
+
+    apply = verifier.prepare_reload({'phabricator_webhook_hmac': ["new-key", "other-key"]})
+
+    assert verifier.verify(_BODY, _sign(b"old-key"))
+    apply()
+    assert not verifier.verify(_BODY, _sign(b"old-key"))
+    assert verifier.verify(_BODY, _sign(b"other-key"))
+    assert verifier.verify(_BODY, _sign(b"new-key"))
+
+    with pytest.raises(ValueError):
+        verifier.prepare_reload({'phabricator_webhook_hmac': []})
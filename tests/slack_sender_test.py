@@ -0,0 +1,133 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+from unittest.mock import MagicMock
+
+from slack_notiphier.slack_sender import SlackSender
+
+
+class _FakeClock:
+    """
+        Clock that only moves forward when something sleeps.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _sender(api_call, **kwargs):
+    clock = _FakeClock()
+    return SlackSender(api_call, clock=clock, sleep=clock.sleep, **kwargs), clock
+
+
+def test_send_message():
+    api_call = MagicMock(return_value={'ok': True})
+    sender, clock = _sender(api_call)
+
+    sender.send("#general", [{'text': "Hi"}])
+
+    api_call.assert_called_once_with("chat.postMessage", channel="#general", attachments=[{'text': "Hi"}])
+    assert sender.stats() == {'sent': 1, 'retried': 0, 'dropped': 0}
+    assert clock.sleeps == []
+
+
+def test_retry_after_rate_limit():
+    api_call = MagicMock(side_effect=[
+        {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '7'}},
+        {'ok': True},
+    ])
+    sender, clock = _sender(api_call)
+
+    sender.send("#general", [{'text': "Hi"}])
+
+    assert api_call.call_count == 2
+    assert clock.sleeps == [7]
+    assert sender.stats() == {'sent': 1, 'retried': 1, 'dropped': 0}
+
+
+def test_exponential_backoff_until_dropped():
+    api_call = MagicMock(return_value={'ok': False, 'error': 'internal_error'})
+    sender, clock = _sender(api_call, max_retries=3, backoff=1)
+
+    sender.send("#general", [{'text': "Hi"}])
+
+    assert api_call.call_count == 4
+    assert clock.sleeps == [1, 2, 4]
+    assert sender.stats() == {'sent': 0, 'retried': 3, 'dropped': 1}
+
+
+def test_permanent_errors_are_not_retried():
+    api_call = MagicMock(return_value={'ok': False, 'error': 'channel_not_found'})
+    sender, clock = _sender(api_call)
+
+    sender.send("#general", [{'text': "Hi"}])
+
+    assert api_call.call_count == 1
+    assert sender.stats() == {'sent': 0, 'retried': 0, 'dropped': 1}
+
+
+def test_rate_limit_per_channel():
+    api_call = MagicMock(return_value={'ok': True})
+    sender, clock = _sender(api_call, rate=1, burst=2)
+
+    for _ in range(3):
+        sender.send("#general", [{'text': "Hi"}])
+    sender.send("#other", [{'text': "Hi"}])
+
+    assert api_call.call_count == 4
+    assert clock.sleeps == [1]
+
+
+def test_background_sending():
+    api_call = MagicMock(side_effect=[
+        {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '0.01'}},
+        {'ok': True},
+        {'ok': True},
+    ])
+    sender = SlackSender(api_call, background=True)
+
+    sender.send("#general", [{'text': "One"}])
+    sender.send("#general", [{'text': "Two"}])
+
+    assert sender.flush(timeout=5)
+    assert api_call.call_count == 3
+    assert sender.stats() == {'sent': 2, 'retried': 1, 'dropped': 0, 'queued': 0, 'retrying': 0}
+
+
+def test_background_sending_keeps_order_per_channel():
+    api_call = MagicMock(side_effect=[
+        {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '0.05'}},
+        {'ok': True},
+        {'ok': True},
+        {'ok': True},
+    ])
+    sender = SlackSender(api_call, background=True)
+
+    sender.send("#general", [{'text': "One"}])
+    sender.send("#general", [{'text': "Two"}])
+    sender.send("#other", [{'text': "Three"}])
+
+    assert sender.flush(timeout=5)
+    sent = [(c[1]['channel'], c[1]['attachments'][0]['text']) for c in api_call.call_args_list]
+    # The retry holds back the rest of its channel, but not other channels
+    assert sent == [("#general", "One"), ("#other", "Three"), ("#general", "One"), ("#general", "Two")]
+
+
+def test_background_queue_size():
+    api_call = MagicMock(return_value={'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '60'}})
+    sender = SlackSender(api_call, background=True, queue_size=2)
+
+    for text in ["One", "Two", "Three"]:
+        sender.send("#general", [{'text': text}])
+
+    stats = sender.stats()
+    assert stats['dropped'] == 1
+    assert stats['queued'] == 2
@@ -1,12 +1,14 @@
 # Execute with:
 #   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
 
+import time
+
 import pytest
 from unittest.mock import patch
 
 from slack_notiphier.slack_client import SlackClient
 from slack_notiphier.phab_client import PhabClient
-from slack_notiphier.users import Users
+from slack_notiphier.users import User, Users
 
 
 @patch("phabricator.Phabricator")
@@ -94,26 +96,10 @@ def test_get_users(Phabricator, Slack, users):
     users = Users(phab_client, slack_client)
     instance.api_call.assert_called_with("users.list")
 
-    expected_user_b = {
-        'phab_username': "ph-username-bb",
-        'phid': "PHID-USER-bb",
-        'slack_id': "SLACK-ID-bb",
-    }
-    expected_user_c = {
-        'phab_username': "ph-username-cc",
-        'phid': "PHID-USER-cc",
-        'slack_id': "SLACK-ID-cc",
-    }
-    expected_user_f = {
-        'phab_username': "ph-username-ff",
-        'phid': "PHID-USER-ff",
-        'slack_id': "SLACK-ID-ff",
-    }
-    expected_user_g = {
-        'phab_username': "ph-username-gg",
-        'phid': "PHID-USER-gg",
-        'slack_id': "SLACK-ID-gg",
-    }
+    expected_user_b = User(phid="PHID-USER-bb", phab_username="ph-username-bb", slack_id="SLACK-ID-bb")
+    expected_user_c = User(phid="PHID-USER-cc", phab_username="ph-username-cc", slack_id="SLACK-ID-cc")
+    expected_user_f = User(phid="PHID-USER-ff", phab_username="ph-username-ff", slack_id="SLACK-ID-ff")
+    expected_user_g = User(phid="PHID-USER-gg", phab_username="ph-username-gg", slack_id="SLACK-ID-gg")
 
     assert expected_user_b == users["PHID-USER-bb"]
     assert expected_user_b == users["ph-username-bb"]
@@ -127,6 +113,10 @@ def test_get_users(Phabricator, Slack, users):
     assert users["ph-username-aa"] is None
     assert users["non-existent"] is None
 
+    assert users["PH-USERNAME-BB"] == expected_user_b
+    assert users.get_by_slack_id("SLACK-ID-cc") == expected_user_c
+    assert users.get_by_slack_id("SLACK-ID-hh") is None
+
 
 @patch("slackclient.SlackClient")
 @patch("phabricator.Phabricator")
@@ -146,3 +136,280 @@ def test_mention_users(Phabricator, Slack, users):
     assert users.get_mention("PHID-USER-cc") == "<@SLACK-ID-cc>"
     assert users.get_mention("ph-username-bb") == "<@SLACK-ID-bb>"
     assert users.get_mention("ph-username-cc") == "<@SLACK-ID-cc>"
+
+
+@patch("phabricator.Phabricator")
+def test_phab_get_users_follows_cursors(Phabricator, users):
+
+    first_page = {'data': users['phab']['data'][:4], 'cursor': {'after': "4"}}
+    second_page = {'data': users['phab']['data'][4:], 'cursor': {'after': None}}
+
+    instance = Phabricator.return_value
+    instance.user.search.side_effect = [first_page, second_page]
+
+    phab_client = PhabClient()
+    pages = list(phab_client.iter_users(page_size=4))
+
+    assert len(pages) == 2
+    assert instance.user.search.call_args_list[0][1] == {'limit': 4}
+    assert instance.user.search.call_args_list[1][1] == {'limit': 4, 'after': "4"}
+    assert sorted(pages[0].keys()) == ['PHID-USER-bb', 'PHID-USER-cc', 'PHID-USER-dd']
+    assert sorted(pages[1].keys()) == ['PHID-USER-ee', 'PHID-USER-ff', 'PHID-USER-gg', 'PHID-USER-ii']
+
+
+@patch("phabricator.Phabricator")
+def test_phab_page_size_is_capped(Phabricator, users):
+    Phabricator.return_value.user.search.return_value = {'data': users['phab']['data'], 'cursor': {'after': None}}
+
+    list(PhabClient().iter_users(page_size=1000))
+
+    Phabricator.return_value.user.search.assert_called_once_with(limit=100)
+
+
+@patch("slackclient.SlackClient")
+def test_slack_get_users_follows_cursors(Slack, users):
+
+    first_page = {
+        'ok': True,
+        'members': users['slack']['members'][:3],
+        'response_metadata': {'next_cursor': "cursor-1"},
+    }
+    second_page = {
+        'ok': True,
+        'members': users['slack']['members'][3:],
+        'response_metadata': {'next_cursor': ""},
+    }
+
+    instance = Slack.return_value
+    instance.api_call.side_effect = [first_page, second_page]
+
+    slack_client = SlackClient()
+    users = slack_client.get_users()
+
+    assert instance.api_call.call_count == 2
+    instance.api_call.assert_called_with("users.list", cursor="cursor-1")
+    assert users == {
+        "User Name AA": "SLACK-ID-aa",
+        "User Name BB": "SLACK-ID-bb",
+        "User Name CC": "SLACK-ID-cc",
+        "User Name FF": "SLACK-ID-ff",
+        "User Name GG": "SLACK-ID-gg",
+        "User Name HH": "SLACK-ID-hh",
+    }
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_refresh_users(Phabricator, Slack, users):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = {'data': users['phab']['data'][:2]}
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    users_directory = Users(PhabClient(), SlackClient())
+    assert users_directory["ph-username-bb"] is not None
+    assert users_directory["ph-username-cc"] is None
+
+    instance_phab.user.search.return_value = {'data': users['phab']['data'][2:3]}
+    users_directory.refresh(delta=True)
+
+    assert instance_phab.user.search.call_args[1]['constraints']['createdStart'] > 0
+    assert users_directory["ph-username-bb"] is not None
+    assert users_directory["ph-username-cc"] is not None
+
+    instance_phab.user.search.return_value = {'data': users['phab']['data'][2:3]}
+    users_directory.refresh()
+
+    assert 'constraints' not in instance_phab.user.search.call_args[1]
+    assert users_directory["ph-username-bb"] is None
+    assert users_directory["ph-username-cc"] is not None
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_refresh_on_demand(Phabricator, Slack, users):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = {'data': []}
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    users_directory = Users(PhabClient(), SlackClient())
+    assert users_directory["PHID-USER-bb"] is None
+
+    instance_phab.user.search.return_value = users['phab']
+    users_directory.start_refresher(interval=0, on_demand_interval=3600)
+
+    assert users_directory.request_refresh()
+    assert not users_directory.request_refresh()
+
+    for _ in range(1000):
+        if users_directory["PHID-USER-bb"]:
+            break
+        time.sleep(0.01)
+    users_directory.stop_refresher()
+
+    assert users_directory["PHID-USER-bb"] is not None
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_failed_refreshes_back_off(Phabricator, Slack, users):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = {'data': []}
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    users_directory = Users(PhabClient(), SlackClient())
+
+    instance_phab.user.search.reset_mock()
+    instance_phab.user.search.side_effect = Exception("Conduit is down")
+    with patch.object(Users, '_min_retry_delay', 0.1):
+        users_directory.start_refresher(interval=0.01, on_demand_interval=3600)
+        time.sleep(0.5)
+        users_directory.stop_refresher()
+
+    # Retried after 0.1, 0.2 and 0.4 seconds at most, instead of in a busy loop
+    assert 1 <= instance_phab.user.search.call_count <= 4
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_resolve_unknown_users(Phabricator, Slack, users):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = {'data': users['phab']['data'][:1]}
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    users_directory = Users(PhabClient(), SlackClient())
+    assert users_directory["PHID-USER-bb"] is None
+
+    # Known by Phabricator, added to the directory with a single lookup
+    instance_phab.user.search.return_value = users['phab']
+    expected_user_b = User(phid="PHID-USER-bb", phab_username="ph-username-bb", slack_id="SLACK-ID-bb")
+    assert users_directory.resolve("PHID-USER-bb") == expected_user_b
+    instance_phab.user.search.assert_called_with(constraints={'phids': ["PHID-USER-bb"]})
+
+    search_count = instance_phab.user.search.call_count
+    assert users_directory["PHID-USER-bb"] == expected_user_b
+    assert users_directory["ph-username-bb"] == expected_user_b
+    assert users_directory.get_by_slack_id("SLACK-ID-bb") == expected_user_b
+    assert users_directory.resolve("PHID-USER-bb") == expected_user_b
+    assert instance_phab.user.search.call_count == search_count
+
+    # Unknown by Phabricator, not looked up again while the negative result is fresh
+    assert users_directory.resolve("PHID-USER-xx") is None
+    assert users_directory.resolve("PHID-USER-xx") is None
+    assert instance_phab.user.search.call_count == search_count + 1
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_placeholders_for_unknown_phids(Phabricator, Slack, users):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = users['phab']
+    instance_phab.phid.query.side_effect = lambda phids: {
+        "PHID-APPS-PhabricatorHeraldApplication": {'name': "Herald"}
+    } if phids == ["PHID-APPS-PhabricatorHeraldApplication"] else {}
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    users_directory = Users(PhabClient(), SlackClient())
+
+    herald = User(phid="PHID-APPS-PhabricatorHeraldApplication", phab_username="Herald", slack_id=None)
+    assert users_directory.resolve("PHID-APPS-PhabricatorHeraldApplication") is None
+    assert users_directory.get_placeholder("PHID-APPS-PhabricatorHeraldApplication") == herald
+    assert users_directory.get_placeholder("PHID-APPS-PhabricatorHeraldApplication") == herald
+    assert instance_phab.phid.query.call_count == 1
+
+    # Named after the PHID when Phabricator doesn't know it either
+    assert users_directory.get_placeholder("PHID-USER-xx").phab_username == "PHID-USER-xx"
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_resolve_refreshes_only_for_users_missing_in_slack(Phabricator, Slack, users):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = {'data': []}
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    users_directory = Users(PhabClient(), SlackClient())
+    instance_phab.user.search.return_value = users['phab']
+
+    with patch.object(users_directory, 'request_refresh') as request_refresh:
+        assert users_directory.resolve("PHID-USER-bb").slack_id == "SLACK-ID-bb"
+        request_refresh.assert_not_called()
+
+        assert users_directory.resolve("PHID-USER-ii").slack_id is None
+        request_refresh.assert_called_once_with()
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_users_snapshot(Phabricator, Slack, users, tmp_path):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = users['phab']
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    snapshot_file = str(tmp_path / "users.jsonl")
+    original = Users(PhabClient(), SlackClient(), snapshot_file=snapshot_file)
+    search_count = instance_phab.user.search.call_count
+
+    # The second directory comes from the snapshot, without downloading the users again
+    restored = Users(PhabClient(), SlackClient(), snapshot_file=snapshot_file)
+    assert instance_phab.user.search.call_count == search_count
+    assert len(restored) == len(original)
+    for phid in ["PHID-USER-bb", "PHID-USER-dd", "PHID-USER-ii"]:
+        assert restored[phid] == original[phid]
+    assert restored.get_mention("ph-username-cc") == "<@SLACK-ID-cc>"
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_unreadable_users_snapshot(Phabricator, Slack, users, tmp_path):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = users['phab']
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    snapshot_file = tmp_path / "users.jsonl"
+    snapshot_file.write_text("not json")
+
+    users_directory = Users(PhabClient(), SlackClient(), snapshot_file=str(snapshot_file))
+    assert instance_phab.user.search.call_count == 1
+    assert users_directory["PHID-USER-bb"] is not None
+
+
+@patch("slackclient.SlackClient")
+@patch("phabricator.Phabricator")
+def test_shared_users_snapshot(Phabricator, Slack, users, tmp_path):
+
+    instance_phab = Phabricator.return_value
+    instance_phab.user.search.return_value = users['phab']
+    instance_slack = Slack.return_value
+    instance_slack.api_call.return_value = users['slack']
+
+    snapshot_file = str(tmp_path / "users.jsonl")
+    first = Users(PhabClient(), SlackClient(), snapshot_file=snapshot_file)
+    second = Users(PhabClient(), SlackClient(), snapshot_file=snapshot_file)
+    search_count = instance_phab.user.search.call_count
+
+    # Another process refreshed the snapshot recently, so it is reused instead of downloading the users again
+    second._on_demand_interval = 60
+    second._refresh_shared()
+    assert instance_phab.user.search.call_count == search_count
+
+    # Once it is too old, the users are downloaded again
+    second._on_demand_interval = 0
+    second._refresh_shared()
+    assert instance_phab.user.search.call_count == search_count + 1
+    assert len(second) == len(first)
@@ -0,0 +1,100 @@
+# Execute with:
+#   Repos/slack-notiphier/src $ ../venv/bin/python -m  pytest ../tests
+
+import hashlib
+import hmac
+import io
+import json
+from unittest.mock import patch
+
+import pytest
+
+from slack_notiphier import config
+from slack_notiphier.config_watcher import ConfigWatcher
+from slack_notiphier.webhook_firehose import WebhookFirehose
+from slack_notiphier.wsgi import create_app
+
+
+_HMAC_KEY = "_hmac_key_"
+
+
+@pytest.fixture
+def client(users):
+    with patch("phabricator.Phabricator") as Phabricator, patch("slackclient.SlackClient") as Slack, \
+            patch.dict(config._config, {'phabricator_webhook_hmac': _HMAC_KEY, 'max_body_size': 1000}), \
+            patch.object(WebhookFirehose, 'handle') as handle, patch.object(ConfigWatcher, 'start'):
+        Phabricator.return_value.user.search.return_value = users['phab']
+        Slack.return_value.api_call.return_value = {'ok': True, 'members': []}
+
+        app = create_app()
+        # Werkzeug 0.14, the pinned version, only enforces it when parsing forms, the limit can't rely on it
+        app.config['MAX_CONTENT_LENGTH'] = None
+        client = app.test_client()
+        client.handle = handle
+        yield client
+
+
+def _post(client, body, signature=None):
+    headers = {'Content-Type': 'application/json'}
+    headers['X-Phabricator-Webhook-Signature'] = signature or hmac.new(_HMAC_KEY.encode(), body,
+                                                                       hashlib.sha256).hexdigest()
+    return client.post('/firehose', data=body, headers=headers)
+
+
+def test_firehose_handles_signed_deliveries(client):
+    delivery = {'object': {'type': "TASK", 'phid': "PHID-TASK-1"}, 'transactions': []}
+
+    response = _post(client, json.dumps(delivery).encode())
+
+    assert response.status_code == 200
+    client.handle.assert_called_once_with(delivery)
+
+
+def test_firehose_rejects_bad_deliveries(client):
+    assert _post(client, b'{"object": {}}', signature="0" * 64).status_code == 400
+    assert _post(client, b'{"object": ').status_code == 400
+    assert _post(client, b'{}').status_code == 400
+
+    client.handle.assert_not_called()
+
+
+def test_firehose_rejects_large_deliveries(client):
+    delivery = {'object': {'type': "TASK", 'phid': "PHID-TASK-1"},
+                'transactions': [{'phid': "PHID-XACT-TASK-{}".format(i)} for i in range(100)]}
+
+    response = _post(client, json.dumps(delivery).encode())
+
+    assert response.status_code == 413
+    client.handle.assert_not_called()
+
+
+class _UnreadableStream(io.BytesIO):
+
+    def read(self, *args, **kwargs):
+        raise AssertionError("The body was read")
+
+    readinto = readline = read
+
+
+def test_firehose_does_not_read_deliveries_announced_as_large(client):
+    response = client.post('/firehose', input_stream=_UnreadableStream(), content_type='application/json',
+                           environ_overrides={'CONTENT_LENGTH': '2000'})
+
+    assert response.status_code == 413
+    client.handle.assert_not_called()
+
+
+def test_firehose_rejects_large_deliveries_without_content_length(client):
+    delivery = {'object': {'type': "TASK", 'phid': "PHID-TASK-1"},
+                'transactions': [{'phid': "PHID-XACT-TASK-{}".format(i)} for i in range(100)]}
+    body = json.dumps(delivery).encode()
+    signature = hmac.new(_HMAC_KEY.encode(), body, hashlib.sha256).hexdigest()
+
+    # As with chunked requests, the size is only known once the body is read
+    response = client.post('/firehose', input_stream=io.BytesIO(body),
+                           environ_overrides={'wsgi.input_terminated': True},
+                           headers={'Content-Type': 'application/json',
+                                    'X-Phabricator-Webhook-Signature': signature})
+
+    assert response.status_code == 413
+    client.handle.assert_not_called()